@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generate HAProxy log lines, in the syslog format, for benchmarks and load
+# testing, e.g.
+#
+#   python3 benchmarks/log_generator.py --lines 1000000 --paths 5000 \
+#     | prometheus-haproxy-log-exporter --stdin
+
+import sys
+import random
+import argparse
+import itertools
+
+MONTHS = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+)
+
+STATUS_CODES = (200, 200, 200, 200, 200, 200, 304, 301, 404, 500, 502, 503)
+
+METHODS = ('GET', 'GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE', 'HEAD')
+
+
+def zipf_weights(count):
+    """Weights making the first choices the most common, like real traffic"""
+
+    return list(itertools.accumulate(1 / (i + 1) for i in range(count)))
+
+
+def generate_lines(
+    count,
+    seed=0,
+    frontends=4,
+    backends=8,
+    servers=4,
+    paths=100,
+    status_codes=len(set(STATUS_CODES)),
+    tcp_fraction=0.2,
+    start_time=1465475499,
+    lines_per_second=1000,
+):
+    """Yield count HAProxy log lines, as str.
+
+    The same seed gives the same lines. frontends, backends, servers (per
+    backend), paths and status_codes set the number of distinct values of
+    each, and tcp_fraction the fraction of lines in the TCP log format.
+    """
+
+    rng = random.Random(seed)
+
+    frontend_names = ['fe%d' % i for i in range(frontends)]
+    backend_names = ['be%d' % i for i in range(backends)]
+    server_names = {
+        backend_name: ['%s-srv%d' % (backend_name, i) for i in range(servers)]
+        for backend_name in backend_names
+    }
+    path_names = [
+        '/api/v1/resource%d/%d' % (i % 50, i) if i % 3 else '/page%d' % i
+        for i in range(paths)
+    ]
+    statuses = sorted(set(STATUS_CODES), key=STATUS_CODES.index)[:status_codes]
+    status_weights = [STATUS_CODES.count(status) for status in statuses]
+
+    frontend_weights = zipf_weights(frontends)
+    backend_weights = zipf_weights(backends)
+    path_weights = zipf_weights(paths)
+
+    for i in range(count):
+        timestamp = start_time + i // lines_per_second
+        seconds = timestamp % 86400
+        day = 9 + timestamp // 86400 - start_time // 86400
+
+        syslog_date = 'Jun %2d %02d:%02d:%02d' % (day, seconds // 3600, seconds // 60 % 60, seconds % 60)
+        accept_date = '%02d/Jun/2016:%02d:%02d:%02d.%03d' % (
+            day,
+            seconds // 3600,
+            seconds // 60 % 60,
+            seconds % 60,
+            rng.randrange(1000),
+        )
+
+        frontend_name = rng.choices(frontend_names, cum_weights=frontend_weights)[0]
+        backend_name = rng.choices(backend_names, cum_weights=backend_weights)[0]
+        server_name = rng.choice(server_names[backend_name])
+
+        client = '10.%d.%d.%d:%d' % (
+            rng.randrange(256),
+            rng.randrange(256),
+            rng.randrange(256),
+            rng.randrange(1024, 65536),
+        )
+
+        time_wait_queues = int(rng.expovariate(1)) if rng.random() < 0.1 else 0
+        time_connect = int(rng.expovariate(0.5))
+        total_time = int(rng.expovariate(0.01)) + time_wait_queues + time_connect
+        queue_server = int(rng.expovariate(1)) if time_wait_queues else 0
+        queue_backend = int(rng.expovariate(1)) if time_wait_queues else 0
+
+        prefix = '%s lb1 haproxy[%d]: %s [%s] ' % (
+            syslog_date,
+            1000 + i % 8,
+            client,
+            accept_date,
+        )
+
+        if rng.random() < tcp_fraction:
+            yield '%s%s~ %s/%s %d/%d/%d %d -- 1/1/0/0/0 %d/%d' % (
+                prefix,
+                frontend_name,
+                backend_name,
+                server_name,
+                time_wait_queues,
+                time_connect,
+                total_time,
+                rng.randrange(100, 100000),
+                queue_server,
+                queue_backend,
+            )
+        else:
+            time_wait_request = int(rng.expovariate(0.2))
+            time_wait_response = max(total_time - time_wait_queues - time_connect - 1, 0)
+
+            yield '%s%s %s/%s %d/%d/%d/%d/%d %d %d - - ---- 1/1/0/0/0 %d/%d "%s %s HTTP/1.1"' % (
+                prefix,
+                frontend_name,
+                backend_name,
+                server_name,
+                time_wait_request,
+                time_wait_queues,
+                time_connect,
+                time_wait_response,
+                total_time + time_wait_request,
+                rng.choices(statuses, weights=status_weights)[0],
+                rng.randrange(100, 100000),
+                queue_server,
+                queue_backend,
+                rng.choice(METHODS),
+                rng.choices(path_names, cum_weights=path_weights)[0],
+            )
+
+
+def add_generator_arguments(p):
+    p.add_argument('--lines', type=int, default=100000)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--frontends', type=int, default=4)
+    p.add_argument('--backends', type=int, default=8)
+    p.add_argument('--servers', type=int, default=4, help="Servers per backend")
+    p.add_argument('--paths', type=int, default=100)
+    p.add_argument('--status-codes', type=int, default=len(set(STATUS_CODES)))
+    p.add_argument('--tcp-fraction', type=float, default=0.2)
+
+
+def generate_lines_from_options(options):
+    return generate_lines(
+        options.lines,
+        seed=options.seed,
+        frontends=options.frontends,
+        backends=options.backends,
+        servers=options.servers,
+        paths=options.paths,
+        status_codes=options.status_codes,
+        tcp_fraction=options.tcp_fraction,
+    )
+
+
+def main():
+    p = argparse.ArgumentParser()
+    add_generator_arguments(p)
+    options = p.parse_args()
+
+    for line in generate_lines_from_options(options):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
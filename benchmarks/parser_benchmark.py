@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the lines per second of the built in parser against the
+# JOURNAL_REGEX + HaproxyLogLine path it replaced.
+#
+#   python3 benchmarks/parser_benchmark.py [--lines N]
+
+import argparse
+import time
+
+from haproxy.haproxy_logline import HaproxyLogLine
+
+from prometheus_haproxy_log_exporter.log_parser import FIELDS, create_parser
+from prometheus_haproxy_log_exporter.log_processing import JOURNAL_REGEX
+
+SAMPLE_LINES = (
+    'Jun  9 12:31:39 softwarelb1-prod1.z01.finn.no haproxy[11058]: 127.0.0.1:42563 [09/Jun/2016:12:31:39.908] '
+    'cache.api.finn.no-tls cache.api.finn.no-backend/apicache3.finn.no 0/0/1/1/2 200 1771 - - ---- 1/1/0/0/0 0/0 '
+    '"GET / HTTP/1.1"',
+    'Jun  9 12:31:39 softwarelb1-prod1.z01.finn.no haproxy[11066]: 127.0.0.1:42563 [09/Jun/2016:12:31:39.900] '
+    'cache.api.finn.no-tls-termination~ cache.api.finn.no-tls-termination/cache.api.finn.no-tls-frontend '
+    '8/1/11 1752 -- 0/0/0/0/0 0/0',
+    'Jun  9 12:31:46 softwarelb1-prod1.z01.finn.no haproxy[11058]: 127.0.0.1:50672 [09/Jun/2016:12:31:46.565] '
+    'statistics statistics/<STATS> 0/0/0/0/0 200 1715 - - LR-- 1/1/0/0/0 0/0 "GET /statistics;csv HTTP/1.1"',
+)
+
+# The fields used by the default --enabled-metrics and labels
+DEFAULT_FIELDS = (
+    'status_code', 'backend_name', 'server_name',
+    'time_wait_request', 'time_wait_queues', 'time_connect_server',
+    'time_wait_response', 'total_time', 'queue_backend', 'queue_server',
+)
+
+
+def haproxy_logline(raw_line):
+    return HaproxyLogLine(JOURNAL_REGEX.sub('', raw_line.strip()).strip())
+
+
+def measure(parse, lines):
+    start = time.perf_counter()
+    for raw_line in lines:
+        parse(raw_line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--lines', type=int, default=300000)
+    options = p.parse_args()
+
+    lines = [
+        SAMPLE_LINES[i % len(SAMPLE_LINES)]
+        for i in range(options.lines)
+    ]
+
+    results = (
+        ('HaproxyLogLine', measure(haproxy_logline, lines)),
+        ('create_parser(all fields)', measure(create_parser(FIELDS), lines)),
+        ('create_parser(default fields)', measure(create_parser(DEFAULT_FIELDS), lines)),
+    )
+
+    baseline = results[0][1]
+    for name, lines_per_second in results:
+        print("%-32s %10.0f lines/s  %5.2fx" % (
+            name,
+            lines_per_second,
+            lines_per_second / baseline,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure the throughput and latency of each stage of processing generated
+# lines, writing the results as JSON, to compare between commits, e.g.
+#
+#   PYTHONPATH=. python3 benchmarks/throughput_benchmark.py --lines 200000 --paths 1000 \
+#     --output before.json -- --requests-total-labels status_code http_request_path
+#
+# Options after -- are passed to the exporter, to choose the metrics.
+
+import sys
+import json
+import time
+import shlex
+import resource
+import argparse
+import platform
+import threading
+import subprocess
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.exposition import generate_latest
+
+from prometheus_haproxy_log_exporter import cli
+from prometheus_haproxy_log_exporter.exposition import IncrementalExposition
+from prometheus_haproxy_log_exporter.log_parser import create_parser
+from prometheus_haproxy_log_exporter.log_processing import JOURNAL_REGEX
+
+from log_generator import add_generator_arguments, generate_lines_from_options
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(durations):
+    durations = sorted(durations)
+
+    return {
+        'p%d' % percentile: durations[min(len(durations) * percentile // 100, len(durations) - 1)]
+        for percentile in (50, 90, 99)
+    }
+
+
+def measure_stage(name, function, inputs, latency_every=10):
+    """Measure the throughput of calling function with each of inputs, and
+    the latency of every latency_every'th call, returning the results and
+    outputs.
+    """
+
+    start = time.perf_counter()
+    outputs = [function(value) for value in inputs]
+    duration = time.perf_counter() - start
+
+    perf_counter_ns = time.perf_counter_ns
+    durations = []
+    for value in inputs[::latency_every]:
+        call_start = perf_counter_ns()
+        function(value)
+        durations.append(perf_counter_ns() - call_start)
+
+    result = {
+        'stage': name,
+        'lines': len(inputs),
+        'seconds': duration,
+        'lines_per_second': len(inputs) / duration,
+        'latency_ns': percentiles(durations),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+    print("%-12s %10.0f lines/s  p50 %6dns  p99 %6dns" % (
+        name,
+        result['lines_per_second'],
+        result['latency_ns']['p50'],
+        result['latency_ns']['p99'],
+    ), file=sys.stderr)
+
+    return result, outputs
+
+
+def measure_scrape(name, render, repeat=5):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = render()
+        durations.append(time.perf_counter() - start)
+
+    result = {
+        'stage': name,
+        'seconds': min(durations),
+        'bytes': len(output),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+    print("%-12s %10.3fs  %d bytes" % (name, result['seconds'], result['bytes']), file=sys.stderr)
+
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argv = sys.argv[1:]
+    exporter_args = []
+    if '--' in argv:
+        exporter_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    p = argparse.ArgumentParser()
+    add_generator_arguments(p)
+    p.add_argument('--output', help="Write the results to this file, rather than stdout")
+    options = p.parse_args(argv)
+
+    exporter_options = cli.get_argument_parser().parse_args(['--stdin'] + exporter_args)
+
+    lines = list(generate_lines_from_options(options))
+    binary_lines = [line.encode('utf-8') for line in lines]
+
+    registry = CollectorRegistry()
+    update_metrics = cli.create_metric_updater(exporter_options, registry=registry)
+    parse_line = create_parser(
+        update_metrics.fields,
+        binary=True,
+        path_normalizer=cli.create_path_normalizer(exporter_options),
+    )
+
+    stages = []
+
+    # The syslog prefix strip and HaproxyLogLine parse used before
+    result, _ = measure_stage(
+        'strip',
+        lambda line: JOURNAL_REGEX.sub('', line),
+        lines,
+    )
+    stages.append(result)
+
+    result, parsed_lines = measure_stage('parse', parse_line, binary_lines)
+    stages.append(result)
+
+    # Only measure updating the metrics once, as the latency measurement
+    # updates them again
+    result, _ = measure_stage('update', update_metrics, parsed_lines)
+    stages.append(result)
+
+    stages.append(measure_scrape(
+        'scrape',
+        lambda: generate_latest(registry),
+    ))
+
+    exposition = IncrementalExposition(
+        update_metrics.caches,
+        threading.Lock(),
+        registry,
+        max_age=0,
+    )
+    exposition.get()
+    stages.append(measure_scrape(
+        'incremental',
+        exposition.get,
+    ))
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'generator': {
+            name: getattr(options, name)
+            for name in (
+                'lines', 'seed', 'frontends', 'backends', 'servers', 'paths',
+                'status_codes', 'tcp_fraction',
+            )
+        },
+        'exporter_args': ' '.join(shlex.quote(arg) for arg in exporter_args),
+        'series': sum(len(cache) for cache in update_metrics.caches),
+        'stages': stages,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Converts archived HAProxy logs in to OpenMetrics text with timestamps, for
+# promtool tsdb create-blocks-from openmetrics
+#
+#   prometheus-haproxy-log-exporter backfill --output-directory out/ \
+#     /var/log/haproxy.log.*.gz
+
+import io
+import os
+import re
+import bz2
+import gzip
+import lzma
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import configargparse
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import _floatToGoString
+
+from .cli import (
+    add_metric_arguments, create_metric_updater, create_path_normalizer,
+)
+from .exposition import format_labels
+from .log_parser import accept_timestamp, create_parser
+
+# Prometheus considers a series stale if it has no samples for 5 minutes, so
+# there is no point filling longer gaps between lines
+LOOKBACK_DELTA = 300
+
+UTC_OFFSET_REGEX = re.compile(r'\A([+-])(\d\d):?(\d\d)\Z')
+
+
+def utc_offset(value):
+    match = UTC_OFFSET_REGEX.match(value)
+    if match is None:
+        raise configargparse.ArgumentTypeError(
+            "invalid UTC offset %s, expected e.g. +0200" % value,
+        )
+
+    sign, hours, minutes = match.groups()
+    offset = int(hours) * 3600 + int(minutes) * 60
+
+    return -offset if sign == '-' else offset
+
+
+def get_argument_parser():
+    p = configargparse.ArgParser(
+        prog="prometheus-haproxy-log-exporter backfill",
+    )
+
+    p.add(
+        '-v',
+        '--verbose',
+        help="Enable debug logging",
+        action="store_true"
+    )
+
+    p.add(
+        '-c',
+        '--config',
+        is_config_file=True,
+        help="config file path",
+        env_var='CONFIG',
+    )
+
+    p.add(
+        'log_files',
+        nargs='+',
+        help="Log files to read, which can be compressed with gzip, bzip2, "
+             "xz or zstd, oldest first, e.g. haproxy.log.2.gz haproxy.log.1 "
+             "haproxy.log",
+    )
+
+    p.add(
+        '--output-directory',
+        default='.',
+        help="Directory to write an OpenMetrics file to, for each log file",
+    )
+
+    p.add(
+        '--step',
+        default=60,
+        type=int,
+        help="Interval in seconds between the samples written",
+    )
+
+    p.add(
+        '--utc-offset',
+        default='+0000',
+        type=utc_offset,
+        help="Offset from UTC of the times in the logs, e.g. +0200",
+    )
+
+    p.add(
+        '--jobs',
+        default=os.cpu_count(),
+        type=int,
+        help="Number of log files to process in parallel",
+    )
+
+    add_metric_arguments(p)
+
+    return p
+
+
+def open_log_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    elif path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    elif path.endswith('.zst'):
+        import zstandard
+
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')),
+        )
+    else:
+        return open(path, 'rb')
+
+
+class OpenMetricsWriter(object):
+    """Writes the samples of a registry at different times, in the
+    OpenMetrics text format.
+
+    The samples of each metric family are written to a temporary file of
+    their own, and only concatenated on close, as families can't be
+    interleaved in the output.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temporary_directory = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+        )
+        self.families = {}
+
+    def write_samples(self, registry, timestamp):
+        for metric in registry.collect():
+            try:
+                _, _, _, samples_file = self.families[metric.name]
+            except KeyError:
+                samples_file = open(
+                    os.path.join(self.temporary_directory, metric.name),
+                    'w',
+                )
+                self.families[metric.name] = (
+                    metric.name,
+                    metric.type,
+                    metric.documentation,
+                    samples_file,
+                )
+
+            for name, labels, value in metric.samples:
+                samples_file.write('%s%s %s %d\n' % (
+                    name,
+                    format_labels(labels),
+                    _floatToGoString(value),
+                    timestamp,
+                ))
+
+    def close(self):
+        with open(self.path, 'w') as output:
+            for name, metric_type, documentation, samples_file in self.families.values():
+                samples_file.close()
+
+                # In OpenMetrics, the family of a counter doesn't include the
+                # _total suffix, and counters without the suffix aren't
+                # allowed, so keep the sample names used by the exporter by
+                # making them unknown instead
+                if metric_type == 'counter':
+                    if name.endswith('_total'):
+                        name = name[:-len('_total')]
+                    else:
+                        metric_type = 'unknown'
+
+                output.write('# HELP %s %s\n' % (
+                    name,
+                    documentation.replace('\\', r'\\').replace('\n', r'\n'),
+                ))
+                output.write('# TYPE %s %s\n' % (name, metric_type))
+
+                with open(samples_file.name) as samples:
+                    shutil.copyfileobj(samples, output)
+
+            output.write('# EOF\n')
+
+        shutil.rmtree(self.temporary_directory)
+
+
+def parse_timestamped_line(parse_line, raw_line, source, utc_offset):
+    """Parse raw_line, returning the line and the timestamp it was accepted
+    at, or None if it can't be parsed.
+    """
+
+    try:
+        line = parse_line(raw_line.strip())
+        if line is None:
+            return None
+
+        line.source = source
+        return line, accept_timestamp(line.accept_date, utc_offset)
+    except Exception:
+        logging.exception("Failed to parse line: %s" % raw_line)
+        return None
+
+
+def write_steps(writer, registry, step, step_end, timestamp):
+    """Write the values at the end of the step, and at the end of the steps
+    without lines which follow it, if timestamp is past it, returning the end
+    of the step of timestamp.
+    """
+
+    if step_end is None:
+        return (timestamp // step + 1) * step
+
+    if timestamp < step_end:
+        return step_end
+
+    fill_end = min(timestamp, step_end + LOOKBACK_DELTA)
+    while step_end <= fill_end:
+        writer.write_samples(registry, step_end)
+        step_end += step
+
+    return (timestamp // step + 1) * step
+
+
+def backfill(options, log_file, final=True):
+    """Write the metrics for the lines of log_file, at the end of each step,
+    returning the path of the OpenMetrics file, and the number of lines which
+    couldn't be processed.
+
+    Lines are assumed to be roughly in order, lines accepted before the
+    current step are counted in the current step.
+
+    Unless log_file is the final one, the last step is left to the next log
+    file, as it also has a sample at the end of it, for lines of the same
+    step.
+    """
+
+    registry = CollectorRegistry()
+    update_metrics = create_metric_updater(options, registry=registry)
+    parse_line = create_parser(
+        update_metrics.fields + ('accept_date',),
+        binary=True,
+        path_normalizer=create_path_normalizer(options),
+    )
+
+    output_path = os.path.join(
+        options.output_directory,
+        '%s.om' % os.path.basename(log_file),
+    )
+    writer = OpenMetricsWriter(output_path)
+
+    step_end = None
+    processing_errors = 0
+
+    with open_log_file(log_file) as lines:
+        for raw_line in lines:
+            parsed = parse_timestamped_line(
+                parse_line,
+                raw_line,
+                log_file,
+                options.utc_offset,
+            )
+            if parsed is None:
+                processing_errors += 1
+                continue
+
+            line, timestamp = parsed
+            step_end = write_steps(writer, registry, options.step, step_end, timestamp)
+
+            try:
+                update_metrics(line)
+            except Exception:
+                processing_errors += 1
+                logging.exception("Failed to update metrics: %s" % raw_line)
+
+    if final and step_end is not None:
+        writer.write_samples(registry, step_end)
+
+    writer.close()
+
+    return output_path, processing_errors
+
+
+def backfill_args(args):
+    return backfill(*args)
+
+
+def main(args=None):
+    p = get_argument_parser()
+    options = p.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO)
+
+    os.makedirs(options.output_directory, exist_ok=True)
+
+    with multiprocessing.Pool(max(options.jobs, 1)) as pool:
+        for output_path, processing_errors in pool.imap_unordered(
+            backfill_args,
+            [
+                (options, log_file, i == len(options.log_files) - 1)
+                for i, log_file in enumerate(options.log_files)
+            ],
+        ):
+            logging.info("Wrote %s (%d lines could not be processed)" % (
+                output_path,
+                processing_errors,
+            ))
@@ -15,93 +15,37 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+import signal
+import socket
 import logging
+import threading
 import configargparse
 
 from os.path import join, dirname, normpath
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
+
+from prometheus_client import Histogram, REGISTRY
 
 from . import __version__
 from . import metrics
-from .exposition import create_request_handler
-
-
-def get_argument_parser():
-    p = configargparse.ArgParser(
-        prog="prometheus-haproxy-log-exporter",
-    )
-
-    p.add(
-        '--version',
-        action='version',
-        version=__version__,
-        help="Show the version",
-    )
-
-    p.add(
-        '-v',
-        '--verbose',
-        help="Enable debug logging",
-        action="store_true"
-    )
-
-    p.add(
-        '-c',
-        '--config',
-        is_config_file=True,
-        help="config file path",
-        env_var='CONFIG',
-    )
-
-    p.add(
-        '--port',
-        default='9129',
-        help="Port on which to expose metrics",
-        type=int,
-        env_var='PORT',
-    )
-    p.add(
-        '--host',
-        default='0.0.0.0',
-        help="Host on which to expose metrics",
-        env_var='HOST',
-    )
-
-    p.add(
-        '--licence-location',
-        default=join(dirname(dirname(normpath(__file__))), 'LICENSE'),
-        help="The location of the licence, linked to through the web interface",
-        env_var='LICENCE_LOCATION',
-    )
-
-    # Processor arguments
-    processor = p.add_mutually_exclusive_group(required=True)
-    processor.add_argument(
-        '-f',
-        '--file',
-        help="read logs from a log file",
-        dest='file',
-        env_var='LOG_FILE',
-    )
-    processor.add_argument(
-        '-j',
-        '--journal',
-        help="read logs from systemd journal",
-        dest='journal',
-        const="haproxy.service",
-        nargs='?',
-        action='store',
-        env_var='JOURNAL_UNIT',
-    )
-    processor.add_argument(
-        '-s',
-        '--stdin',
-        help="read logs from stdin",
-        dest='stdin',
-        action='store_true',
-        env_var='STDIN',
-    )
-
+from .compact import CompactHistogram
+from .exposition import (
+    ExpositionCollector, IncrementalExposition, create_request_handler,
+)
+from .ingest import OVERFLOW_POLICIES
+from .line_filter import filter_rule
+from .log_processing import MultiSourceProcessor
+from .paths import PathNormalizer
+from .push import MAX_PUSH_SIZE, DeltaPusher, PushCollector
+from .sampling import sampling_rule
+from .series import SeriesCacheCollector
+
+# Seconds to wait for the log processor to save its position when stopping
+STOP_TIMEOUT = 30
+
+
+def add_metric_arguments(p):
     p.add(
         '--enabled-metrics',
         nargs='+',
@@ -127,6 +71,48 @@ def get_argument_parser():
         env_var='ENABLED_TIMERS',
     )
 
+    p.add(
+        '--normalize-paths',
+        action='store_true',
+        help="Remove the query string from http_request_path, and replace "
+             "segments which look like ids with {number}, {uuid} or {hex}",
+        env_var='NORMALIZE_PATHS',
+    )
+    p.add(
+        '--path-templates',
+        nargs='+',
+        default=[],
+        metavar='TEMPLATE',
+        help="Use these templates for http_request_path, when they match, "
+             "e.g. /users/{user}/orders or /static/*, implies "
+             "--normalize-paths",
+        env_var='PATH_TEMPLATES',
+    )
+    p.add(
+        '--path-cache-size',
+        default=10000,
+        type=int,
+        help="Number of normalized paths to keep",
+        env_var='PATH_CACHE_SIZE',
+    )
+
+    p.add(
+        '--max-series-per-metric',
+        default=0,
+        type=int,
+        help="Remove the least recently used series of a metric when it has "
+             "more than this many, 0 for no limit",
+        env_var='MAX_SERIES_PER_METRIC',
+    )
+
+    p.add(
+        '--compact-histograms',
+        action='store_true',
+        help="Store the counts of all the series of each histogram in one "
+             "array, using far less memory when there are many series",
+        env_var='COMPACT_HISTOGRAMS',
+    )
+
     for counter in (
         metrics.bytes_read_total,
         metrics.requests_total,
@@ -160,6 +146,32 @@ def get_argument_parser():
             env_var='%s_BUCKETS' % timer_name.upper(),
         )
 
+        p.add_argument(
+            '--%s-quantiles' % timer_name.replace('_', '-'),
+            nargs='+',
+            type=float,
+            help="Export %s as a summary of these quantiles, e.g. 0.5 0.99, "
+                 "rather than as a histogram" % timer_name,
+            env_var='%s_QUANTILES' % timer_name.upper(),
+        )
+
+    p.add(
+        '--quantile-window',
+        default=600,
+        type=float,
+        help="Seconds of values the quantiles of the timers exported as "
+             "summaries are of",
+        env_var='QUANTILE_WINDOW',
+    )
+    p.add(
+        '--quantile-relative-accuracy',
+        default=0.01,
+        type=float,
+        help="Relative accuracy of the quantiles of the timers exported as "
+             "summaries, finer accuracy needs more memory",
+        env_var='QUANTILE_RELATIVE_ACCURACY',
+    )
+
     for queue_histogram in (
         metrics.backend_queue_length,
         metrics.server_queue_length,
@@ -183,12 +195,313 @@ def get_argument_parser():
             env_var='%s_BUCKETS' % queue_histogram.__name__.upper(),
         )
 
+
+def get_argument_parser():
+    p = configargparse.ArgParser(
+        prog="prometheus-haproxy-log-exporter",
+    )
+
+    p.add(
+        '--version',
+        action='version',
+        version=__version__,
+        help="Show the version",
+    )
+
+    p.add(
+        '-v',
+        '--verbose',
+        help="Enable debug logging",
+        action="store_true"
+    )
+
+    p.add(
+        '-c',
+        '--config',
+        is_config_file=True,
+        help="config file path",
+        env_var='CONFIG',
+    )
+
+    p.add(
+        '--port',
+        default='9129',
+        help="Port on which to expose metrics",
+        type=int,
+        env_var='PORT',
+    )
+    p.add(
+        '--host',
+        default='0.0.0.0',
+        help="Host on which to expose metrics",
+        env_var='HOST',
+    )
+
+    p.add(
+        '--licence-location',
+        default=join(dirname(dirname(normpath(__file__))), 'LICENSE'),
+        help="The location of the licence, linked to through the web interface",
+        env_var='LICENCE_LOCATION',
+    )
+
+    p.add(
+        '--metrics-max-age',
+        default=1000,
+        type=int,
+        help="Render the metrics at most once in this many milliseconds, "
+             "serving the same output to the scrapes in between",
+        env_var='METRICS_MAX_AGE',
+    )
+
+    p.add(
+        '--debug-endpoints',
+        action='store_true',
+        help="Serve /debug/profile?seconds=N, returning the sampled stacks of "
+             "the threads processing lines, and /debug/tracemalloc, returning "
+             "the top memory allocations, traced from the first request until "
+             "/debug/tracemalloc?stop=1. Only the main process is profiled, "
+             "so with --workers, the lines processed by the workers aren't",
+        env_var='DEBUG_ENDPOINTS',
+    )
+
+    p.add(
+        '--enable-reload-endpoint',
+        action='store_true',
+        help="Reload the metric arguments, from the command line, config "
+             "file and environment, on POST /-/reload, as on SIGHUP",
+        env_var='ENABLE_RELOAD_ENDPOINT',
+    )
+
+    # Processor arguments, any of --file, --journal and --syslog can be
+    # combined, and their lines are processed together
+    processor = p.add_argument_group('sources of the logs')
+    processor.add_argument(
+        '-f',
+        '--file',
+        help="read logs from one or more log files, or glob patterns, e.g. "
+             "'/var/log/haproxy/*.log', expanded when starting",
+        dest='file',
+        nargs='+',
+        metavar='PATH',
+        env_var='LOG_FILE',
+    )
+    processor.add_argument(
+        '-j',
+        '--journal',
+        help="read logs of one or more units from systemd journal, "
+             "haproxy.service if none are given",
+        dest='journal',
+        nargs='*',
+        metavar='UNIT',
+        env_var='JOURNAL_UNIT',
+    )
+    processor.add_argument(
+        '-s',
+        '--stdin',
+        help="read logs from stdin, which can't be combined with another "
+             "source",
+        dest='stdin',
+        action='store_true',
+        env_var='STDIN',
+    )
+    processor.add_argument(
+        '--syslog',
+        help="receive logs as syslog messages, on one or more addresses, "
+             "e.g. udp://0.0.0.0:514, tcp://0.0.0.0:514 or "
+             "unix:///run/haproxy-log.sock",
+        dest='syslog',
+        nargs='+',
+        metavar='ADDRESS',
+        env_var='SYSLOG',
+    )
+    processor.add_argument(
+        '--aggregate',
+        help="read no logs, but aggregate the metrics pushed to /push by "
+             "other exporters with --push-url, which must have the same "
+             "metric arguments, which can't be combined with a source",
+        dest='aggregate',
+        action='store_true',
+        env_var='AGGREGATE',
+    )
+
+    p.add(
+        '--aggregate-max-push-bytes',
+        default=MAX_PUSH_SIZE,
+        type=int,
+        help="With --aggregate, reject pushes of more than this many bytes, "
+             "compressed",
+        env_var='AGGREGATE_MAX_PUSH_BYTES',
+    )
+
+    p.add(
+        '--push-url',
+        help="Push the updates to the metrics to the exporter with "
+             "--aggregate at this URL, e.g. http://aggregator:9129/push, "
+             "requires --batch-lines or --workers",
+        env_var='PUSH_URL',
+    )
+    p.add(
+        '--push-interval',
+        default=15,
+        type=float,
+        help="Seconds between pushes to --push-url",
+        env_var='PUSH_INTERVAL',
+    )
+    p.add(
+        '--push-instance',
+        default=socket.gethostname(),
+        help="Name of this exporter, to the exporter it pushes to",
+        env_var='PUSH_INSTANCE',
+    )
+
+    p.add(
+        '--file-state-path',
+        help="With --file, save the position in each log file here "
+             "periodically, and when stopping, and resume from it when "
+             "starting",
+        env_var='LOG_FILE_STATE_PATH',
+    )
+    p.add(
+        '--journal-state-path',
+        help="With --journal, save the cursor of the last journal entry "
+             "processed here periodically, and when stopping, and resume "
+             "after it when starting",
+        env_var='JOURNAL_STATE_PATH',
+    )
+
+    p.add(
+        '--series-ttl',
+        default=0,
+        type=float,
+        help="Remove the series of a metric which haven't been updated for "
+             "this many seconds, e.g. of a server removed from a backend, 0 to "
+             "keep them",
+        env_var='SERIES_TTL',
+    )
+
+    p.add(
+        '--queue-lines',
+        default=0,
+        type=int,
+        help="Maximum number of lines waiting to be processed by a separate "
+             "thread, e.g. 100000, 0 to process each line as it's read",
+        env_var='QUEUE_LINES',
+    )
+    p.add(
+        '--overflow-policy',
+        default='block',
+        choices=OVERFLOW_POLICIES,
+        help="What to do with lines when --queue-lines are already waiting: "
+             "wait for space (block), drop the oldest waiting line "
+             "(drop-oldest), or only process 1 in --sample-every lines until "
+             "the queue is half empty, counting each one that many times "
+             "(sample)",
+        env_var='OVERFLOW_POLICY',
+    )
+    p.add(
+        '--sample-every',
+        default=10,
+        type=int,
+        help="With --overflow-policy sample, process 1 in this many lines",
+        env_var='SAMPLE_EVERY',
+    )
+
+    p.add(
+        '--include-lines',
+        nargs='+',
+        default=[],
+        type=filter_rule,
+        metavar='FIELD=PATTERN',
+        help="Only process lines matching one of these rules, where FIELD is "
+             "frontend, backend, server or status, and * in PATTERN matches "
+             "anything, and x any digit in a status, e.g. status=5xx",
+        env_var='INCLUDE_LINES',
+    )
+    p.add(
+        '--exclude-lines',
+        nargs='+',
+        default=[],
+        type=filter_rule,
+        metavar='FIELD=PATTERN',
+        help="Don't process lines matching any of these rules, e.g. "
+             "backend=statistics",
+        env_var='EXCLUDE_LINES',
+    )
+
+    p.add(
+        '--frontend-sampling-rates',
+        nargs='+',
+        default=[],
+        type=sampling_rule,
+        metavar='FRONTEND=RATE',
+        help="Only process this fraction of the lines of these frontends, "
+             "scaling the metrics up to match, e.g. www=0.1",
+        env_var='FRONTEND_SAMPLING_RATES',
+    )
+    p.add(
+        '--backend-sampling-rates',
+        nargs='+',
+        default=[],
+        type=sampling_rule,
+        metavar='BACKEND=RATE',
+        help="Only process this fraction of the lines of these backends, "
+             "unless the frontend has a sampling rate",
+        env_var='BACKEND_SAMPLING_RATES',
+    )
+
+    p.add(
+        '--batch-lines',
+        default=0,
+        type=int,
+        help="Collect the updates from this many lines before applying them "
+             "to the metrics, 0 to apply the updates from each line directly",
+        env_var='BATCH_LINES',
+    )
+    p.add(
+        '--batch-max-delay',
+        default=1000,
+        type=int,
+        help="The maximum time in milliseconds before collected updates are "
+             "applied to the metrics, when using --batch-lines",
+        env_var='BATCH_MAX_DELAY',
+    )
+
+    p.add(
+        '--workers',
+        default=0,
+        type=int,
+        help="Parse lines in this many worker processes, 0 to parse them in "
+             "the main process",
+        env_var='WORKERS',
+    )
+
+    add_metric_arguments(p)
+
     return p
 
 
-def create_log_processor(options, error):
+def create_path_normalizer(options):
+    if not (options.normalize_paths or options.path_templates):
+        return None
+
+    return PathNormalizer(
+        options.path_templates,
+        max_cache_size=options.path_cache_size,
+    )
+
+
+def create_metric_updater(options, registry=REGISTRY):
+    """Create the enabled metrics, fused in to one updater, which only
+    extracts the fields they use.
+    """
+
     metric_updaters = []
 
+    if options.compact_histograms:
+        histogram_class = CompactHistogram
+    else:
+        histogram_class = Histogram
+
     for timer_name in metrics.TIMERS.keys():
         if timer_name not in options.enabled_metrics:
             continue
@@ -197,7 +510,17 @@ def create_log_processor(options, error):
         buckets = getattr(options, '%s_buckets' % timer_name)
 
         metric_updaters.append(
-            metrics.timer(timer_name, labelnames, buckets),
+            metrics.timer(
+                timer_name,
+                labelnames,
+                buckets,
+                max_series=options.max_series_per_metric,
+                registry=registry,
+                histogram_class=histogram_class,
+                quantiles=getattr(options, '%s_quantiles' % timer_name),
+                quantile_window=options.quantile_window,
+                relative_accuracy=options.quantile_relative_accuracy,
+            ),
         )
 
     for counter in (
@@ -209,7 +532,11 @@ def create_log_processor(options, error):
 
         labelnames = getattr(options, '%s_labels' % counter.__name__)
 
-        metric_updaters.append(counter(labelnames))
+        metric_updaters.append(counter(
+            labelnames,
+            max_series=options.max_series_per_metric,
+            registry=registry,
+        ))
 
     for queue_histogram in (
         metrics.backend_queue_length,
@@ -221,31 +548,227 @@ def create_log_processor(options, error):
         labelnames = getattr(options, '%s_labels' % queue_histogram.__name__)
         buckets = getattr(options, '%s_buckets' % queue_histogram.__name__)
 
-        metric_updaters.append(queue_histogram(labelnames, buckets))
+        metric_updaters.append(queue_histogram(
+            labelnames,
+            buckets,
+            max_series=options.max_series_per_metric,
+            registry=registry,
+            histogram_class=histogram_class,
+        ))
+
+    return metrics.compile_plan(metric_updaters)
 
-    if options.stdin:
-        from .stdin import StdinProcessor
 
-        log_processor = StdinProcessor(metric_updaters)
-    elif options.journal:
+def create_sources(options, processor_kwargs):
+    """Create the log processors of the sources given by options, apart from
+    --stdin and --aggregate, which are on their own.
+    """
+
+    sources = []
+
+    if options.journal is not None:
         from .journal import JournalProcessor
 
-        log_processor = JournalProcessor(
-            metric_updaters=metric_updaters,
-            unit=options.journal,
-        )
-    elif options.file:
+        sources.append(JournalProcessor(
+            units=options.journal or ['haproxy.service'],
+            state_path=options.journal_state_path,
+            **processor_kwargs
+        ))
+
+    if options.syslog:
+        from .syslog import SyslogProcessor
+
+        sources.append(SyslogProcessor(
+            addresses=options.syslog,
+            **processor_kwargs
+        ))
+
+    if options.file:
         from .file import LogFileProcessor
 
-        log_processor = LogFileProcessor(
-            metric_updaters=metric_updaters,
-            path=options.file,
+        sources.append(LogFileProcessor(
+            paths=options.file,
+            state_path=options.file_state_path,
+            **processor_kwargs
+        ))
+
+    return sources
+
+
+def create_log_processor(options, error):
+    update_metrics = create_metric_updater(options)
+    metric_updaters = [update_metrics]
+    caches = update_metrics.caches
+
+    processor_kwargs = dict(
+        metric_updaters=metric_updaters,
+        fields=update_metrics.fields,
+        caches=caches,
+        batch_lines=options.batch_lines,
+        batch_max_delay=options.batch_max_delay / 1000,
+        workers=options.workers,
+        queue_lines=options.queue_lines,
+        overflow_policy=options.overflow_policy,
+        sample_every=options.sample_every,
+        frontend_sampling_rates=options.frontend_sampling_rates,
+        backend_sampling_rates=options.backend_sampling_rates,
+        include_rules=options.include_lines,
+        exclude_rules=options.exclude_lines,
+        path_normalizer=create_path_normalizer(options),
+        series_ttl=options.series_ttl,
+    )
+
+    source_options = [
+        name
+        for name in ('file', 'journal', 'syslog', 'stdin', 'aggregate')
+        if getattr(options, name) not in (None, False)
+    ]
+    if not source_options:
+        error("one of --file, --journal, --syslog, --stdin or --aggregate is required")
+    if len(source_options) > 1 and (options.stdin or options.aggregate):
+        error("--%s can't be combined with --%s" % tuple(source_options[:2]))
+
+    if options.stdin:
+        from .stdin import StdinProcessor
+
+        return StdinProcessor(**processor_kwargs)
+    elif options.aggregate:
+        from .push import AggregateProcessor
+
+        return AggregateProcessor(
+            max_push_size=options.aggregate_max_push_bytes,
+            **processor_kwargs
         )
 
+    try:
+        if len(source_options) == 1:
+            log_processor, = create_sources(options, processor_kwargs)
+            return log_processor
+
+        # The sources only read the lines, and pass them to log_processor
+        log_processor = MultiSourceProcessor(**processor_kwargs)
+        for source in create_sources(
+            options,
+            dict(metric_updaters=None, sink=log_processor),
+        ):
+            log_processor.add_source(source)
+    except ValueError as e:
+        error(str(e))
+
     return log_processor
 
 
+def reload_metrics(log_processor, options, registry=REGISTRY):
+    """Change the metrics of the running log_processor to those of options.
+    The metrics which haven't changed keep their series, and the source of
+    the logs continues as it was, as only the metric arguments are used.
+    """
+
+    # The metrics are only registered once it's known which are new
+    update_metrics = create_metric_updater(options, registry=None)
+
+    added_caches, removed_caches = log_processor.set_metric_updaters(
+        [update_metrics],
+        update_metrics.fields,
+        update_metrics.caches,
+        path_normalizer=create_path_normalizer(options),
+    )
+
+    for cache in removed_caches:
+        registry.unregister(cache.metric)
+    for cache in added_caches:
+        registry.register(cache.metric)
+
+    logging.info("Reloaded the metrics, added %s, removed %s" % (
+        ', '.join(cache.name for cache in added_caches) or 'none',
+        ', '.join(cache.name for cache in removed_caches) or 'none',
+    ))
+
+
+def create_push(options, log_processor, error):
+    """Return the aggregator of the pushes of other exporters, if this
+    exporter aggregates them, and the pusher of the deltas of log_processor,
+    if it pushes them.
+    """
+
+    if options.aggregate:
+        PushCollector(metrics.NAMESPACE, aggregator=log_processor)
+
+        return log_processor, None
+
+    if not options.push_url:
+        return None, None
+
+    if not log_processor.batch_lines:
+        error("--push-url requires --batch-lines or --workers")
+
+    pusher = DeltaPusher(
+        log_processor,
+        options.push_url,
+        options.push_instance,
+        interval=options.push_interval,
+    )
+    PushCollector(metrics.NAMESPACE, pusher=pusher)
+
+    return None, pusher
+
+
+def create_reload(p, log_processor, series_cache_collector, exposition):
+    """Create the function reloading the metrics of log_processor from the
+    arguments parsed by p, raising ValueError if they're invalid.
+    """
+
+    reload_lock = threading.Lock()
+
+    def reload():
+        with reload_lock:
+            try:
+                new_options = p.parse_args()
+            except SystemExit:
+                raise ValueError("invalid configuration, see the log")
+
+            reload_metrics(log_processor, new_options)
+
+            series_cache_collector.caches = log_processor.metric_caches
+            exposition.caches = log_processor.caches
+
+    return reload
+
+
+def reload_on_sighup(reload):
+    def reload_logging_errors():
+        try:
+            reload()
+        except Exception:
+            logging.exception("Failed to reload the metrics")
+
+    def reload_on_signal(signum, frame):
+        # Not in the signal handler, as that interrupts the main thread
+        threading.Thread(target=reload_logging_errors, daemon=True).start()
+
+    signal.signal(signal.SIGHUP, reload_on_signal)
+
+
+def stop(log_processor, pusher):
+    """Stop log_processor, waiting for its sources to save their positions,
+    and then pusher, pushing the last deltas.
+    """
+
+    log_processor.stop()
+    log_processor.join(STOP_TIMEOUT)
+    if log_processor.is_alive():
+        logging.warning("Stopping without waiting any longer for %s" % log_processor.name)
+
+    if pusher is not None:
+        pusher.stop()
+
+
 def main():
+    if sys.argv[1:2] == ['backfill']:
+        from .backfill import main as backfill_main
+
+        return backfill_main(sys.argv[2:])
+
     p = get_argument_parser()
     options = p.parse_args()
 
@@ -254,19 +777,61 @@ def main():
     logging.info(p.format_values())
 
     log_processor = create_log_processor(options, p.error)
+
+    aggregator, pusher = create_push(options, log_processor, p.error)
+
+    series_cache_collector = SeriesCacheCollector(
+        log_processor.metric_caches,
+        metrics.NAMESPACE,
+    )
+
+    # Stopped explicitly, so a source blocked reading, e.g. from stdin,
+    # doesn't keep the process alive
+    log_processor.daemon = True
     log_processor.start()
+    if pusher is not None:
+        pusher.start()
 
     host = options.host
     port = options.port
 
-    httpd = HTTPServer(
+    exposition = IncrementalExposition(
+        log_processor.caches,
+        log_processor.lock,
+        max_age=options.metrics_max_age / 1000,
+    )
+    ExpositionCollector(exposition, metrics.NAMESPACE)
+
+    reload = create_reload(
+        p,
+        log_processor,
+        series_cache_collector,
+        exposition,
+    )
+    reload_on_sighup(reload)
+
+    # Each scrape is handled in its own thread, so a slow one doesn't delay
+    # the others
+    httpd = ThreadingHTTPServer(
         (host, port),
-        create_request_handler(options.licence_location),
+        create_request_handler(
+            options.licence_location,
+            exposition,
+            debug_threads=log_processor.threads if options.debug_endpoints else None,
+            aggregator=aggregator,
+            reload=reload if options.enable_reload_endpoint else None,
+        ),
     )
 
     logging.info("Listing on port %s:%d" % (host, port))
 
+    # Stop as on ^C, e.g. when stopped by systemd, so the positions in the
+    # logs are saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
+
+    stop(log_processor, pusher)
@@ -0,0 +1,197 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from array import array
+from bisect import bisect_left
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import Metric, _floatToGoString
+
+INF = float('inf')
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, INF,
+)
+
+
+class CompactHistogramChild(object):
+    """The series of a CompactHistogram for some label values, which is the
+    row slot of its arrays.
+    """
+
+    __slots__ = ('histogram', 'slot')
+
+    def __init__(self, histogram, slot):
+        self.histogram = histogram
+        self.slot = slot
+
+    def observe(self, amount, weight=1):
+        histogram = self.histogram
+
+        histogram.sums[self.slot] += amount * weight
+        histogram.counts[
+            self.slot * histogram.bucket_count +
+            bisect_left(histogram.upper_bounds, amount)
+        ] += weight
+
+    def add(self, total, bucket_counts):
+        """Add the sum and (not cumulative) bucket counts of observations"""
+
+        histogram = self.histogram
+        counts = histogram.counts
+        start = self.slot * histogram.bucket_count
+
+        histogram.sums[self.slot] += total
+        for i, count in enumerate(bucket_counts, start):
+            if count:
+                counts[i] += count
+
+    @staticmethod
+    def apply_delta(child, delta):
+        child.add(*delta)
+
+    def _samples(self):
+        histogram = self.histogram
+        slot = self.slot
+
+        # Removed since it was looked up, e.g. while rendering a scrape
+        if slot is None:
+            return ()
+
+        start = slot * histogram.bucket_count
+
+        samples = []
+        accumulated = 0.0
+        for le, count in zip(
+            histogram.bucket_labels,
+            histogram.counts[start:start + histogram.bucket_count],
+        ):
+            accumulated += count
+            samples.append(('_bucket', {'le': le}, accumulated))
+        samples.append(('_count', {}, accumulated))
+        samples.append(('_sum', {}, histogram.sums[slot]))
+
+        return tuple(samples)
+
+
+class CompactHistogram(CompactHistogramChild):
+    """A histogram storing the bucket counts of all its series in one array,
+    with a row of len(buckets) counts per series, and their sums in another,
+    rather than in an object with a lock for each bucket of each series, as
+    prometheus_client does.
+
+    It has the interface of a prometheus_client Histogram used by
+    SeriesCache. Like a Histogram, if it has no labels, it's the child of the
+    series itself.
+    """
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        namespace='',
+        buckets=DEFAULT_BUCKETS,
+        registry=REGISTRY,
+    ):
+        self.name = '%s_%s' % (namespace, name) if namespace else name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+
+        upper_bounds = [float(bucket) for bucket in buckets]
+        if upper_bounds != sorted(upper_bounds):
+            raise ValueError('Buckets not in sorted order')
+        if upper_bounds[-1] != INF:
+            upper_bounds.append(INF)
+
+        self.upper_bounds = upper_bounds
+        self.bucket_labels = [_floatToGoString(bound) for bound in upper_bounds]
+        self.bucket_count = len(upper_bounds)
+
+        self.counts = array('d')
+        self.sums = array('d')
+        self.zero_row = array('d', [0.0]) * self.bucket_count
+
+        self._lock = threading.Lock()
+        self._children = {}
+        self._free_slots = []
+
+        super(CompactHistogram, self).__init__(
+            self,
+            None if self._labelnames else self._allocate(),
+        )
+
+        if registry:
+            registry.register(self)
+
+    def _allocate(self):
+        if self._free_slots:
+            return self._free_slots.pop()
+
+        self.counts.extend(self.zero_row)
+        self.sums.append(0.0)
+
+        return len(self.sums) - 1
+
+    def labels(self, *label_values):
+        key = tuple(str(value) for value in label_values)
+        if len(key) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+
+        with self._lock:
+            try:
+                return self._children[key]
+            except KeyError:
+                child = self._children[key] = CompactHistogramChild(
+                    self,
+                    self._allocate(),
+                )
+                return child
+
+    def remove(self, *label_values):
+        key = tuple(str(value) for value in label_values)
+
+        with self._lock:
+            child = self._children.pop(key)
+
+            start = child.slot * self.bucket_count
+            self.counts[start:start + self.bucket_count] = self.zero_row
+            self.sums[child.slot] = 0.0
+            self._free_slots.append(child.slot)
+
+            # Any further use of the child is an error, rather than updating
+            # the series which reuses the slot
+            child.slot = None
+
+    def collect(self):
+        metric = Metric(self.name, self.documentation, 'histogram')
+
+        if self._labelnames:
+            with self._lock:
+                children = list(self._children.items())
+        else:
+            children = [((), self)]
+
+        for label_values, child in children:
+            labels = dict(zip(self._labelnames, label_values))
+
+            for suffix, sample_labels, value in child._samples():
+                metric.add_sample(
+                    self.name + suffix,
+                    dict(labels, **sample_labels),
+                    value,
+                )
+
+        return [metric]
@@ -13,7 +13,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from prometheus_client.exposition import MetricsHandler
+import gzip
+import time
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import (
+    CounterMetricFamily, GaugeMetricFamily, _floatToGoString,
+)
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+from . import profiling
 
 index_page = """
 <!doctype html>
@@ -78,22 +91,383 @@ index_page = """
 """
 
 
-def create_request_handler(licence_location):
-    class RequestHandler(MetricsHandler):
-        def do_GET(self):
-            if self.path == "/metrics":
-                return super().do_GET()
+class CachedExposition(object):
+    """Renders the metrics in registry at most once every max_age seconds,
+    sharing the output, and its gzip compressed form, between all the scrapes
+    in that time.
+
+    Only one thread renders at a time, others scraping at the same time wait
+    for, and then use, its output.
+    """
+
+    def __init__(self, registry=REGISTRY, max_age=1.0):
+        self.registry = registry
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.rendered_at = None
+        self.output = None
+        self.gzipped_output = None
+
+        self.renders = 0
+        self.render_seconds = 0
+
+    def render(self):
+        return generate_latest(self.registry)
+
+    def get(self, gzipped=False):
+        with self.lock:
+            now = time.monotonic()
+
+            if self.rendered_at is None or now - self.rendered_at >= self.max_age:
+                self.output = self.render()
+                self.gzipped_output = None
+                self.rendered_at = now
+
+                self.renders += 1
+                self.render_seconds += time.monotonic() - now
+
+            if not gzipped:
+                return self.output
+
+            if self.gzipped_output is None:
+                self.gzipped_output = gzip.compress(self.output, compresslevel=6)
+
+            return self.gzipped_output
+
+
+class ExpositionCollector(object):
+    """Exports the number of times a CachedExposition has rendered the
+    metrics, the time spent doing so, and the size of the last output.
+    """
+
+    def __init__(self, exposition, namespace, registry=REGISTRY):
+        self.exposition = exposition
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        yield CounterMetricFamily(
+            '%s_scrape_renders_total' % self.namespace,
+            "Times the metrics have been rendered for a scrape",
+            value=self.exposition.renders,
+        )
+
+        yield CounterMetricFamily(
+            '%s_scrape_render_seconds_total' % self.namespace,
+            "Time spent rendering the metrics for scrapes",
+            value=self.exposition.render_seconds,
+        )
+
+        output = self.exposition.output
+        yield GaugeMetricFamily(
+            '%s_scrape_size_bytes' % self.namespace,
+            "Size of the uncompressed metrics, as last rendered",
+            value=0 if output is None else len(output),
+        )
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'),
+        )
+        for name, value in sorted(labels.items())
+    )
 
-            self.send_response(200)
-            self.end_headers()
 
-            if self.path == "/licence":
-                with open(
-                    licence_location,
-                    'rb',
-                ) as licence:
-                    self.wfile.write(licence.read())
+class _Collectors(object):
+    def __init__(self, collectors):
+        self.collectors = collectors
+
+    def collect(self):
+        for collector in self.collectors:
+            for metric in collector.collect():
+                yield metric
+
+
+class IncrementalExposition(CachedExposition):
+    """Renders the metrics of the given SeriesCaches incrementally, keeping
+    the text of each series, and only rendering the series again once they
+    have changed, as recorded by SeriesCache.take_dirty. The metrics of the
+    other collectors in the registry are rendered in full each time.
+
+    lock is the lock held while updating the metrics, so that the dirty
+    series of all the caches are taken at the same time.
+    """
+
+    def __init__(self, caches, lock, registry=REGISTRY, max_age=1.0):
+        super(IncrementalExposition, self).__init__(registry, max_age)
+
+        self.caches = caches
+        self.processor_lock = lock
+
+        # For the metric of each cache, the HELP and TYPE lines, and the text
+        # of each series, kept when the cache is replaced by one adopting the
+        # metric
+        self.headers = {}
+        self.fragments = {}
+
+    def render(self):
+        with self.processor_lock:
+            caches = self.caches
+            all_dirty = [cache.take_dirty() for cache in caches]
+
+        output = []
+        for cache, dirty in zip(caches, all_dirty):
+            output.append(self.render_cache(cache, dirty))
+
+        cached_metrics = set(cache.metric for cache in caches)
+
+        # Forget the metrics which have been removed, e.g. by a reload
+        for metric in list(self.headers):
+            if metric not in cached_metrics:
+                del self.headers[metric]
+                del self.fragments[metric]
+        with self.registry._lock:
+            other_collectors = [
+                collector
+                for collector in self.registry._collectors
+                if collector not in cached_metrics
+            ]
+
+        output.append(generate_latest(_Collectors(other_collectors)))
+
+        return b''.join(output)
+
+    def render_cache(self, cache, dirty):
+        metric = cache.metric
+        labelnames = getattr(metric, '_labelnames', ())
+
+        try:
+            header, name = self.headers[metric]
+            fragments = self.fragments[metric]
+        except KeyError:
+            family = metric.collect()[0]
+            name = family.name
+            header = '# HELP %s %s\n# TYPE %s %s\n' % (
+                name,
+                family.documentation.replace('\\', r'\\').replace('\n', r'\n'),
+                name,
+                family.type,
+            )
+            header = header.encode('utf-8')
+
+            self.headers[metric] = header, name
+            fragments = self.fragments[metric] = {}
+
+            # The metric is exported before any lines are processed if it has
+            # no labels
+            if not labelnames:
+                dirty.add(())
+
+        for label_values in dirty:
+            if labelnames:
+                child = cache.peek(label_values)
+                if child is None:
+                    fragments.pop(label_values, None)
+                    continue
             else:
-                self.wfile.write(index_page.encode('UTF-8'))
+                child = metric
+
+            labels = dict(zip(labelnames, (str(value) for value in label_values)))
+
+            fragments[label_values] = ''.join(
+                '%s%s %s\n' % (
+                    name + suffix,
+                    format_labels(dict(labels, **sample_labels)),
+                    _floatToGoString(value),
+                )
+                for suffix, sample_labels, value in child._samples()
+            ).encode('utf-8')
+
+        return header + b''.join(fragments.values())
+
+
+def accepts_gzip(accept_encoding):
+    """Whether the value of an Accept-Encoding header allows gzip"""
+
+    for coding in accept_encoding.split(','):
+        name, _, parameters = coding.partition(';')
+
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+
+        parameters = parameters.replace(' ', '')
+        if parameters.startswith('q=') and float(parameters[2:] or 0) == 0:
+            return False
+
+        return True
+
+    return False
+
+
+def debug_output(path, debug_threads):
+    """The output of the /debug/ endpoint at path, or None if there is none.
+
+    Raises ValueError on invalid query parameters.
+    """
+
+    url = urlsplit(path)
+    query = parse_qs(url.query)
+
+    if url.path == "/debug/profile":
+        seconds = float(query.get('seconds', ['10'])[0])
+        if not 0 < seconds <= profiling.MAX_PROFILE_SECONDS:
+            raise ValueError("seconds out of range: %s" % seconds)
+
+        return profiling.sample_stacks(debug_threads, seconds)
+
+    if url.path == "/debug/tracemalloc":
+        return profiling.top_allocations(
+            int(query.get('limit', ['25'])[0]),
+            query.get('key', ['lineno'])[0],
+            stop=bool(int(query.get('stop', ['0'])[0])),
+        )
+
+    return None
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """The request handler of the HTTP server, configured by the subclass
+    create_request_handler creates.
+    """
+
+    licence_location = None
+    exposition = None
+    debug_threads = None
+    aggregator = None
+    reload = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            return self.send_metrics()
+
+        if self.debug_threads is not None and self.path.startswith("/debug/"):
+            return self.send_debug()
+
+        self.send_response(200)
+        self.end_headers()
+
+        if self.path == "/licence":
+            with open(
+                self.licence_location,
+                'rb',
+            ) as licence:
+                self.wfile.write(licence.read())
+        else:
+            self.wfile.write(index_page.encode('UTF-8'))
+
+    def do_POST(self):
+        if self.reload is not None and self.path == "/-/reload":
+            return self.send_reload()
+
+        if self.aggregator is not None and self.path == "/push":
+            return self.receive_push()
+
+        self.send_error(404)
+
+    def send_no_content(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def receive_push(self):
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return self.send_error(411)
+
+        if length > self.aggregator.max_push_size:
+            return self.send_error(413)
+
+        try:
+            self.aggregator.receive(self.rfile.read(length))
+        except ValueError as e:
+            return self.send_error(400, str(e))
+
+        self.send_no_content()
+
+    def send_reload(self):
+        try:
+            self.reload()
+        except ValueError as e:
+            return self.send_error(400, str(e))
+
+        self.send_no_content()
+
+    def send_metrics(self):
+        try:
+            gzipped = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        except ValueError:
+            gzipped = False
+
+        output = self.exposition.get(gzipped)
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(output)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+
+        self.wfile.write(output)
+
+    def send_debug(self):
+        try:
+            output = debug_output(self.path, self.debug_threads)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+
+        if output is None:
+            return self.send_error(404)
+
+        output = output.encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        return
+
+
+def create_request_handler(
+    licence_location,
+    exposition=None,
+    debug_threads=None,
+    aggregator=None,
+    reload=None,
+):
+    """Create the request handler of the HTTP server.
+
+    If debug_threads is given, /debug/profile?seconds=N returns the stacks of
+    those threads, sampled over N seconds, and /debug/tracemalloc the top
+    memory allocations, tracing them until /debug/tracemalloc?stop=1.
+
+    If aggregator (an AggregateProcessor) is given, it receives the deltas
+    POSTed to /push.
+
+    If reload is given, it's called on POST /-/reload, and should raise
+    ValueError if the configuration can't be reloaded.
+    """
+
+    if exposition is None:
+        exposition = CachedExposition()
 
-    return RequestHandler
+    return type('RequestHandler', (RequestHandler,), {
+        'licence_location': licence_location,
+        'exposition': exposition,
+        'debug_threads': debug_threads,
+        'aggregator': aggregator,
+        'reload': staticmethod(reload) if reload is not None else None,
+    })
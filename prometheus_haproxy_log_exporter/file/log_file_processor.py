@@ -11,23 +11,212 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import tailhead
+import re
+import glob
 import time
+import logging
+import selectors
 
-from ..log_processing import AbstractLogProcessor
+from ..log_processing import AbstractLogProcessor, load_state, save_state
+from .tail import FileTail
+
+# The characters making a path a glob pattern
+GLOB_MAGIC_REGEX = re.compile(r'[*?[]')
+
+
+def load_positions(state_path):
+    """Return the positions saved to state_path by save_positions, by path"""
+
+    state = load_state(state_path)
+    if state is None:
+        return {}
+
+    if 'files' not in state:
+        # Saved when only one file could be followed
+        state = {'files': [state]}
+
+    return {
+        file_state['path']: (
+            file_state['device'],
+            file_state['inode'],
+            file_state['offset'],
+        )
+        for file_state in state['files']
+    }
+
+
+def save_positions(state_path, positions):
+    save_state(state_path, {
+        'files': [
+            {
+                'path': path,
+                'device': device,
+                'inode': inode,
+                'offset': offset,
+            }
+            for path, (device, inode, offset) in positions.items()
+        ],
+    })
+
+
+def expand_paths(patterns):
+    """Return the paths of the files matching each of patterns, or the
+    pattern itself if it isn't a glob pattern, to be followed even if it
+    doesn't exist yet.
+    """
+
+    paths = []
+
+    for pattern in patterns:
+        if GLOB_MAGIC_REGEX.search(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                logging.warning("No files match %s" % pattern)
+        else:
+            matches = [pattern]
+
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+def create_selector(tails):
+    """Return a selector of the inotify descriptors of tails, or None if some
+    of them can't be watched, and have to be polled.
+    """
+
+    if not tails or any(tail.fileno() is None for tail in tails):
+        return None
+
+    selector = selectors.DefaultSelector()
+    for tail in tails:
+        selector.register(tail.fileno(), selectors.EVENT_READ, tail)
+
+    return selector
 
 
 class LogFileProcessor(AbstractLogProcessor):
-    def __init__(self, metric_updaters, path, *args, **kwargs):
+    """Follows the log files at paths, which may be glob patterns, expanded
+    when starting. The source of each line is the path of its file.
+
+    The files are all read by one thread, which waits for any of them to
+    change with epoll on their inotify file descriptors, or polls them if
+    inotify isn't available.
+    """
+
+    binary = True
+    source = 'file'
+
+    def __init__(
+        self,
+        metric_updaters,
+        paths,
+        *args,
+        state_path=None,
+        checkpoint_interval=10,
+        **kwargs
+    ):
         super().__init__(metric_updaters, *args, **kwargs)
-        self.path = path
-        self.should_exit = False
+        self.paths = paths
+
+        # If state_path is set, the position in each file is saved there
+        # every checkpoint_interval seconds, and reading resumes from it on
+        # startup
+        self.state_path = state_path
+        self.checkpoint_interval = checkpoint_interval
 
     def run(self):
-        for line in tailhead.follow_path(self.path):
-            if line is None:
-                time.sleep(0.1)
-                if self.should_exit:
-                    return
+        positions = {}
+        if self.state_path is not None:
+            positions = load_positions(self.state_path)
+
+        tails = [
+            FileTail(path, position=positions.get(path))
+            for path in expand_paths(self.paths)
+        ]
+
+        selector = create_selector(tails)
+
+        last_checkpoint = time.monotonic()
+
+        try:
+            while not self.should_exit:
+                read_any = self.read_tails(tails)
+
+                last_checkpoint = self.checkpoint_if_due(tails, last_checkpoint)
+
+                if not read_any:
+                    self.wait(tails, selector, timeout=1)
+        finally:
+            if self.state_path is not None:
+                self.checkpoint(tails)
+
+            if selector is not None:
+                selector.close()
+
+            for tail in tails:
+                tail.close()
+
+    def read_tails(self, tails):
+        """Process the lines appended to each of tails, returning whether
+        any were read.
+        """
+
+        read_any = False
+
+        for tail in tails:
+            lines = tail.read_lines()
+            if not lines:
                 continue
-            self.update_metrics(line)
+
+            read_any = True
+            lines = [line for line in lines if line]
+            if lines:
+                self.update_metrics_batch(lines, tail.path)
+
+        return read_any
+
+    def checkpoint_if_due(self, tails, last_checkpoint):
+        """Checkpoint the positions of tails if checkpoint_interval has
+        passed since last_checkpoint, returning the time of the last one.
+        """
+
+        if (
+            self.state_path is None or
+            time.monotonic() - last_checkpoint < self.checkpoint_interval
+        ):
+            return last_checkpoint
+
+        self.checkpoint(tails)
+
+        return time.monotonic()
+
+    def wait(self, tails, selector, timeout):
+        if selector is None:
+            time.sleep(min([timeout] + [tail.poll_interval for tail in tails]))
+            return
+
+        for key, _ in selector.select(timeout):
+            key.data.inotify.clear()
+
+    def checkpoint(self, tails):
+        positions = {}
+        for tail in tails:
+            position = tail.get_position()
+            if position is not None:
+                positions[tail.path] = position
+
+        if not positions:
+            return
+
+        # Only save positions past lines which have been processed
+        if not self.wait_until_processed(timeout=self.checkpoint_interval):
+            logging.warning("Not saving the positions, as the lines read are still queued")
+            return
+
+        try:
+            save_positions(self.state_path, positions)
+        except OSError:
+            logging.exception("Failed to save the positions to %s" % self.state_path)
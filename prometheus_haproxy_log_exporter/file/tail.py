@@ -0,0 +1,289 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import ctypes
+import ctypes.util
+import logging
+import select
+import time
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+except (OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+
+class Inotify(object):
+    """Waits for changes to the files in a directory"""
+
+    def __init__(self, directory):
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd == -1:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        watch = _inotify_add_watch(
+            self.fd,
+            os.fsencode(directory),
+            IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE,
+        )
+        if watch == -1:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for %s" % directory)
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            self.clear()
+
+    def clear(self):
+        # Only the wakeup matters, not which events happened
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileTail(object):
+    """Follows the file at path, returning the complete lines written to it.
+
+    Data is read in chunks of chunk_size bytes in to one reusable buffer, and
+    split in to lines of bytes, without decoding. If the file is renamed and
+    a new one is created at path, the rest of the old file is read before
+    switching to the new one, and if the file is truncated (copytruncate)
+    it's read again from the start.
+
+    wait blocks until the directory of the file changes, using inotify if
+    it's available, and polling otherwise.
+
+    If position (as returned by get_position) is given, reading continues
+    from there, even if the file has been rotated since.
+    """
+
+    def __init__(self, path, chunk_size=1 << 16, poll_interval=0.1, position=None):
+        self.path = path
+        self.poll_interval = poll_interval
+
+        self.buffer = bytearray(chunk_size)
+        self.buffer_view = memoryview(self.buffer)
+        self.partial_line = bytearray()
+
+        self.fd = None
+        self.offset = 0
+
+        try:
+            if _inotify_init1 is None:
+                raise OSError("inotify is not available")
+            self.inotify = Inotify(os.path.dirname(os.path.abspath(path)))
+        except OSError as e:
+            logging.info("Polling %s for changes (%s)" % (path, e))
+            self.inotify = None
+
+        if position is None:
+            # Like tail -F, start at the end of an existing file, but read
+            # files created later from the start
+            self.open(from_end=True)
+        else:
+            self.resume(position)
+
+    def open(self, from_end=False):
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            return False
+
+        if self.fd is not None:
+            os.close(self.fd)
+
+        self.fd = fd
+        self.offset = os.lseek(fd, 0, os.SEEK_END) if from_end else 0
+        self.partial_line = bytearray()
+
+        return True
+
+    def get_position(self):
+        """Return the device, inode and offset of the start of the first line
+        which hasn't been returned, or None if no file is open.
+        """
+
+        if self.fd is None:
+            return None
+
+        stat = os.fstat(self.fd)
+
+        return (stat.st_dev, stat.st_ino, self.offset - len(self.partial_line))
+
+    def resume(self, position):
+        device, inode, offset = position
+
+        path = self.find_file(device, inode)
+
+        if path is None:
+            # The file has been rotated away, so everything in the current
+            # file is new
+            logging.info("%s has been rotated away, reading %s from the start" % (
+                inode,
+                self.path,
+            ))
+            self.open()
+            return
+
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+        if offset > os.fstat(fd).st_size:
+            # Truncated
+            offset = 0
+
+        self.fd = fd
+        self.offset = os.lseek(fd, offset, os.SEEK_SET)
+        self.partial_line = bytearray()
+
+        if path != self.path:
+            # Once this file is read, check_rotation will switch to the
+            # current file
+            logging.info("Reading the rest of %s, rotated from %s" % (
+                path,
+                self.path,
+            ))
+
+    def find_file(self, device, inode):
+        """Find the file with the given device and inode, either at path, or
+        rotated to another name starting with path in the same directory.
+        """
+
+        directory, name = os.path.split(os.path.abspath(self.path))
+
+        candidates = [self.path] + sorted(
+            os.path.join(directory, other_name)
+            for other_name in os.listdir(directory)
+            if other_name.startswith(name) and other_name != name
+        )
+
+        for candidate in candidates:
+            try:
+                stat = os.stat(candidate)
+            except FileNotFoundError:
+                continue
+
+            if (stat.st_dev, stat.st_ino) == (device, inode):
+                return candidate
+
+        return None
+
+    def fileno(self):
+        return None if self.inotify is None else self.inotify.fileno()
+
+    def wait(self, timeout):
+        if self.inotify is None:
+            time.sleep(min(timeout, self.poll_interval))
+        else:
+            self.inotify.wait(timeout)
+
+    def read_lines(self):
+        """Return the complete lines read from the next chunk of the file, an
+        empty list when there is nothing more to read.
+        """
+
+        if self.fd is None:
+            if not self.open():
+                return []
+
+        while True:
+            read = os.readv(self.fd, [self.buffer_view])
+            if read == 0:
+                lines = self.check_rotation()
+                if lines is None:
+                    return []
+                return lines
+
+            self.offset += read
+
+            last_newline = self.buffer.rfind(b'\n', 0, read)
+            if last_newline != -1:
+                break
+
+            self.partial_line += self.buffer_view[:read]
+
+        data = self.buffer_view[:last_newline].tobytes()
+        if self.partial_line:
+            data = bytes(self.partial_line) + data
+            self.partial_line = bytearray()
+
+        self.partial_line += self.buffer_view[last_newline + 1:read]
+
+        return data.split(b'\n')
+
+    def check_rotation(self):
+        """At the end of the file, check if it has been rotated, and if so
+        continue reading from the new file, also returning the incomplete last
+        line of the old file. Returns None if the file hasn't been rotated.
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Wait for the new file to be created
+            return None
+
+        current_stat = os.fstat(self.fd)
+
+        if (stat.st_dev, stat.st_ino) != (current_stat.st_dev, current_stat.st_ino):
+            logging.info("%s was rotated, opening the new file" % self.path)
+
+            last_line = bytes(self.partial_line)
+            self.open()
+
+            lines = self.read_lines()
+            if last_line:
+                lines.insert(0, last_line)
+            return lines
+
+        if current_stat.st_size < self.offset:
+            logging.info("%s was truncated, reading from the start" % self.path)
+
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            self.offset = 0
+            self.partial_line = bytearray()
+
+            return self.read_lines()
+
+        return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        if self.inotify is not None:
+            self.inotify.close()
@@ -0,0 +1,175 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from collections import deque
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'sample')
+
+
+class IngestQueue(object):
+    """A bounded queue of raw lines, between the source of the lines and
+    parsing them, holding up to max_lines.
+
+    When it's full, with the block policy, put waits for there to be space.
+    With drop-oldest, the oldest line in the queue is dropped to make space.
+    With sample, only 1 in every sample_every lines is queued from then on,
+    with a weight of sample_every, until the queue is down to half full. If
+    it's still full, put waits as with block.
+
+    Lines are queued with their weight and source, as (raw_line, weight,
+    source) tuples. Once processed, the lines taken by get_many are marked as
+    done by task_done, so that join can wait for all the lines queued to be
+    processed.
+    """
+
+    def __init__(self, max_lines, policy='block', sample_every=10):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %s" % policy)
+
+        self.max_lines = max_lines
+        self.policy = policy
+        self.sample_every = sample_every
+
+        self.lines = deque()
+        self.not_empty = threading.Condition()
+        self.not_full = threading.Condition(self.not_empty)
+        self.all_done = threading.Condition(self.not_empty)
+
+        # Lines queued, and not yet marked as done
+        self.unfinished = 0
+
+        self.dropped = 0
+        # Lines skipped while sampling, counted through the weight of the
+        # lines sampled instead
+        self.sampled_out = 0
+        self.sampling = False
+        self.lines_until_sample = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def put(self, raw_line, source=None):
+        self.put_many((raw_line,), source)
+
+    def put_many(self, raw_lines, source=None):
+        with self.not_empty:
+            for raw_line in raw_lines:
+                weight = 1
+
+                if self.sampling:
+                    if self.lines_until_sample:
+                        self.lines_until_sample -= 1
+                        self.sampled_out += 1
+                        continue
+
+                    self.lines_until_sample = self.sample_every - 1
+                    weight = self.sample_every
+
+                if len(self.lines) >= self.max_lines:
+                    if self.policy == 'drop-oldest':
+                        self.lines.popleft()
+                        self.dropped += 1
+                        self.unfinished -= 1
+                    elif self.policy == 'sample' and not self.sampling:
+                        self.sampling = True
+                        self.lines_until_sample = self.sample_every - 1
+                        weight = self.sample_every
+
+                    self.not_empty.notify()
+                    while len(self.lines) >= self.max_lines:
+                        self.not_full.wait()
+
+                self.lines.append((raw_line, weight, source))
+                self.unfinished += 1
+
+            self.not_empty.notify()
+
+    def get_many(self, max_lines, timeout=None):
+        """Remove and return up to max_lines lines, waiting up to timeout
+        seconds for there to be any. Returns an empty list on timeout.
+        """
+
+        with self.not_empty:
+            if not self.lines:
+                self.not_empty.wait(timeout)
+
+            lines = []
+            while self.lines and len(lines) < max_lines:
+                lines.append(self.lines.popleft())
+
+            if self.sampling and len(self.lines) <= self.max_lines // 2:
+                self.sampling = False
+
+            self.not_full.notify_all()
+
+            return lines
+
+    def task_done(self, count):
+        with self.not_empty:
+            self.unfinished -= count
+
+            if not self.unfinished:
+                self.all_done.notify_all()
+
+    def join(self, timeout=None):
+        """Wait up to timeout seconds for all the lines queued to be
+        processed, returning whether they have been.
+        """
+
+        with self.not_empty:
+            return self.all_done.wait_for(lambda: not self.unfinished, timeout)
+
+
+class IngestQueueCollector(object):
+    """Exports the state of an IngestQueue"""
+
+    def __init__(self, ingest_queue, namespace, registry=REGISTRY):
+        self.ingest_queue = ingest_queue
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            '%s_ingest_queue_lines' % self.namespace,
+            "Lines waiting to be processed",
+            value=len(self.ingest_queue),
+        )
+        yield GaugeMetricFamily(
+            '%s_ingest_queue_capacity_lines' % self.namespace,
+            "Maximum number of lines waiting to be processed",
+            value=self.ingest_queue.max_lines,
+        )
+        yield GaugeMetricFamily(
+            '%s_ingest_sampling' % self.namespace,
+            "1 if only some lines are being processed, as the queue of lines "
+            "is full",
+            value=1 if self.ingest_queue.sampling else 0,
+        )
+        yield CounterMetricFamily(
+            '%s_ingest_dropped_lines_total' % self.namespace,
+            "Lines dropped as the queue of lines was full",
+            value=self.ingest_queue.dropped,
+        )
+        yield CounterMetricFamily(
+            '%s_ingest_sampled_out_lines_total' % self.namespace,
+            "Lines skipped while sampling, as the queue of lines was full, "
+            "which are only counted through the weight of the lines sampled",
+            value=self.ingest_queue.sampled_out,
+        )
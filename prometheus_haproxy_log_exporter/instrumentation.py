@@ -0,0 +1,98 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .series import SeriesCache
+
+# Only 1 in this many lines is timed, and has its lag measured
+TIMED_LINE_INTERVAL = 100
+
+STAGE_DURATION_BUCKETS = (
+    0.000001, 0.0000025, 0.000005,
+    0.00001, 0.000025, 0.00005,
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.01, float('inf'),
+)
+
+
+def stage_durations(namespace, registry=REGISTRY):
+    """Create the SeriesCache of the stage duration histogram, so that, like
+    the other metrics, it's batched, and updated from the workers.
+    """
+
+    return SeriesCache(
+        '%s_stage_duration_seconds' % namespace,
+        Histogram(
+            'stage_duration_seconds',
+            "Time spent on each stage of processing a line, for 1 in %d lines" % (
+                TIMED_LINE_INTERVAL,
+            ),
+            labelnames=['stage'],
+            namespace=namespace,
+            buckets=STAGE_DURATION_BUCKETS,
+            registry=registry,
+        ),
+        buckets=STAGE_DURATION_BUCKETS,
+    )
+
+
+class LogProcessorCollector(object):
+    """Exports the lines and bytes read by a log processor, and the lag, of
+    each source
+    """
+
+    def __init__(self, log_processor, namespace, registry=REGISTRY):
+        self.log_processor = log_processor
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        with self.log_processor.stats_lock:
+            lines_read = dict(self.log_processor.lines_read)
+            bytes_read = dict(self.log_processor.bytes_read)
+            lag = dict(self.log_processor.lag)
+
+        for family_class, name, documentation, values in (
+            (
+                CounterMetricFamily,
+                'source_lines_total',
+                "Lines read from each source of the logs",
+                lines_read,
+            ),
+            (
+                CounterMetricFamily,
+                'source_bytes_total',
+                "Bytes of lines read from each source of the logs",
+                bytes_read,
+            ),
+            (
+                GaugeMetricFamily,
+                'lag_seconds',
+                "Time between HAProxy accepting the connection of a recent "
+                "line from each source, and the line being processed",
+                lag,
+            ),
+        ):
+            family = family_class(
+                '%s_%s' % (self.namespace, name),
+                documentation,
+                labels=['source'],
+            )
+            for source, value in values.items():
+                family.add_metric([source], value)
+
+            yield family
@@ -11,25 +11,167 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import logging
+import operator
+import itertools
+
 from systemd import journal
 
-from ..log_processing import AbstractLogProcessor
+from ..log_processing import AbstractLogProcessor, load_state, save_state
+
+
+def load_cursor(state_path, units):
+    state = load_state(state_path)
+    if state is None:
+        return None
+
+    # Saved when only one unit could be followed
+    saved_units = state.get('units', [state.get('unit')])
+
+    if sorted(saved_units) != sorted(units):
+        logging.info("Ignoring state file %s, as it's for %s" % (
+            state_path,
+            ', '.join(map(str, saved_units)),
+        ))
+        return None
+
+    return state['cursor']
+
+
+def save_cursor(state_path, units, cursor):
+    save_state(state_path, {
+        'units': sorted(units),
+        'cursor': cursor,
+    })
 
 
 class JournalProcessor(AbstractLogProcessor):
-    def __init__(self, unit, *args, **kwargs):
+    """Follows the entries of the given systemd units in the journal. The
+    source of each line is its unit.
+    """
+
+    # Only the MESSAGE field is read from each entry, and not decoded
+    binary = True
+    source = 'journal'
+
+    def __init__(
+        self,
+        units,
+        *args,
+        state_path=None,
+        checkpoint_interval=10,
+        files=None,
+        entries_per_batch=1000,
+        **kwargs
+    ):
         super(JournalProcessor, self).__init__(*args, **kwargs)
 
-        self.unit = unit
+        self.units = units
+
+        # If state_path is set, the cursor of the last entry processed is
+        # saved there every checkpoint_interval seconds, and reading resumes
+        # after it on startup
+        self.state_path = state_path
+        self.checkpoint_interval = checkpoint_interval
+
+        # Read these journal files, rather than the system journal
+        self.files = files
+
+        self.entries_per_batch = entries_per_batch
+
+    def open_reader(self):
+        if self.files is None:
+            return journal.Reader()
+        else:
+            return journal.Reader(files=self.files)
 
     def run(self):
-        with journal.Reader() as j:
-            j.add_match(_SYSTEMD_UNIT=self.unit)
+        with self.open_reader() as j:
+            # Matches of the same field are alternatives
+            for unit in self.units:
+                j.add_match(_SYSTEMD_UNIT=unit)
 
+            self.seek(j)
+
+            cursor = None
+            last_checkpoint = time.monotonic()
+
+            try:
+                while not self.should_exit:
+                    entries = self.read_entries(j)
+
+                    if entries:
+                        for unit, unit_entries in itertools.groupby(
+                            entries,
+                            key=operator.itemgetter(0),
+                        ):
+                            self.update_metrics_batch(
+                                [message for _, message in unit_entries],
+                                unit,
+                            )
+                        cursor = j._get_cursor()
+
+                    if (
+                        self.state_path is not None and
+                        cursor is not None and
+                        time.monotonic() - last_checkpoint >= self.checkpoint_interval
+                    ):
+                        self.checkpoint(cursor)
+                        last_checkpoint = time.monotonic()
+
+                    if len(entries) < self.entries_per_batch:
+                        j.wait(1)
+            finally:
+                if self.state_path is not None and cursor is not None:
+                    self.checkpoint(cursor)
+
+    def seek(self, j):
+        cursor = None
+        if self.state_path is not None:
+            cursor = load_cursor(self.state_path, self.units)
+
+        if cursor is not None:
+            j.seek_cursor(cursor)
+
+            # Move on to the entry with the cursor, which has already been
+            # processed, unless it no longer exists, in which case this moves
+            # on to the next entry, so move back again
+            if j._next() and not j.test_cursor(cursor):
+                logging.info("Entry %s no longer exists, resuming after it" % cursor)
+                j._previous()
+        else:
             j.seek_tail()
-            j.get_previous()
+            j._previous()
+
+    def read_entries(self, j):
+        """Return the unit and MESSAGE of up to entries_per_batch entries,
+        without reading and decoding the other fields of the entries. The
+        unit is only read if following more than one.
+        """
+
+        entries = []
+        unit = self.units[0]
+
+        while len(entries) < self.entries_per_batch and j._next():
+            try:
+                message = j._get('MESSAGE')
+                if len(self.units) > 1:
+                    unit = j._get('_SYSTEMD_UNIT').decode('utf-8', 'replace')
+            except KeyError:
+                continue
+
+            entries.append((unit, message))
+
+        return entries
+
+    def checkpoint(self, cursor):
+        # Only save the cursor of an entry which has been processed
+        if not self.wait_until_processed(timeout=self.checkpoint_interval):
+            logging.warning("Not saving the cursor, as the entries read are still queued")
+            return
 
-            while True:
-                for entry in j:
-                    self.update_metrics(entry['MESSAGE'])
-                j.wait()
+        try:
+            save_cursor(self.state_path, self.units, cursor)
+        except OSError:
+            logging.exception("Failed to save the cursor to %s" % self.state_path)
@@ -0,0 +1,167 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+FILTER_FIELDS = ('frontend', 'backend', 'server', 'status')
+
+# Finds the fields which can be filtered on, without parsing the rest of the
+# line. The status is only present for HTTP lines, and the ~ marking SSL
+# frontends isn't included in the frontend.
+HEADER_REGEX = re.compile(
+    # [09/Dec/2013:12:59:46.633] loadbalancer~ default/instance8
+    r' \[[^\]]*\] (?P<frontend>[^\s~]+)~? (?P<backend>[^\s/]+)/(?P<server>\S+) '
+    # 0/51536/1/48082/99627 200
+    r'(?:-?\d+/-?\d+/-?\d+/-?\d+/\+?-?\d+ (?P<status>-?\d+) )?'
+)
+
+HEADER_REGEX_BYTES = re.compile(HEADER_REGEX.pattern.encode('ascii'))
+
+
+def filter_rule(value):
+    """Parse FIELD=PATTERN, e.g. backend=statistics or status=5xx"""
+
+    field, separator, pattern = value.partition('=')
+    if not separator or field not in FILTER_FIELDS or not pattern:
+        raise ValueError(
+            "Invalid filter rule %s, expected FIELD=PATTERN, with FIELD one "
+            "of %s" % (value, ', '.join(FILTER_FIELDS)),
+        )
+
+    return field, pattern
+
+
+def pattern_regex(field, pattern):
+    """Translate a pattern, where * matches anything, and for the status, x
+    matches any digit, in to a regular expression.
+    """
+
+    wildcards = {'*': '.*'}
+    if field == 'status':
+        wildcards['x'] = r'\d'
+
+    return ''.join(
+        wildcards.get(character, re.escape(character))
+        for character in pattern
+    )
+
+
+class LineFilter(object):
+    """Decides whether to process a raw line, from rules matching its
+    frontend, backend, server and status.
+
+    A line is skipped if it matches any of the exclude_rules, or if there are
+    include_rules, and it matches none of them. Each rule is a (field,
+    pattern) tuple. Lines which don't look like log lines aren't skipped.
+
+    For each field, the patterns of all the rules are combined in to one
+    regular expression, with a group for each rule, so that each field is
+    only matched once.
+    """
+
+    def __init__(self, include_rules=(), exclude_rules=(), binary=False):
+        # The exclude rules come first, so that they win if both match
+        self.rules = (
+            [('exclude', field, pattern) for field, pattern in exclude_rules] +
+            [('include', field, pattern) for field, pattern in include_rules]
+        )
+        self.has_include_rules = bool(include_rules)
+
+        self.skipped = [0] * len(self.rules)
+        self.not_included = 0
+
+        self.header_regex = HEADER_REGEX_BYTES if binary else HEADER_REGEX
+
+        self.matchers = []
+        for field in FILTER_FIELDS:
+            alternatives = [
+                '(?P<rule%d>%s)' % (i, pattern_regex(field, pattern))
+                for i, (_, rule_field, pattern) in enumerate(self.rules)
+                if rule_field == field
+            ]
+            if not alternatives:
+                continue
+
+            regex = '|'.join(alternatives)
+            if binary:
+                regex = regex.encode('utf-8')
+
+            self.matchers.append((field, re.compile(regex).fullmatch))
+
+        # For the group of each rule, its index, and whether it excludes
+        self.groups = {
+            'rule%d' % i: (i, action == 'exclude')
+            for i, (action, _, _) in enumerate(self.rules)
+        }
+
+    def __call__(self, raw_line):
+        match = self.header_regex.search(raw_line)
+        if match is None:
+            return True
+
+        included = not self.has_include_rules
+
+        for field, matcher in self.matchers:
+            value = match.group(field)
+            if value is None:
+                continue
+
+            rule_match = matcher(value)
+            if rule_match is None:
+                continue
+
+            index, excludes = self.groups[rule_match.lastgroup]
+            if excludes:
+                self.skipped[index] += 1
+                return False
+
+            included = True
+
+        if not included:
+            self.not_included += 1
+            return False
+
+        return True
+
+
+class LineFilterCollector(object):
+    """Exports the lines skipped by each rule of a LineFilter"""
+
+    def __init__(self, line_filter, namespace, registry=REGISTRY):
+        self.line_filter = line_filter
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        family = CounterMetricFamily(
+            '%s_filtered_lines_total' % self.namespace,
+            "Lines which were not processed, due to the filter rules",
+            labels=['rule'],
+        )
+
+        for (action, field, pattern), skipped in zip(
+            self.line_filter.rules,
+            self.line_filter.skipped,
+        ):
+            if action == 'exclude':
+                family.add_metric(['exclude %s=%s' % (field, pattern)], skipped)
+
+        if self.line_filter.has_include_rules:
+            family.add_metric(['not included'], self.line_filter.not_included)
+
+        yield family
@@ -0,0 +1,236 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import calendar
+import functools
+
+# A single regular expression covering the optional syslog prefix, and both
+# the HTTP and the TCP log formats, e.g.
+#
+# Jun  9 12:31:39 lb1 haproxy[11058]: 127.0.0.1:42563
+# [09/Jun/2016:12:31:39.908] fe be/srv 0/0/1/1/2 200 1771 - - ---- 1/1/0/0/0
+# 0/0 "GET / HTTP/1.1"
+#
+# Jun  9 12:31:39 lb1 haproxy[11066]: 127.0.0.1:42563
+# [09/Jun/2016:12:31:39.900] fe~ be/srv 8/1/11 1752 -- 0/0/0/0/0 0/0
+#
+# Only character classes which can't backtrack across fields are used, so the
+# line is matched in one pass.
+LINE_REGEX = re.compile(
+    # Jun  9 12:31:39 localhost.localdomain haproxy[28029]:
+    r'(?:\w+\s+\d+\s+\d+:\d+:\d+\s+[\.a-zA-Z0-9_-]+\s+\w+\[\d+\]:\s+)?'
+    # 127.0.0.1:39759
+    r'(?P<client_ip>[^\s:]+):(?P<client_port>\d+)\s+'
+    # [09/Dec/2013:12:59:46.633]
+    r'\[(?P<accept_date>[^\]\.]+)[^\]]*\]\s+'
+    # loadbalancer default/instance8
+    r'(?P<frontend_name>\S+)\s+(?P<backend_name>[^\s/]+)/(?P<server_name>\S+)\s+'
+    r'(?:'
+    # HTTP: 0/51536/1/48082/99627 200 83285 - - ---- 87/87/87/1/0 0/67
+    r'(?P<http_tq>-?\d+)/(?P<http_tw>-?\d+)/(?P<http_tc>-?\d+)/'
+    r'(?P<http_tr>-?\d+)/(?P<http_tt>\+?-?\d+)\s+'
+    r'(?P<status_code>-?\d+)\s+(?P<http_bytes_read>\+?\d+)\s+'
+    r'\S+\s+\S+\s+(?P<http_termination_state>\S+)\s+'
+    r'\d+/\d+/\d+/\d+/\+?\d+\s+'
+    r'(?P<http_queue_server>\d+)/(?P<http_queue_backend>\d+)\s+'
+    # {77.24.148.74}
+    r'(?:\{[^}]*\}\s+)*'
+    # "GET /path/to/image HTTP/1.1"
+    r'"(?:(?P<http_request_method>\w+)\s+(?P<http_request_path>\S+)[^"]*|[^"]*)"'
+    r'|'
+    # TCP: 8/1/11 1752 -- 0/0/0/0/0 0/0
+    r'(?P<tcp_tw>-?\d+)/(?P<tcp_tc>-?\d+)/(?P<tcp_tt>\+?-?\d+)\s+'
+    r'(?P<tcp_bytes_read>\+?\d+)\s+(?P<tcp_termination_state>\S+)\s+'
+    r'\d+/\d+/\d+/\d+/\+?\d+\s+'
+    r'(?P<tcp_queue_server>\d+)/(?P<tcp_queue_backend>\d+)'
+    r')\s*\Z'
+)
+
+LINE_REGEX_BYTES = re.compile(LINE_REGEX.pattern.encode('ascii'))
+
+# The attributes a parsed line can have, mapped to the group holding them in
+# the HTTP and TCP variants of LINE_REGEX (None when the format lacks the
+# field), and the conversion applied to the matched text. The names and types
+# are the ones used by haproxy.haproxy_logline.HaproxyLogLine. The source of
+# the line isn't in it, but set by the log processor after parsing.
+FIELD_GROUPS = {
+    'client_ip': ('client_ip', 'client_ip', None),
+    'client_port': ('client_port', 'client_port', int),
+    'accept_date': ('accept_date', 'accept_date', None),
+    'frontend_name': ('frontend_name', 'frontend_name', None),
+    'backend_name': ('backend_name', 'backend_name', None),
+    'server_name': ('server_name', 'server_name', None),
+    'time_wait_request': ('http_tq', None, int),
+    'time_wait_queues': ('http_tw', 'tcp_tw', int),
+    'time_connect_server': ('http_tc', 'tcp_tc', int),
+    'time_wait_response': ('http_tr', None, int),
+    'total_time': ('http_tt', 'tcp_tt', None),
+    'status_code': ('status_code', None, None),
+    'bytes_read': ('http_bytes_read', 'tcp_bytes_read', None),
+    'termination_state': ('http_termination_state', 'tcp_termination_state', None),
+    'queue_server': ('http_queue_server', 'tcp_queue_server', int),
+    'queue_backend': ('http_queue_backend', 'tcp_queue_backend', int),
+    'http_request_method': ('http_request_method', None, None),
+    'http_request_path': ('http_request_path', None, None),
+    'source': (None, None, None),
+}
+
+FIELDS = tuple(FIELD_GROUPS.keys())
+
+# The values of the text fields which TCP lines lack, so that they have a
+# deliberate value when used as labels, rather than "None". In Prometheus, an
+# empty label value is the same as not having the label.
+TCP_VALUES = {
+    'status_code': '',
+    'http_request_method': '',
+    'http_request_path': '',
+}
+
+
+# Not calendar.month_abbr, as that depends on the locale
+MONTHS = {
+    month: i + 1
+    for i, month in enumerate((
+        'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+        'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+    ))
+}
+
+
+@functools.lru_cache(maxsize=16)
+def _day_timestamp(day):
+    # 09/Jun/2016
+    day_of_month, month, year = day.split('/')
+
+    return calendar.timegm((int(year), MONTHS[month], int(day_of_month), 0, 0, 0))
+
+
+def accept_timestamp(accept_date, utc_offset=0):
+    """Return the UNIX timestamp of the accept_date of a line, e.g.
+    09/Jun/2016:12:31:39. HAProxy logs in local time, so utc_offset is the
+    offset of that from UTC in seconds.
+    """
+
+    hour, minute, second = accept_date[12:].split(':')
+
+    return (
+        _day_timestamp(accept_date[:11]) +
+        int(hour) * 3600 + int(minute) * 60 + int(second) -
+        utc_offset
+    )
+
+
+class LogLine(object):
+    __slots__ = FIELDS + ('is_http',)
+
+    def __init__(self, is_http):
+        self.is_http = is_http
+
+    def __getattr__(self, name):
+        # Fields which were not extracted, or which don't exist in this log
+        # format
+        if name in FIELD_GROUPS:
+            return None
+        raise AttributeError(name)
+
+
+def decode(value):
+    return value.decode('utf-8', 'replace')
+
+
+def field_converter(field, binary=False, path_normalizer=None):
+    """Return the function converting the matched text of field, or None"""
+
+    convert = FIELD_GROUPS[field][2]
+
+    if field == 'http_request_path' and path_normalizer is not None:
+        return path_normalizer
+    elif binary and convert is None:
+        return decode
+
+    return convert
+
+
+def select_fields(fields, binary=False, path_normalizer=None):
+    """Return the fields of HTTP lines, and of TCP lines, to be extracted, as
+    tuples of the field, the group holding it and its converter, and the
+    fields which TCP lines lack, with the value they're given.
+    """
+
+    http_fields = []
+    tcp_fields = []
+    tcp_values = []
+
+    for field in fields:
+        if field not in FIELD_GROUPS:
+            raise ValueError('Unknown field: %s' % field)
+
+        http_group, tcp_group, _ = FIELD_GROUPS[field]
+        convert = field_converter(field, binary, path_normalizer)
+
+        if http_group is not None:
+            http_fields.append((field, http_group, convert))
+        if tcp_group is not None:
+            tcp_fields.append((field, tcp_group, convert))
+        elif field in TCP_VALUES:
+            tcp_values.append((field, TCP_VALUES[field]))
+
+    return http_fields, tcp_fields, tcp_values
+
+
+def create_parser(fields=FIELDS, binary=False, path_normalizer=None):
+    """Create a function parsing a raw line in to a LogLine, or returning None
+    if the line is not a HAProxy log line. Only the given fields are set on
+    the returned LogLine.
+
+    If binary is set, the raw lines are bytes, and only the text of the
+    extracted fields is decoded.
+
+    If path_normalizer is given, it's called with the raw
+    http_request_path, and its result used instead.
+    """
+
+    http_fields, tcp_fields, tcp_values = select_fields(
+        fields,
+        binary,
+        path_normalizer,
+    )
+
+    match_line = (LINE_REGEX_BYTES if binary else LINE_REGEX).match
+
+    def parse(raw_line):
+        match = match_line(raw_line)
+        if match is None:
+            return None
+
+        if match.start('status_code') == -1:
+            line = LogLine(False)
+            line_fields = tcp_fields
+
+            for field, value in tcp_values:
+                setattr(line, field, value)
+        else:
+            line = LogLine(True)
+            line_fields = http_fields
+
+        group = match.group
+        for field, group_name, convert in line_fields:
+            value = group(group_name)
+            if value is not None and convert is not None:
+                value = convert(value)
+            setattr(line, field, value)
+
+        return line
+
+    return parse
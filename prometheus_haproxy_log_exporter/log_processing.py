@@ -11,14 +11,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
+import json
+import time
 import logging
 import threading
 
-from haproxy.haproxy_logline import HaproxyLogLine
 from prometheus_client import Counter
 
 from .metrics import NAMESPACE
+from .ingest import IngestQueue, IngestQueueCollector
+from .instrumentation import (
+    TIMED_LINE_INTERVAL, LogProcessorCollector, stage_durations,
+)
+from .line_filter import LineFilter, LineFilterCollector
+from .log_parser import FIELDS, accept_timestamp, create_parser
+from .sampling import Sampler, SamplerCollector
+from .series import SeriesCache
+from .workers import WorkerPool
 
 JOURNAL_REGEX = re.compile(
     # Dec  9
@@ -29,36 +40,518 @@ JOURNAL_REGEX = re.compile(
     r'([\.a-zA-Z0-9_-]+)\s+\w+\[\d+\]:\s+',
 )
 
+# Lines sent to a worker at a time, if --batch-lines isn't given
+DEFAULT_WORKER_BATCH_LINES = 1000
+
+# Lines taken from the ingest queue at a time
+INGEST_BATCH_LINES = 1000
+
+# The series unused for longer than the TTL of the series are looked for this
+# many times per TTL, so they're removed within 1.1 TTLs
+SERIES_TTL_SWEEPS = 10
+
+
+def load_state(state_path):
+    """Return the state saved to state_path by save_state, or None if there
+    isn't any.
+    """
+
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.exception("Ignoring invalid state file %s" % state_path)
+        return None
+
+
+def save_state(state_path, state):
+    tmp_state_path = '%s.tmp' % state_path
+    with open(tmp_state_path, 'w') as f:
+        json.dump(state, f)
+
+    # rename(2) is atomic
+    os.rename(tmp_state_path, state_path)
+
 
 class AbstractLogProcessor(threading.Thread):
-    def __init__(self, metric_updaters, *args, **kwargs):
+    # Whether the raw lines passed to update_metrics are bytes, rather than
+    # str
+    binary = False
+
+    # The value of the source label of the lines read, and of the metrics
+    # about them, unless the source of each line is given
+    source = 'unknown'
+
+    def __init__(
+        self,
+        metric_updaters,
+        *args,
+        fields=FIELDS,
+        caches=(),
+        batch_lines=0,
+        batch_max_delay=1.0,
+        workers=0,
+        queue_lines=0,
+        overflow_policy='block',
+        sample_every=10,
+        frontend_sampling_rates=(),
+        backend_sampling_rates=(),
+        include_rules=(),
+        exclude_rules=(),
+        path_normalizer=None,
+        series_ttl=0,
+        source=None,
+        sink=None,
+        **kwargs
+    ):
         super(AbstractLogProcessor, self).__init__(*args, **kwargs)
 
+        if source is not None:
+            self.source = source
+
+        # Set by stop, for run to return once it has saved its position
+        self.should_exit = False
+
+        # If sink, another log processor, is given, the lines read are
+        # processed by it, with its metrics, rather than by this one
+        self.sink = sink
+        if sink is not None:
+            if sink.binary != self.binary:
+                raise ValueError("the lines of %s can't be processed by %s" % (
+                    self.source,
+                    sink.source,
+                ))
+            return
+
         self.metric_updaters = metric_updaters
+        self.parse_line = create_parser(
+            fields,
+            binary=self.binary,
+            path_normalizer=path_normalizer,
+        )
+
+        # Held while processing each line, and while doing anything else with
+        # the metrics which must not happen at the same time
+        self.lock = threading.Lock()
 
-        self.processing_errors = Counter(
-            'processing_errors_total',
-            "Total log lines which could not be processed",
-            namespace=NAMESPACE,
+        self.processing_errors = SeriesCache(
+            '%s_processing_errors_total' % NAMESPACE,
+            Counter(
+                'processing_errors_total',
+                "Total log lines which could not be processed",
+                namespace=NAMESPACE,
+            ),
         )
 
-    def update_metrics(self, raw_line):
+        # The time taken by each stage is measured for the first line, and
+        # then 1 in TIMED_LINE_INTERVAL lines, as is the lag
+        self.stage_durations = stage_durations(NAMESPACE)
+        self.lines_until_timed = 1
+        self.lines_until_lag = 1
+        self.parse_accept_date = create_parser(('accept_date',), binary=self.binary)
+
+        # The threads processing lines, for profiling
+        self.threads = [self]
+
+        # By source. Changed while holding stats_lock, rather than lock, as
+        # the lines read are counted before they're queued.
+        self.stats_lock = threading.Lock()
+        self.lines_read = {}
+        self.bytes_read = {}
+        self.lag = {}
+        LogProcessorCollector(self, NAMESPACE)
+
+        # When batching, updates are collected in the caches, and applied to
+        # the metrics every batch_lines lines, or batch_max_delay seconds
+        self.metric_caches = tuple(caches)
+        self.caches = self.metric_caches + (self.processing_errors, self.stage_durations)
+        self.batch_lines = batch_lines
+        self.batch_max_delay = batch_max_delay
+        self.lines_in_batch = 0
+
+        # If series_ttl is set, the series of the metrics which haven't been
+        # updated for series_ttl seconds are removed
+        self.series_ttl = series_ttl
+
+        # When using workers, batches of lines are parsed in worker processes
+        # instead
+        self.worker_pool = None
+        if workers:
+            self.batch_lines = self.batch_lines or DEFAULT_WORKER_BATCH_LINES
+            self.worker_pool = WorkerPool(self, workers, self.batch_lines)
+        elif self.batch_lines:
+            for cache in self.caches:
+                cache.start_batching()
+
+        # Lines matching the exclude rules, or not matching the include rules,
+        # are skipped
+        self.line_filter = None
+        if include_rules or exclude_rules:
+            self.line_filter = LineFilter(
+                include_rules,
+                exclude_rules,
+                binary=self.binary,
+            )
+            LineFilterCollector(self.line_filter, NAMESPACE)
+
+        # Only some of the lines of the frontends and backends with a sampling
+        # rate are processed
+        self.sampler = None
+        if frontend_sampling_rates or backend_sampling_rates:
+            self.sampler = Sampler(
+                frontend_sampling_rates,
+                backend_sampling_rates,
+                binary=self.binary,
+            )
+            SamplerCollector(self.sampler, NAMESPACE)
+
+        # If queue_lines is set, lines are put in a queue by the source, and
+        # taken from it to be processed in a separate thread
+        self.ingest_queue = None
+        if queue_lines:
+            self.ingest_queue = IngestQueue(queue_lines, overflow_policy, sample_every)
+            IngestQueueCollector(self.ingest_queue, NAMESPACE)
+
+    def start(self):
+        # Fork the workers before starting any threads
+        if self.worker_pool is not None:
+            self.worker_pool.start()
+
+        super(AbstractLogProcessor, self).start()
+
+        if self.ingest_queue is not None:
+            consumer = threading.Thread(
+                target=self.process_queued_lines,
+                name='%s-consumer' % self.name,
+            )
+            consumer.daemon = True
+            consumer.start()
+            self.threads.append(consumer)
+
+        if self.batch_lines:
+            flusher = threading.Thread(
+                target=self.flush_periodically,
+                name='%s-flusher' % self.name,
+            )
+            flusher.daemon = True
+            flusher.start()
+            self.threads.append(flusher)
+
+        if self.series_ttl:
+            sweeper = threading.Thread(
+                target=self.expire_periodically,
+                name='%s-sweeper' % self.name,
+            )
+            sweeper.daemon = True
+            sweeper.start()
+            self.threads.append(sweeper)
+
+    def expire_periodically(self):
+        while True:
+            time.sleep(self.series_ttl / SERIES_TTL_SWEEPS)
+
+            self.expire_series()
+
+    def expire_series(self):
+        """Remove the series of the metrics which haven't been updated for
+        series_ttl seconds.
+
+        The time is only read here, and given to the caches as their tick, so
+        updating a series only records the tick of the last sweep. The series
+        are removed with the lock held, as for any update, so a scrape sees
+        them removed, and marked as changed, all at once.
+        """
+
+        tick = time.monotonic()
+
+        with self.lock:
+            for cache in self.metric_caches:
+                if cache.expiring:
+                    cache.tick = tick
+                    cache.expire(tick - self.series_ttl)
+                else:
+                    # Including the caches added by a reload
+                    cache.start_expiry(tick)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.batch_max_delay)
+
+            with self.lock:
+                self.flush()
+
+    def flush(self):
+        if self.worker_pool is not None:
+            self.worker_pool.flush()
+        else:
+            for cache in self.caches:
+                cache.flush()
+
+        self.lines_in_batch = 0
+
+    def set_metric_updaters(self, metric_updaters, fields, caches, path_normalizer=None):
+        """Replace the metric updaters, and the caches of their metrics, e.g.
+        when reloading the configuration, without interrupting the source.
+
+        The caches with the same signature as a current one adopt its series,
+        so only the metrics which are new, or no longer used, change. Returns
+        the lists of caches of the new metrics, and of the removed ones.
+        """
+
+        if self.worker_pool is not None:
+            raise ValueError("the metrics can't be changed when using workers")
+
+        parse_line = create_parser(
+            fields,
+            binary=self.binary,
+            path_normalizer=path_normalizer,
+        )
+
+        with self.lock:
+            # Apply the pending updates to the current caches, before the new
+            # ones take over their series
+            if self.batch_lines:
+                self.flush()
+
+            shipping = self.processing_errors.shipping
+
+            current_caches = {cache.signature(): cache for cache in self.metric_caches}
+            added_caches = []
+            for cache in caches:
+                current_cache = current_caches.pop(cache.signature(), None)
+
+                if current_cache is not None:
+                    cache.adopt(current_cache)
+                else:
+                    added_caches.append(cache)
+                    if shipping:
+                        cache.start_shipping()
+
+                if self.batch_lines:
+                    cache.start_batching()
+
+            self.metric_updaters = metric_updaters
+            self.parse_line = parse_line
+            self.metric_caches = tuple(caches)
+            self.caches = self.metric_caches + (self.processing_errors, self.stage_durations)
+
+        return added_caches, list(current_caches.values())
+
+    def stop(self):
+        self.should_exit = True
+
+    def update_metrics(self, raw_line, source=None):
+        if source is None:
+            source = self.source
+
+        if self.sink is not None:
+            self.sink.update_metrics(raw_line, source)
+            return
+
+        self.count_read(source, 1, len(raw_line))
+
+        if self.ingest_queue is not None:
+            self.ingest_queue.put(raw_line, source)
+            return
+
+        with self.lock:
+            self._update_metrics(raw_line, 1, source)
+
+    def update_metrics_batch(self, raw_lines, source=None):
+        """Like update_metrics for each of raw_lines, taking the lock once"""
+
+        if source is None:
+            source = self.source
+
+        if self.sink is not None:
+            self.sink.update_metrics_batch(raw_lines, source)
+            return
+
+        self.count_read(source, len(raw_lines), sum(map(len, raw_lines)))
+
+        if self.ingest_queue is not None:
+            self.ingest_queue.put_many(raw_lines, source)
+            return
+
+        with self.lock:
+            for raw_line in raw_lines:
+                self._update_metrics(raw_line, 1, source)
+
+    def count_read(self, source, lines, size):
+        with self.stats_lock:
+            self.lines_read[source] = self.lines_read.get(source, 0) + lines
+            self.bytes_read[source] = self.bytes_read.get(source, 0) + size
+
+    def process_queued_lines(self):
+        while True:
+            lines = self.ingest_queue.get_many(INGEST_BATCH_LINES, timeout=1)
+            if not lines:
+                continue
+
+            try:
+                with self.lock:
+                    for raw_line, weight, source in lines:
+                        self._update_metrics(raw_line, weight, source)
+            finally:
+                self.ingest_queue.task_done(len(lines))
+
+    def wait_until_processed(self, timeout=None):
+        """Wait up to timeout seconds for the lines read so far to be
+        processed, if they're queued, returning whether they have been, e.g.
+        before saving the position of the source.
+        """
+
+        if self.sink is not None:
+            return self.sink.wait_until_processed(timeout)
+
+        if self.ingest_queue is None:
+            return True
+
+        return self.ingest_queue.join(timeout)
+
+    def update_lag(self, raw_line, source):
         try:
-            raw_line = JOURNAL_REGEX.sub('', raw_line.strip())
-            line = HaproxyLogLine(raw_line.strip())
+            line = self.parse_accept_date(raw_line.strip())
+            if line is None:
+                return
+
+            # HAProxy logs the accept date in local time
+            lag = time.time() - accept_timestamp(
+                line.accept_date,
+                time.localtime().tm_gmtoff,
+            )
+
+            with self.stats_lock:
+                self.lag[source] = lag
+        except Exception:
+            logging.exception("Failed to get the accept date of %s" % raw_line)
+
+    def _update_metrics(self, raw_line, weight=1, source=None):
+        self.lines_until_lag -= 1
+        timed = not self.lines_until_lag
+        if timed:
+            self.lines_until_lag = TIMED_LINE_INTERVAL
+            self.update_lag(raw_line, source)
+
+        if self.line_filter is not None or self.sampler is not None:
+            sample_weight = self.filter_line(raw_line, timed)
+            if not sample_weight:
+                return
+
+            weight *= sample_weight
+
+        if self.worker_pool is not None:
+            self.worker_pool.submit(raw_line, weight, source)
+            return
+
+        self.process_line(raw_line, weight, source)
+
+        if self.batch_lines:
+            self.lines_in_batch += 1
+
+            if self.lines_in_batch >= self.batch_lines:
+                self.flush()
+
+    def filter_line(self, raw_line, timed=False):
+        """Return the weight of raw_line after filtering and sampling it, 0 if
+        it should be dropped.
+        """
+
+        if timed:
+            start = time.perf_counter()
+
+        if self.line_filter is not None and not self.line_filter(raw_line):
+            return 0
+
+        weight = 1
+        if self.sampler is not None:
+            weight = self.sampler(raw_line)
+            if not weight:
+                return 0
+
+        if timed:
+            self.stage_durations.get(('filter',)).observe(time.perf_counter() - start)
+
+        return weight
+
+    def process_line(self, raw_line, weight=1, source=None):
+        self.lines_until_timed -= 1
+        timed = not self.lines_until_timed
+        if timed:
+            self.lines_until_timed = TIMED_LINE_INTERVAL
+            start = time.perf_counter()
+
+        try:
+            line = self.parse_line(raw_line.strip())
         except Exception as e:
-            self.processing_errors.inc()
+            self.processing_errors.get(()).inc()
             logging.exception("%s (line parsing error): %s" % (e, raw_line))
             return
 
-        if not line.valid:
-            self.processing_errors.inc()
+        if line is None:
+            self.processing_errors.get(()).inc()
             logging.debug("Failed to parse line: %s" % raw_line)
             return
 
+        line.source = self.source if source is None else source
+
+        if timed:
+            parsed = time.perf_counter()
+
         try:
             for metric_updater in self.metric_updaters:
-                metric_updater(line)
+                metric_updater(line, weight)
         except Exception as e:
-            self.processing_errors.inc()
+            self.processing_errors.get(()).inc()
             logging.exception("%s (error updating metrics): %s" % (e, raw_line))
+
+        if timed:
+            self.stage_durations.get(('parse',)).observe(parsed - start)
+            self.stage_durations.get(('update',)).observe(time.perf_counter() - parsed)
+
+
+class MultiSourceProcessor(AbstractLogProcessor):
+    """Processes the lines read by several sources, log processors created
+    with this one as their sink, each in its own thread, in one parsing
+    stage, with one set of metrics. The source of each line is the source of
+    the log processor which read it, or as given by it, e.g. the path of a
+    file.
+    """
+
+    binary = True
+    source = 'multiple'
+
+    def __init__(self, *args, **kwargs):
+        super(MultiSourceProcessor, self).__init__(*args, **kwargs)
+
+        self.sources = []
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def stop(self):
+        super(MultiSourceProcessor, self).stop()
+
+        for source in self.sources:
+            source.stop()
+
+    def run(self):
+        # Only run, rather than start, the sources, as they process none of
+        # the lines themselves
+        threads = [
+            threading.Thread(
+                target=source.run,
+                name='%s-%s' % (self.name, source.source),
+                daemon=True,
+            )
+            for source in self.sources
+        ]
+
+        for thread in threads:
+            thread.start()
+            self.threads.append(thread)
+
+        for thread in threads:
+            thread.join()
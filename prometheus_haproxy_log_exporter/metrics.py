@@ -12,8 +12,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import itertools
+import operator
 
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Histogram, REGISTRY
+
+from .series import SeriesCache, weighted_observe
+from .sketch import SketchSummary
 
 NAMESPACE = 'haproxy_log'
 
@@ -72,6 +76,7 @@ REQUEST_LABELS = (
     'http_request_method',
     'client_ip',
     'client_port',
+    'source',
 )
 
 # These are the default buckets for the Prometheus python client, adjusted to
@@ -90,155 +95,334 @@ DEFAULT_QUEUE_LENGTH_BUCKETS = tuple(itertools.chain(
 ))
 
 
-def requests_total(labelnames):
+class MetricUpdater(object):
+    """Updates a metric from processed lines.
+
+    labelnames are the line attributes used as labels, and fields all the
+    attributes which are read from the line. observe is called with the line,
+    the tuple of values for labelnames, and the weight of the line, the number
+    of lines it stands for if lines are being sampled. caches are the
+    SeriesCaches of the metrics which are updated.
+    """
+
+    def __init__(self, labelnames, fields, observe, caches):
+        self.labelnames = tuple(labelnames)
+        self.fields = self.labelnames + tuple(
+            field for field in fields if field not in self.labelnames
+        )
+        self.observe = observe
+        self.caches = tuple(caches)
+
+    def __call__(self, line, weight=1):
+        self.observe(line, tuple(
+            getattr(line, label)
+            for label in self.labelnames
+        ), weight)
+
+
+def series_cache(name, metric, max_series, buckets=None):
+    return SeriesCache(
+        '%s_%s' % (NAMESPACE, name),
+        metric,
+        max_series=max_series,
+        buckets=buckets,
+    )
+
+
+def requests_total(labelnames, registry=REGISTRY, max_series=0):
     requests_total = Counter(
         'requests_total',
         "Total processed requests",
         namespace=NAMESPACE,
         labelnames=labelnames,
+        registry=registry,
     )
 
-    if len(labelnames) == 0:
-        def observe(line):
-            requests_total.inc()
-    else:
-        def observe(line):
-            requests_total.labels({
-                label: getattr(line, label)
-                for label in labelnames
-            }).inc()
+    cache = series_cache('requests_total', requests_total, max_series)
 
-    return observe
+    def observe(line, label_values, weight):
+        cache.get(label_values).inc(weight)
 
+    return MetricUpdater(labelnames, (), observe, (cache,))
 
-def timer(timer_name, labelnames, buckets):
-    attribute, documentation = TIMERS[timer_name]
 
-    all_labelnames = labelnames
+def timer_cache(timer_name, documentation, labelnames, buckets, registry,
+                max_series, histogram_class, quantiles, quantile_window,
+                relative_accuracy):
+    """Create the SeriesCache of the histogram of a timer, or of its
+    SketchSummary if quantiles are given.
+    """
 
-    if timer_name == 'session_duration_milliseconds':
-        all_labelnames = labelnames + ['logasap']
+    if quantiles:
+        summary = SketchSummary(
+            timer_name,
+            documentation=documentation,
+            namespace=NAMESPACE,
+            labelnames=tuple(labelnames),
+            quantiles=quantiles,
+            window=quantile_window,
+            relative_accuracy=relative_accuracy,
+            registry=registry,
+        )
 
-    histogram = Histogram(
+        return series_cache(timer_name, summary, max_series)
+
+    histogram = histogram_class(
         timer_name,
         documentation=documentation,
         namespace=NAMESPACE,
-        labelnames=tuple(all_labelnames),
+        labelnames=tuple(labelnames),
         buckets=buckets,
+        registry=registry,
     )
 
-    if timer_name == 'session_duration_milliseconds':
-        def observe(line):
-            raw_value = getattr(line, attribute)
-
-            label_values = {
-                label: getattr(line, label)
-                for label in labelnames
-            }
-
-            if raw_value.startswith('+'):
-                label_values['logasap'] = True
-                value = float(raw_value[1:])
-            else:
-                label_values['logasap'] = False
-                value = float(raw_value)
-
-            histogram.labels(label_values).observe(value)
-    else:
-        abort_counter_name, abort_counter_documentation = TIMER_ABORT_COUNTERS[timer_name]
+    return series_cache(timer_name, histogram, max_series, buckets)
 
-        abort_counter = Counter(
-            abort_counter_name,
-            abort_counter_documentation,
-            namespace=NAMESPACE,
-            labelnames=labelnames,
-        )
 
-        if len(labelnames) == 0:
-            def observe(line):
-                value = float(getattr(line, attribute))
+def session_duration_observer(attribute, histogram_cache):
+    """Create the observe function of the session duration, which is
+    labelled with whether it's logged as soon as possible (logasap), when
+    it's prefixed with a +.
+    """
+
+    def observe(line, label_values, weight):
+        raw_value = getattr(line, attribute)
+
+        if raw_value is None:
+            return
 
-                if value == -1:
-                    abort_counter.inc()
-                else:
-                    histogram.observe(value)
+        if raw_value.startswith('+'):
+            child = histogram_cache.get(label_values + (True,))
+            value = float(raw_value[1:])
         else:
-            def observe(line):
-                value = float(getattr(line, attribute))
+            child = histogram_cache.get(label_values + (False,))
+            value = float(raw_value)
 
-                label_values = {
-                    label: getattr(line, label)
-                    for label in labelnames
-                }
+        if weight == 1:
+            child.observe(value)
+        else:
+            weighted_observe(child, value, weight)
+
+    return observe
 
-                if value == -1:
-                    abort_counter.labels(label_values).inc()
-                else:
-                    histogram.labels(label_values).observe(value)
+
+def timer_observer(attribute, histogram_cache, abort_counter_cache):
+    """Create the observe function of a timer, which counts the aborts, when
+    the time is -1, instead of observing them.
+    """
+
+    def observe(line, label_values, weight):
+        raw_value = getattr(line, attribute)
+
+        if raw_value is None:
+            return
+
+        value = float(raw_value)
+
+        if value == -1:
+            abort_counter_cache.get(label_values).inc(weight)
+        elif weight == 1:
+            histogram_cache.get(label_values).observe(value)
+        else:
+            weighted_observe(histogram_cache.get(label_values), value, weight)
 
     return observe
 
 
-def bytes_read_total(labelnames):
+def timer(timer_name, labelnames, buckets, registry=REGISTRY, max_series=0,
+          histogram_class=Histogram, quantiles=None, quantile_window=600,
+          relative_accuracy=0.01):
+    """Create the updater of a timer, a histogram with the given buckets, or
+    if quantiles are given, a SketchSummary of those quantiles over the last
+    quantile_window seconds instead.
+    """
+
+    attribute, documentation = TIMERS[timer_name]
+
+    if timer_name == 'session_duration_milliseconds':
+        histogram_cache = timer_cache(
+            timer_name, documentation, labelnames + ['logasap'], buckets,
+            registry, max_series, histogram_class, quantiles,
+            quantile_window, relative_accuracy,
+        )
+
+        return MetricUpdater(
+            labelnames,
+            (attribute,),
+            session_duration_observer(attribute, histogram_cache),
+            (histogram_cache,),
+        )
+
+    histogram_cache = timer_cache(
+        timer_name, documentation, labelnames, buckets, registry, max_series,
+        histogram_class, quantiles, quantile_window, relative_accuracy,
+    )
+
+    abort_counter_name, abort_counter_documentation = TIMER_ABORT_COUNTERS[timer_name]
+
+    abort_counter = Counter(
+        abort_counter_name,
+        abort_counter_documentation,
+        namespace=NAMESPACE,
+        labelnames=labelnames,
+        registry=registry,
+    )
+
+    abort_counter_cache = series_cache(abort_counter_name, abort_counter, max_series)
+
+    return MetricUpdater(
+        labelnames,
+        (attribute,),
+        timer_observer(attribute, histogram_cache, abort_counter_cache),
+        (histogram_cache, abort_counter_cache),
+    )
+
+
+def bytes_read_total(labelnames, registry=REGISTRY, max_series=0):
     counter = Counter(
         'bytes_read_total',
         "Bytes read total",
         namespace=NAMESPACE,
         labelnames=labelnames,
+        registry=registry,
     )
 
-    if len(labelnames) == 0:
-        def observe(line):
-            counter.inc()
-    else:
-        def observe(line):
-            counter.labels({
-                label: getattr(line, label)
-                for label in labelnames
-            }).inc()
+    cache = series_cache('bytes_read_total', counter, max_series)
 
-    return observe
+    def observe(line, label_values, weight):
+        cache.get(label_values).inc(weight)
+
+    return MetricUpdater(labelnames, (), observe, (cache,))
 
 
-def backend_queue_length(labelnames, buckets):
-    histogram = Histogram(
+def backend_queue_length(labelnames, buckets, registry=REGISTRY, max_series=0,
+                         histogram_class=Histogram):
+    histogram = histogram_class(
         'backend_queue_length',
         "Requests processed before this one in the backend queue",
         namespace=NAMESPACE,
         labelnames=tuple(labelnames),
         buckets=buckets,
+        registry=registry,
     )
 
-    if len(labelnames) == 0:
-        def observe(line):
-            histogram.observe(line.queue_backend)
-    else:
-        def observe(line):
-            histogram.labels({
-                label: getattr(line, label)
-                for label in labelnames
-            }).observe(line.queue_backend)
+    cache = series_cache('backend_queue_length', histogram, max_series, buckets)
 
-    return observe
+    def observe(line, label_values, weight):
+        if weight == 1:
+            cache.get(label_values).observe(line.queue_backend)
+        else:
+            weighted_observe(cache.get(label_values), line.queue_backend, weight)
+
+    return MetricUpdater(labelnames, ('queue_backend',), observe, (cache,))
 
 
-def server_queue_length(labelnames, buckets):
-    histogram = Histogram(
+def server_queue_length(labelnames, buckets, registry=REGISTRY, max_series=0,
+                        histogram_class=Histogram):
+    histogram = histogram_class(
         'server_queue_length',
         "Length of the server queue when the request was received",
         namespace=NAMESPACE,
         labelnames=tuple(labelnames),
         buckets=buckets,
+        registry=registry,
     )
 
-    if len(labelnames) == 0:
-        def observe(line):
-            histogram.observe(line.queue_server)
+    cache = series_cache('server_queue_length', histogram, max_series, buckets)
+
+    def observe(line, label_values, weight):
+        if weight == 1:
+            cache.get(label_values).observe(line.queue_server)
+        else:
+            weighted_observe(cache.get(label_values), line.queue_server, weight)
+
+    return MetricUpdater(labelnames, ('queue_server',), observe, (cache,))
+
+
+def create_field_getter(fields):
+    """Create a function returning the tuple of the values of fields of a
+    line, as operator.attrgetter does for more than one field.
+    """
+
+    if len(fields) == 0:
+        def get_field_values(line):
+            return ()
+    elif len(fields) == 1:
+        field = fields[0]
+
+        def get_field_values(line):
+            return (getattr(line, field),)
     else:
-        def observe(line):
-            histogram.labels({
-                label: getattr(line, label)
-                for label in labelnames
-            }).observe(line.queue_server)
+        get_field_values = operator.attrgetter(*fields)
 
-    return observe
+    return get_field_values
+
+
+def create_item_getter(indexes):
+    """Create a function returning the tuple of the items of a sequence at
+    indexes, as operator.itemgetter does for more than one index.
+    """
+
+    if len(indexes) == 0:
+        return lambda values: ()
+    elif len(indexes) == 1:
+        index = indexes[0]
+        return lambda values: (values[index],)
+    else:
+        return operator.itemgetter(*indexes)
+
+
+def compile_plan(metric_updaters):
+    """Fuse the given MetricUpdaters in to one function updating all of them.
+
+    Every field is read from the line once, and each distinct tuple of label
+    values is built once and shared by the metrics using those labels.
+    """
+
+    fields = []
+    for metric_updater in metric_updaters:
+        for field in metric_updater.fields:
+            if field not in fields:
+                fields.append(field)
+
+    labelname_sets = []
+    for metric_updater in metric_updaters:
+        if metric_updater.labelnames not in labelname_sets:
+            labelname_sets.append(metric_updater.labelnames)
+
+    steps = tuple(
+        (labelname_sets.index(metric_updater.labelnames), metric_updater.observe)
+        for metric_updater in metric_updaters
+    )
+
+    label_fields = tuple(
+        field for field in fields
+        if any(field in labelnames for labelnames in labelname_sets)
+    )
+    get_field_values = create_field_getter(label_fields)
+
+    # For each distinct set of labels, a function taking the values of
+    # label_fields, and returning the tuple of label values
+    label_value_getters = tuple(
+        create_item_getter(tuple(label_fields.index(label) for label in labelnames))
+        for labelnames in labelname_sets
+    )
+
+    def update(line, weight=1):
+        field_values = get_field_values(line)
+        label_values = [
+            get_label_values(field_values)
+            for get_label_values in label_value_getters
+        ]
+
+        for label_set, observe in steps:
+            observe(line, label_values[label_set], weight)
+
+    update.fields = tuple(fields)
+    update.caches = tuple(
+        cache
+        for metric_updater in metric_updaters
+        for cache in metric_updater.caches
+    )
+
+    return update
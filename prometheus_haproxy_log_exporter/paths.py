@@ -0,0 +1,114 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import functools
+
+NUMBER_REGEX = re.compile(r'\A\d+\Z')
+UUID_REGEX = re.compile(
+    r'\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z'
+)
+# At least 8 hex digits, including a decimal digit, so words aren't matched
+HEX_REGEX = re.compile(r'\A(?=[a-fA-F]*\d)[0-9a-fA-F]{8,}\Z')
+
+# Keys in the trie of templates, for any segment, the end of a template, and
+# a template ending in *
+PARAMETER = object()
+END = object()
+REST = object()
+
+
+def replace_ids(segment):
+    if NUMBER_REGEX.match(segment):
+        return '{number}'
+    elif UUID_REGEX.match(segment):
+        return '{uuid}'
+    elif HEX_REGEX.match(segment):
+        return '{hex}'
+
+    return segment
+
+
+class PathNormalizer(object):
+    """Normalizes request paths, so that they can be used as label values
+    without creating a series for every distinct URL.
+
+    The query string is removed, and if the path matches one of templates,
+    the template is returned. In templates, a segment in braces, e.g.
+    /users/{user}, matches any segment, and a final * matches the rest of the
+    path, e.g. /static/*. Otherwise, segments which look like ids, numbers,
+    UUIDs and long hex strings, are replaced with {number}, {uuid} and {hex}.
+
+    Calling the PathNormalizer with a path, as str or bytes, returns the
+    normalized path, with the results for the last max_cache_size paths kept.
+    """
+
+    def __init__(self, templates=(), max_cache_size=10000):
+        self.trie = {}
+        for template in templates:
+            self.add_template(template)
+
+        self.normalize = functools.lru_cache(maxsize=max_cache_size)(self._normalize)
+
+    def __call__(self, path):
+        return self.normalize(path)
+
+    def add_template(self, template):
+        node = self.trie
+
+        for segment in template.strip('/').split('/'):
+            if segment == '*':
+                node[REST] = template
+                return
+
+            if segment.startswith('{') and segment.endswith('}'):
+                segment = PARAMETER
+
+            node = node.setdefault(segment, {})
+
+        node[END] = template
+
+    def match_template(self, node, segments, index):
+        """Return the template matching segments[index:], from node in the
+        trie, preferring literal segments to parameters.
+        """
+
+        if index == len(segments):
+            template = node.get(END)
+            if template is not None:
+                return template
+            return node.get(REST)
+
+        for key in (segments[index], PARAMETER):
+            child = node.get(key)
+            if child is not None:
+                template = self.match_template(child, segments, index + 1)
+                if template is not None:
+                    return template
+
+        return node.get(REST)
+
+    def _normalize(self, path):
+        if isinstance(path, bytes):
+            path = path.decode('utf-8', 'replace')
+
+        path = path.split('?', 1)[0]
+
+        segments = path.strip('/').split('/')
+
+        if self.trie:
+            template = self.match_template(self.trie, segments, 0)
+            if template is not None:
+                return template
+
+        return '/'.join(replace_ids(segment) for segment in path.split('/'))
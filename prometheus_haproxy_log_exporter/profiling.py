@@ -0,0 +1,103 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import collections
+import tracemalloc
+
+MAX_PROFILE_SECONDS = 300
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def collapse_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (
+            code.co_name,
+            code.co_filename,
+            code.co_firstlineno,
+        ))
+        frame = frame.f_back
+
+    return ';'.join(reversed(stack))
+
+
+def sample_stacks(threads, seconds, interval=DEFAULT_SAMPLE_INTERVAL):
+    """Sample the stacks of the given threads every interval seconds, for
+    the given number of seconds, returning them in the collapsed format read
+    by flamegraph.pl and speedscope, one stack with its count per line, the
+    outermost frame being the name of the thread.
+    """
+
+    names = {thread.ident: thread.name for thread in threads}
+    counts = collections.Counter()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+
+        for ident, name in names.items():
+            frame = frames.get(ident)
+            if frame is not None:
+                counts['%s;%s' % (name, collapse_stack(frame))] += 1
+
+        # Don't keep the frames of the other threads alive while sleeping
+        del frames
+
+        time.sleep(interval)
+
+    return ''.join(
+        '%s %d\n' % (stack, count)
+        for stack, count in counts.most_common()
+    )
+
+
+def top_allocations(limit=25, key_type='lineno', stop=False):
+    """Return the top allocations by size, grouped by key_type (as for
+    tracemalloc.Snapshot.statistics), of the memory allocated since tracing
+    started. Tracing is started by the first call, as it slows down every
+    allocation, so that call only reports that it has started, and it
+    continues until a call with stop set, which reports the allocations one
+    last time before stopping it.
+    """
+
+    if not tracemalloc.is_tracing():
+        if stop:
+            return "Not tracing memory allocations\n"
+
+        tracemalloc.start()
+        return (
+            "Started tracing memory allocations, only allocations from now "
+            "on are reported, until stopped with ?stop=1\n"
+        )
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ))
+
+    statistics = snapshot.statistics(key_type)
+    current, peak = tracemalloc.get_traced_memory()
+
+    output = ["Traced %d bytes (peak %d bytes)\n" % (current, peak)]
+    for statistic in statistics[:limit]:
+        output.append('%s\n' % statistic)
+
+    if stop:
+        # Also frees the traces
+        tracemalloc.stop()
+        output.append("Stopped tracing memory allocations\n")
+
+    return ''.join(output)
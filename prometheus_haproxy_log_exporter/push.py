@@ -0,0 +1,513 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Exporters can push the updates to their metrics to another exporter, which
+# aggregates the updates from all of them, and serves the metrics of the
+# whole fleet.
+#
+# Each push holds the deltas of the series updated since the last push, and
+# is identified by the instance name, a random id chosen when the exporter
+# starts, and a sequence number. A push is sent again until it's
+# acknowledged, or rejected as invalid, with any new deltas held back for the
+# next push, and the aggregator ignores pushes it has already applied, so a
+# retry after a lost response isn't counted twice. A push is only applied if
+# all of it fits the metrics of the aggregator.
+
+import os
+import zlib
+import struct
+import logging
+import threading
+import urllib.error
+import urllib.request
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+from .log_processing import AbstractLogProcessor
+
+MAGIC = b'HLD1'
+
+CONTENT_TYPE = 'application/x-haproxy-log-deltas'
+
+# magic, boot id, sequence number
+HEADER = struct.Struct('!4s16sQ')
+LENGTH = struct.Struct('!H')
+# number of buckets, 0 for a counter or SKETCH, relative accuracy of a
+# sketch, and number of series
+CACHE_HEADER = struct.Struct('!HdI')
+
+# The default maximum size of a push, compressed, and of its deltas once
+# decompressed, as the aggregator's port isn't authenticated
+MAX_PUSH_SIZE = 16 * 1024 * 1024
+MAX_DELTAS_SIZE = 256 * 1024 * 1024
+
+SKETCH = 0xffff
+# sum, count, zero count and number of bins of a sketch
+SKETCH_HEADER = struct.Struct('!dddI')
+SKETCH_BIN = struct.Struct('!id')
+COUNTER_VALUE = struct.Struct('!d')
+# The structs of the histogram deltas, by number of buckets
+HISTOGRAM_VALUES = {}
+
+
+def pack_string(value):
+    value = value.encode('utf-8')
+
+    return LENGTH.pack(len(value)) + value
+
+
+def cache_layout(cache):
+    """Return the number of buckets of the deltas of cache, 0 for a counter
+    or SKETCH, and the relative accuracy of a sketch, or 0.
+    """
+
+    if cache.windowed:
+        return (SKETCH, cache.metric.relative_accuracy)
+    elif cache.upper_bounds is not None:
+        return (len(cache.upper_bounds), 0.0)
+    else:
+        return (0, 0.0)
+
+
+def histogram_values(bucket_count):
+    """The struct of the sum and bucket counts of a histogram delta"""
+
+    try:
+        return HISTOGRAM_VALUES[bucket_count]
+    except KeyError:
+        values = HISTOGRAM_VALUES[bucket_count] = struct.Struct('!%dd' % (bucket_count + 1))
+
+        return values
+
+
+def encode_counter(delta, bucket_count):
+    return COUNTER_VALUE.pack(delta)
+
+
+def decode_counter(reader, bucket_count):
+    return reader.unpack(COUNTER_VALUE)[0]
+
+
+def encode_histogram(delta, bucket_count):
+    total, bucket_counts = delta
+
+    return histogram_values(bucket_count).pack(total, *bucket_counts)
+
+
+def decode_histogram(reader, bucket_count):
+    values = reader.unpack(histogram_values(bucket_count))
+
+    return (values[0], values[1:])
+
+
+def encode_sketch(delta, bucket_count):
+    total, count, zero_count, bins = delta
+
+    return SKETCH_HEADER.pack(total, count, zero_count, len(bins)) + b''.join(
+        SKETCH_BIN.pack(key, bin_count)
+        for key, bin_count in bins.items()
+    )
+
+
+def decode_sketch(reader, bucket_count):
+    total, count, zero_count, bin_count = reader.unpack(SKETCH_HEADER)
+
+    return (total, count, zero_count, dict(
+        reader.unpack(SKETCH_BIN)
+        for _ in range(bin_count)
+    ))
+
+
+# The encoder and decoder of the deltas of each kind of cache
+DELTA_CODECS = {
+    'counter': (encode_counter, decode_counter),
+    'histogram': (encode_histogram, decode_histogram),
+    'sketch': (encode_sketch, decode_sketch),
+}
+
+
+def delta_codec(bucket_count):
+    """Return the encoder and decoder of the deltas of a cache with
+    bucket_count buckets, as in its layout.
+    """
+
+    if bucket_count == SKETCH:
+        return DELTA_CODECS['sketch']
+    elif bucket_count:
+        return DELTA_CODECS['histogram']
+    else:
+        return DELTA_CODECS['counter']
+
+
+def encode_deltas(instance, boot_id, seq, caches_deltas):
+    """Encode a push of the deltas of each cache, given as the cache name,
+    its layout, as returned by cache_layout, and the deltas as returned by
+    SeriesCache.take_unshipped.
+    """
+
+    output = [HEADER.pack(MAGIC, boot_id, seq), pack_string(instance)]
+
+    for name, (bucket_count, relative_accuracy), deltas in caches_deltas:
+        output.append(pack_string(name))
+        output.append(CACHE_HEADER.pack(bucket_count, relative_accuracy, len(deltas)))
+
+        encode, _ = delta_codec(bucket_count)
+
+        for label_values, delta in deltas.items():
+            output.append(bytes((len(label_values),)))
+            for label_value in label_values:
+                output.append(pack_string(str(label_value)))
+
+            output.append(encode(delta, bucket_count))
+
+    return zlib.compress(b''.join(output))
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, format):
+        values = format.unpack_from(self.data, self.offset)
+        self.offset += format.size
+
+        return values
+
+    def string(self):
+        length, = self.unpack(LENGTH)
+        value = self.data[self.offset:self.offset + length]
+        if len(value) != length:
+            raise ValueError("truncated push")
+        self.offset += length
+
+        return value.decode('utf-8')
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+
+        return value
+
+    def at_end(self):
+        return self.offset == len(self.data)
+
+
+def decompress(data, max_size):
+    """Decompress data, raising ValueError if it's larger than max_size, or
+    truncated, without decompressing more than max_size bytes.
+    """
+
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(data, max_size)
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("push larger than %d bytes decompressed" % max_size)
+    if not decompressor.eof:
+        raise ValueError("truncated push")
+
+    return output
+
+
+def decode_deltas(data, max_size=MAX_DELTAS_SIZE):
+    """Decode a push, returning the instance, boot id and sequence number,
+    and a list of the cache names, layouts and deltas, raising ValueError if
+    it isn't valid, or larger than max_size bytes once decompressed.
+    """
+
+    try:
+        reader = Reader(decompress(data, max_size))
+
+        magic, boot_id, seq = reader.unpack(HEADER)
+        if magic != MAGIC:
+            raise ValueError("not a push of deltas")
+        instance = reader.string()
+
+        caches_deltas = []
+        while not reader.at_end():
+            name = reader.string()
+            bucket_count, relative_accuracy, series = reader.unpack(CACHE_HEADER)
+
+            _, decode = delta_codec(bucket_count)
+
+            deltas = {}
+            for _ in range(series):
+                label_values = tuple(
+                    reader.string()
+                    for _ in range(reader.byte())
+                )
+
+                deltas[label_values] = decode(reader, bucket_count)
+
+            caches_deltas.append((name, (bucket_count, relative_accuracy), deltas))
+    except (zlib.error, struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("invalid push: %s" % e)
+
+    return instance, boot_id, seq, caches_deltas
+
+
+class DeltaPusher(threading.Thread):
+    """Pushes the deltas applied to the caches of log_processor to the
+    aggregator at url every interval seconds.
+
+    Only deltas are recorded, so the log processor must batch its updates,
+    or use workers.
+    """
+
+    def __init__(self, log_processor, url, instance, interval=15, timeout=10):
+        super(DeltaPusher, self).__init__(name='delta-pusher', daemon=True)
+
+        self.log_processor = log_processor
+        self.url = url
+        self.instance = instance
+        self.interval = interval
+        self.timeout = timeout
+
+        self.boot_id = os.urandom(16)
+        self.seq = 0
+        # The encoded push which hasn't been acknowledged yet
+        self.push_data = None
+
+        self.pushes = 0
+        self.failures = 0
+        self.rejected = 0
+
+        for cache in log_processor.caches:
+            cache.start_shipping()
+
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.push()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+        # Push what's left
+        with self.log_processor.lock:
+            self.log_processor.flush()
+        self.push()
+
+    def push(self):
+        # Send the push which failed first, so they're applied in order
+        if self.push_data is not None and not self.send():
+            return
+
+        with self.log_processor.lock:
+            caches_deltas = [
+                (cache.name, cache_layout(cache), cache.take_unshipped())
+                for cache in self.log_processor.caches
+            ]
+
+        caches_deltas = [
+            (name, layout, deltas)
+            for name, layout, deltas in caches_deltas
+            if deltas
+        ]
+        if not caches_deltas:
+            return
+
+        self.seq += 1
+        self.push_data = encode_deltas(
+            self.instance,
+            self.boot_id,
+            self.seq,
+            caches_deltas,
+        )
+
+        self.send()
+
+    def send(self):
+        request = urllib.request.Request(
+            self.url,
+            data=self.push_data,
+            headers={'Content-Type': CONTENT_TYPE},
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if not 400 <= e.code < 500:
+                return self.failed(e)
+
+            # Sending it again won't help, so drop it rather than holding
+            # back every later push
+            self.push_data = None
+            self.rejected += 1
+            logging.error("Push of deltas rejected by %s, dropping it: %s" % (
+                self.url,
+                e,
+            ))
+            return True
+        except OSError as e:
+            return self.failed(e)
+
+        self.push_data = None
+        self.pushes += 1
+
+        return True
+
+    def failed(self, e):
+        self.failures += 1
+        logging.warning("Failed to push deltas to %s, will retry: %s" % (
+            self.url,
+            e,
+        ))
+
+        return False
+
+
+def check_deltas(cache, layout, deltas):
+    """Raise ValueError if the pushed deltas don't fit cache, e.g. as the
+    exporter which pushed them has different metric arguments.
+    """
+
+    if layout != cache_layout(cache):
+        raise ValueError("the buckets of %s don't match" % cache.name)
+
+    label_count = len(getattr(cache.metric, '_labelnames', ()))
+    for label_values in deltas:
+        if len(label_values) != label_count:
+            raise ValueError("the labels of %s don't match" % cache.name)
+
+
+class AggregateProcessor(AbstractLogProcessor):
+    """Reads no logs, but applies the deltas pushed by other exporters to its
+    caches, which must be for the same metrics, with the same labels and
+    buckets.
+    """
+
+    source = 'push'
+
+    def __init__(
+        self,
+        *args,
+        max_push_size=MAX_PUSH_SIZE,
+        max_deltas_size=MAX_DELTAS_SIZE,
+        **kwargs
+    ):
+        super(AggregateProcessor, self).__init__(*args, **kwargs)
+
+        # Larger pushes are rejected, before reading them, and while
+        # decompressing them
+        self.max_push_size = max_push_size
+        self.max_deltas_size = max_deltas_size
+
+        self.caches_by_name = {cache.name: cache for cache in self.caches}
+
+        # The boot id of each instance, and the last sequence number applied
+        # for it. Only the latest boot of an instance is pushing.
+        self.last_seqs = {}
+
+        self.received_pushes = {}
+        self.duplicate_pushes = {}
+
+    def run(self):
+        pass
+
+    def set_metric_updaters(self, *args, **kwargs):
+        changes = super(AggregateProcessor, self).set_metric_updaters(*args, **kwargs)
+
+        self.caches_by_name = {cache.name: cache for cache in self.caches}
+
+        return changes
+
+    def receive(self, data):
+        """Apply a push, returning False if it had already been applied.
+
+        Raises ValueError, having applied none of it, if it's invalid, or
+        doesn't fit the caches.
+        """
+
+        instance, boot_id, seq, caches_deltas = decode_deltas(data, self.max_deltas_size)
+
+        with self.lock:
+            # All of it is checked before any of it is applied, so a push is
+            # applied either in full, or not at all
+            for name, layout, deltas in caches_deltas:
+                if name not in self.caches_by_name:
+                    raise ValueError("unknown metric %s" % name)
+                check_deltas(self.caches_by_name[name], layout, deltas)
+
+            self.received_pushes[instance] = self.received_pushes.get(instance, 0) + 1
+
+            last_boot_id, last_seq = self.last_seqs.get(instance, (None, 0))
+            if boot_id == last_boot_id and seq <= last_seq:
+                self.duplicate_pushes[instance] = self.duplicate_pushes.get(instance, 0) + 1
+                return False
+
+            for name, _, deltas in caches_deltas:
+                self.caches_by_name[name].apply_deltas(deltas)
+
+            self.last_seqs[instance] = (boot_id, seq)
+
+        return True
+
+
+class PushCollector(object):
+    """Exports the pushes sent by a DeltaPusher, or received by an
+    AggregateProcessor.
+    """
+
+    def __init__(self, namespace, pusher=None, aggregator=None, registry=REGISTRY):
+        self.namespace = namespace
+        self.pusher = pusher
+        self.aggregator = aggregator
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        if self.pusher is not None:
+            yield CounterMetricFamily(
+                '%s_pushes_total' % self.namespace,
+                "Pushes of deltas acknowledged by the aggregator",
+                value=self.pusher.pushes,
+            )
+            yield CounterMetricFamily(
+                '%s_push_failures_total' % self.namespace,
+                "Pushes of deltas which failed, and will be retried",
+                value=self.pusher.failures,
+            )
+            yield CounterMetricFamily(
+                '%s_push_rejections_total' % self.namespace,
+                "Pushes of deltas rejected by the aggregator, and dropped",
+                value=self.pusher.rejected,
+            )
+
+        if self.aggregator is not None:
+            for name, documentation, counts in (
+                (
+                    'received_pushes_total',
+                    "Pushes of deltas received from each instance",
+                    self.aggregator.received_pushes,
+                ),
+                (
+                    'duplicate_pushes_total',
+                    "Pushes of deltas received again, and ignored",
+                    self.aggregator.duplicate_pushes,
+                ),
+            ):
+                family = CounterMetricFamily(
+                    '%s_%s' % (self.namespace, name),
+                    documentation,
+                    labels=['instance'],
+                )
+                for instance, count in list(counts.items()):
+                    family.add_metric([instance], count)
+
+                yield family
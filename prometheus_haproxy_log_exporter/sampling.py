@@ -0,0 +1,166 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+def sampling_rule(value):
+    """Parse NAME=RATE, e.g. www=0.1, in to the name and rate"""
+
+    name, separator, rate = value.rpartition('=')
+    if not separator or not name:
+        raise ValueError("Invalid sampling rule %s, expected NAME=RATE" % value)
+
+    rate = float(rate)
+    if not 0 < rate <= 1:
+        raise ValueError("Invalid sampling rate %s, expected 0 < RATE <= 1" % rate)
+
+    return name, rate
+
+
+class SamplingRule(object):
+    __slots__ = ('frontend_name', 'backend_name', 'rate', 'threshold', 'weight', 'seen', 'kept')
+
+    def __init__(self, frontend_name, backend_name, rate):
+        self.frontend_name = frontend_name
+        self.backend_name = backend_name
+        self.rate = rate
+
+        # Lines are kept if the CRC32 of the client address is below this
+        self.threshold = int(rate * (1 << 32))
+        self.weight = 1 / rate
+
+        self.seen = 0
+        self.kept = 0
+
+
+class Sampler(object):
+    """Decides whether to process a raw line, for lines of the frontends and
+    backends with a sampling rate.
+
+    Only the client address, frontend and backend are found in the line,
+    without parsing it. Whether a line is kept depends on a hash of the client
+    ip:port, so it's the same for all the lines of a connection, and in all
+    processes. Calling the Sampler returns the weight of the line, the inverse
+    of the rate, or 0 if it should be skipped.
+
+    The rule for the frontend of a line is used if there is one, otherwise
+    the rule for the backend.
+    """
+
+    def __init__(self, frontend_rates, backend_rates, binary=False):
+        encode = (lambda name: name.encode('utf-8')) if binary else (lambda name: name)
+
+        self.frontend_rules = {
+            encode(name): SamplingRule(name, '', rate)
+            for name, rate in frontend_rates
+        }
+        self.backend_rules = {
+            encode(name): SamplingRule('', name, rate)
+            for name, rate in backend_rates
+        }
+        self.rules = list(self.frontend_rules.values()) + list(self.backend_rules.values())
+
+        self.date_start = encode(' [')
+        self.date_end = encode('] ')
+        self.space = encode(' ')
+        self.slash = encode('/')
+        self.ssl_suffix = encode('~')
+        self.client_address = (lambda address: address) if binary else (
+            lambda address: address.encode('utf-8')
+        )
+
+    def __call__(self, raw_line):
+        # 127.0.0.1:39759 [09/Dec/2013:12:59:46.633] fe~ be/srv ...
+        date_start = raw_line.find(self.date_start)
+        if date_start == -1:
+            return 1
+
+        frontend_start = raw_line.find(self.date_end, date_start) + 2
+        frontend_end = raw_line.find(self.space, frontend_start)
+        if frontend_start == 1 or frontend_end == -1:
+            return 1
+
+        frontend_name = raw_line[frontend_start:frontend_end]
+        if frontend_name.endswith(self.ssl_suffix):
+            frontend_name = frontend_name[:-1]
+
+        rule = self.frontend_rules.get(frontend_name)
+        if rule is None:
+            backend_end = raw_line.find(self.slash, frontend_end + 1)
+            if backend_end == -1:
+                return 1
+
+            rule = self.backend_rules.get(raw_line[frontend_end + 1:backend_end])
+            if rule is None:
+                return 1
+
+        rule.seen += 1
+
+        client_start = raw_line.rfind(self.space, 0, date_start) + 1
+        client_address = self.client_address(raw_line[client_start:date_start])
+
+        if zlib.crc32(client_address) >= rule.threshold:
+            return 0
+
+        rule.kept += 1
+
+        return rule.weight
+
+
+class SamplerCollector(object):
+    """Exports the sampling rates of a Sampler"""
+
+    def __init__(self, sampler, namespace, registry=REGISTRY):
+        self.sampler = sampler
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        labels = ['frontend_name', 'backend_name']
+
+        configured_rate = GaugeMetricFamily(
+            '%s_sampling_configured_rate' % self.namespace,
+            "The configured fraction of lines which are processed",
+            labels=labels,
+        )
+        rate = GaugeMetricFamily(
+            '%s_sampling_rate' % self.namespace,
+            "The fraction of lines which have been processed, with the "
+            "metrics scaled up by the inverse of it",
+            labels=labels,
+        )
+        skipped = CounterMetricFamily(
+            '%s_sampling_skipped_lines_total' % self.namespace,
+            "Lines which were not processed, due to sampling",
+            labels=labels,
+        )
+
+        for rule in self.sampler.rules:
+            label_values = [rule.frontend_name, rule.backend_name]
+
+            configured_rate.add_metric(label_values, rule.rate)
+            rate.add_metric(
+                label_values,
+                rule.kept / rule.seen if rule.seen else rule.rate,
+            )
+            skipped.add_metric(label_values, rule.seen - rule.kept)
+
+        yield configured_rate
+        yield rate
+        yield skipped
@@ -0,0 +1,406 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .compact import CompactHistogram, CompactHistogramChild
+from .sketch import SketchSummary, SketchSummaryChild
+
+INF = float('inf')
+
+
+class PendingCounter(object):
+    """Increments of a counter child which are yet to be applied"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def delta(self):
+        return self.value
+
+    def merge(self, delta):
+        self.value += delta
+
+    @staticmethod
+    def apply_delta(child, delta):
+        child.inc(delta)
+
+
+class PendingHistogram(object):
+    """Observations of a histogram child which are yet to be applied"""
+
+    __slots__ = ('upper_bounds', 'sum', 'bucket_counts')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.sum = 0
+        self.bucket_counts = [0] * len(upper_bounds)
+
+    def observe(self, amount, weight=1):
+        self.sum += amount * weight
+        self.bucket_counts[bisect_left(self.upper_bounds, amount)] += weight
+
+    def delta(self):
+        return (self.sum, self.bucket_counts)
+
+    def merge(self, delta):
+        total, bucket_counts = delta
+
+        self.sum += total
+        for i, count in enumerate(bucket_counts):
+            self.bucket_counts[i] += count
+
+    @staticmethod
+    def apply_delta(child, delta):
+        total, bucket_counts = delta
+
+        # prometheus_client can only observe one value at a time, so add to
+        # the sum and buckets of the child directly
+        child._sum.inc(total)
+        for bucket, count in zip(child._buckets, bucket_counts):
+            if count:
+                bucket.inc(count)
+
+
+def weighted_observe(child, amount, weight):
+    """Observe amount in a histogram child, or anything else observing
+    weighted values (PendingHistogram, CompactHistogramChild or
+    SketchSummaryChild), as if it had been observed weight times, e.g. for a
+    sampled line.
+    """
+
+    try:
+        buckets = child._buckets
+    except AttributeError:
+        child.observe(amount, weight)
+        return
+
+    # prometheus_client can only observe one value at a time
+    child._sum.inc(amount * weight)
+    buckets[bisect_left(child._upper_bounds, amount)].inc(weight)
+
+
+class SeriesCache(object):
+    """Maps tuples of raw label values to the children of a metric.
+
+    This avoids building the label dict, and taking the lock of the metric for
+    every line. If max_series is set, the least recently used series are
+    removed from the metric once there are more than max_series of them.
+
+    Once batching has started, get returns a PendingCounter or
+    PendingHistogram (if buckets are given) instead of the child, and the
+    updates are applied to the children by flush. take_deltas and
+    apply_deltas allow the updates to be applied to the children of a
+    different SeriesCache instead, e.g. one in another process.
+
+    If the metric is a SketchSummary, the pending updates of a series are a
+    DDSketch, merged in to the series by flush.
+
+    The label values of the series which are created, updated or removed are
+    recorded, until taken by take_dirty. The quantiles of a SketchSummary
+    change as time passes, so all its series are taken.
+
+    Once shipping has started, the deltas applied are also added up, until
+    taken by take_unshipped, e.g. to send them to another exporter.
+
+    Once expiry has started, the tick (a coarse clock, only advanced by
+    whoever expires the series) at which each series was last used is
+    recorded, and expire removes the series last used before a given tick.
+    """
+
+    def __init__(self, name, metric, max_series=0, buckets=None):
+        self.name = name
+        self.metric = metric
+        self.max_series = max_series
+
+        self.windowed = isinstance(metric, SketchSummary)
+        self.upper_bounds = None
+
+        if self.windowed:
+            self.create_pending = metric.create_sketch
+            self.apply_delta = SketchSummaryChild.apply_delta
+        elif buckets is None:
+            self.create_pending = PendingCounter
+            self.apply_delta = PendingCounter.apply_delta
+        else:
+            upper_bounds = [float(bucket) for bucket in buckets]
+            if upper_bounds[-1] != INF:
+                upper_bounds.append(INF)
+            self.upper_bounds = tuple(upper_bounds)
+
+            self.create_pending = lambda: PendingHistogram(upper_bounds)
+
+            if isinstance(metric, CompactHistogram):
+                self.apply_delta = CompactHistogramChild.apply_delta
+            else:
+                self.apply_delta = PendingHistogram.apply_delta
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.tick = 0
+
+        self._children = OrderedDict()
+        self._pending = None
+        self._unshipped = None
+        self._dirty = set()
+        # The tick at which each series was last used, least recently used
+        # first, once expiry has started
+        self._last_used = None
+
+    def __len__(self):
+        return len(self._children)
+
+    def get(self, label_values):
+        try:
+            child = self._children[label_values]
+        except KeyError:
+            return self._add(label_values)
+
+        self.hits += 1
+        self._dirty.add(label_values)
+        if self.max_series:
+            self._children.move_to_end(label_values)
+        # The series are in the order of their ticks, so one used since the
+        # tick changed is already in place
+        last_used = self._last_used
+        if last_used is not None and last_used[label_values] != self.tick:
+            last_used[label_values] = self.tick
+            last_used.move_to_end(label_values)
+
+        return child
+
+    def _add(self, label_values):
+        self.misses += 1
+
+        if label_values:
+            child = self.metric.labels(*label_values)
+        else:
+            child = self.metric
+        self._children[label_values] = child
+        self._dirty.add(label_values)
+        if self._last_used is not None:
+            self._last_used[label_values] = self.tick
+
+        if self.max_series and len(self._children) > self.max_series:
+            evicted_label_values, _ = self._children.popitem(last=False)
+            self.metric.remove(*evicted_label_values)
+            self._dirty.add(evicted_label_values)
+            if self._last_used is not None:
+                del self._last_used[evicted_label_values]
+            self.evictions += 1
+
+        return child
+
+    def signature(self):
+        """Return what identifies the metric of this cache, and its series,
+        so a cache with the same signature can adopt them.
+        """
+
+        metric = self.metric
+
+        return (
+            self.name,
+            type(metric),
+            tuple(getattr(metric, '_labelnames', ())),
+            self.upper_bounds,
+            getattr(metric, 'quantiles', None),
+            getattr(metric, 'window', None),
+            getattr(metric, 'relative_accuracy', None),
+        )
+
+    def adopt(self, cache):
+        """Take over the metric and series of cache, with the same signature,
+        and its pending updates, which must already have been flushed.
+        """
+
+        self.metric = cache.metric
+        self.hits = cache.hits
+        self.misses = cache.misses
+        self.evictions = cache.evictions
+        self.expirations = cache.expirations
+
+        self.tick = cache.tick
+
+        self._children = cache._children
+        self._unshipped = cache._unshipped
+        self._dirty = cache._dirty
+        self._last_used = cache._last_used
+
+    def peek(self, label_values):
+        """Return the child for label_values, or None if there isn't one,
+        without creating it or counting it as used.
+        """
+
+        return self._children.get(label_values)
+
+    def take_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+
+        if self.windowed:
+            dirty.update(self._children)
+
+        return dirty
+
+    def start_expiry(self, tick):
+        """Start recording when the series are used, counting the existing
+        ones as used at tick.
+        """
+
+        self.tick = tick
+        self._last_used = OrderedDict(
+            (label_values, tick)
+            for label_values in self._children
+        )
+
+    @property
+    def expiring(self):
+        return self._last_used is not None
+
+    def expire(self, before):
+        """Remove the series last used before the tick before. The series
+        of a metric without labels are never removed.
+        """
+
+        last_used = self._last_used
+
+        while last_used:
+            label_values = next(iter(last_used))
+            if last_used[label_values] >= before or not label_values:
+                break
+
+            del last_used[label_values]
+            del self._children[label_values]
+            self.metric.remove(*label_values)
+            self._dirty.add(label_values)
+            self.expirations += 1
+
+    def start_batching(self):
+        self._pending = {}
+        self.get = self._get_pending
+
+    def _get_pending(self, label_values):
+        try:
+            return self._pending[label_values]
+        except KeyError:
+            pending = self._pending[label_values] = self.create_pending()
+            return pending
+
+    def take_deltas(self):
+        pending, self._pending = self._pending, {}
+
+        return {
+            label_values: pending_updates.delta()
+            for label_values, pending_updates in pending.items()
+        }
+
+    def apply_deltas(self, deltas):
+        apply_delta = self.apply_delta
+
+        for label_values, delta in deltas.items():
+            apply_delta(SeriesCache.get(self, label_values), delta)
+
+        if self._unshipped is not None:
+            for label_values, delta in deltas.items():
+                try:
+                    unshipped = self._unshipped[label_values]
+                except KeyError:
+                    unshipped = self._unshipped[label_values] = self.create_pending()
+
+                unshipped.merge(delta)
+
+    def flush(self):
+        self.apply_deltas(self.take_deltas())
+
+    def start_shipping(self):
+        self._unshipped = {}
+
+    @property
+    def shipping(self):
+        return self._unshipped is not None
+
+    def take_unshipped(self):
+        unshipped, self._unshipped = self._unshipped, {}
+
+        return {
+            label_values: pending_updates.delta()
+            for label_values, pending_updates in unshipped.items()
+        }
+
+
+class SeriesCacheCollector(object):
+    """Exports the statistics of the given SeriesCaches"""
+
+    def __init__(self, caches, namespace, registry=REGISTRY):
+        self.caches = caches
+        self.namespace = namespace
+
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        families = (
+            (
+                CounterMetricFamily,
+                'series_cache_hits_total',
+                "Lookups of series which were already cached",
+                lambda cache: cache.hits,
+            ),
+            (
+                CounterMetricFamily,
+                'series_cache_misses_total',
+                "Lookups of series which were not cached, and so were created",
+                lambda cache: cache.misses,
+            ),
+            (
+                CounterMetricFamily,
+                'series_cache_evictions_total',
+                "Series removed as more than the maximum number of series were in use",
+                lambda cache: cache.evictions,
+            ),
+            (
+                CounterMetricFamily,
+                'series_cache_expirations_total',
+                "Series removed as they had not been updated for longer than "
+                "the TTL of the series",
+                lambda cache: cache.expirations,
+            ),
+            (
+                GaugeMetricFamily,
+                'series',
+                "Current number of series",
+                len,
+            ),
+        )
+
+        for family_class, name, documentation, get_value in families:
+            family = family_class(
+                '%s_%s' % (self.namespace, name),
+                documentation,
+                labels=['metric'],
+            )
+            for cache in self.caches:
+                family.add_metric([cache.name], get_value(cache))
+
+            yield family
@@ -0,0 +1,276 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import time
+import threading
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import Metric, _floatToGoString
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Values below this are counted as 0
+MIN_VALUE = 1e-9
+
+
+class DDSketch(object):
+    """Counts values in buckets whose bounds grow exponentially, so that any
+    quantile is estimated within relative_accuracy of its value, as in
+    DDSketch (https://arxiv.org/abs/1908.10693).
+
+    At most max_bins buckets are kept, by merging the lowest ones, so the
+    memory used is bounded. Sketches with the same relative_accuracy can be
+    merged exactly, which is how they're batched.
+    """
+
+    __slots__ = ('gamma', 'multiplier', 'max_bins', 'bins', 'zero_count', 'count', 'sum')
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math.log(self.gamma)
+        self.max_bins = max_bins
+
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value, weight=1):
+        self.count += weight
+        self.sum += value * weight
+
+        if value < MIN_VALUE:
+            self.zero_count += weight
+            return
+
+        key = math.ceil(math.log(value) * self.multiplier)
+
+        bins = self.bins
+        try:
+            bins[key] += weight
+        except KeyError:
+            bins[key] = weight
+
+            if len(bins) > self.max_bins:
+                self.collapse()
+
+    def collapse(self):
+        lowest, second_lowest = sorted(self.bins)[:2]
+        self.bins[second_lowest] += self.bins.pop(lowest)
+
+    def delta(self):
+        return (self.sum, self.count, self.zero_count, self.bins)
+
+    def merge(self, delta):
+        total, count, zero_count, bins = delta
+
+        self.sum += total
+        self.count += count
+        self.zero_count += zero_count
+
+        own_bins = self.bins
+        for key, bin_count in bins.items():
+            own_bins[key] = own_bins.get(key, 0) + bin_count
+
+        while len(own_bins) > self.max_bins:
+            self.collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return float('nan')
+
+        rank = q * (self.count - 1)
+
+        accumulated = self.zero_count
+        if accumulated > rank:
+            return 0.0
+
+        for key in sorted(self.bins):
+            accumulated += self.bins[key]
+            if accumulated > rank:
+                # The middle of the bucket, within relative_accuracy of any
+                # value in it
+                return 2 * self.gamma ** key / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class SketchSummaryChild(object):
+    """The series of a SketchSummary for some label values.
+
+    Its values are counted in a ring of age_buckets sketches, each covering
+    window / age_buckets seconds, the oldest of which is replaced by an empty
+    one when that time has passed, so the quantiles are of the values from
+    roughly the last window seconds. The count and sum are of all values, as
+    for any summary.
+    """
+
+    __slots__ = ('summary', 'sketches', 'starts', 'current', 'rotate_at', 'count', 'sum')
+
+    def __init__(self, summary):
+        self.summary = summary
+
+        now = time.monotonic()
+
+        self.sketches = [summary.create_sketch() for _ in range(summary.age_buckets)]
+        self.starts = [now] + [-math.inf] * (summary.age_buckets - 1)
+        self.current = 0
+        self.rotate_at = now + summary.age
+
+        self.count = 0
+        self.sum = 0
+
+    def rotate(self, now):
+        summary = self.summary
+
+        elapsed = int((now - self.rotate_at) // summary.age) + 1
+        for _ in range(min(elapsed, summary.age_buckets)):
+            self.current = (self.current + 1) % summary.age_buckets
+            self.sketches[self.current] = summary.create_sketch()
+
+        self.rotate_at += elapsed * summary.age
+        self.starts[self.current] = self.rotate_at - summary.age
+
+    def observe(self, amount, weight=1):
+        now = time.monotonic()
+        if now >= self.rotate_at:
+            self.rotate(now)
+
+        self.sketches[self.current].observe(amount, weight)
+        self.count += weight
+        self.sum += amount * weight
+
+    def merge(self, delta):
+        now = time.monotonic()
+        if now >= self.rotate_at:
+            self.rotate(now)
+
+        self.sketches[self.current].merge(delta)
+        self.count += delta[1]
+        self.sum += delta[0]
+
+    @staticmethod
+    def apply_delta(child, delta):
+        child.merge(delta)
+
+    def _samples(self):
+        summary = self.summary
+
+        # Only read from the sketches being updated, as this is called while
+        # lines are being processed, copying their buckets in one step
+        window_start = time.monotonic() - summary.window
+        merged = summary.create_sketch()
+        for sketch, start in zip(list(self.sketches), list(self.starts)):
+            if start > window_start:
+                merged.merge((sketch.sum, sketch.count, sketch.zero_count, sketch.bins.copy()))
+
+        samples = [
+            ('', {'quantile': label}, merged.quantile(quantile))
+            for quantile, label in zip(summary.quantiles, summary.quantile_labels)
+        ]
+        samples.append(('_count', {}, float(self.count)))
+        samples.append(('_sum', {}, float(self.sum)))
+
+        return tuple(samples)
+
+
+class SketchSummary(SketchSummaryChild):
+    """A summary of the given quantiles of the values observed in the last
+    window seconds, estimated by sketches using constant memory per series,
+    within relative_accuracy.
+
+    It has the interface of a prometheus_client metric used by SeriesCache.
+    Like a prometheus_client metric, if it has no labels, it's the child of
+    the series itself.
+    """
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        namespace='',
+        quantiles=DEFAULT_QUANTILES,
+        window=600,
+        age_buckets=5,
+        relative_accuracy=0.01,
+        registry=REGISTRY,
+    ):
+        self.name = '%s_%s' % (namespace, name) if namespace else name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+
+        for quantile in quantiles:
+            if not 0 <= quantile <= 1:
+                raise ValueError('Invalid quantile: %s' % quantile)
+
+        self.quantiles = tuple(float(quantile) for quantile in quantiles)
+        self.quantile_labels = [_floatToGoString(quantile) for quantile in self.quantiles]
+        self.window = window
+        self.age_buckets = age_buckets
+        self.age = window / age_buckets
+        self.relative_accuracy = relative_accuracy
+
+        self._lock = threading.Lock()
+        self._children = {}
+
+        if self._labelnames:
+            self.summary = self
+        else:
+            super(SketchSummary, self).__init__(self)
+
+        if registry:
+            registry.register(self)
+
+    def create_sketch(self):
+        return DDSketch(self.relative_accuracy)
+
+    def labels(self, *label_values):
+        key = tuple(str(value) for value in label_values)
+        if len(key) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+
+        with self._lock:
+            try:
+                return self._children[key]
+            except KeyError:
+                child = self._children[key] = SketchSummaryChild(self)
+                return child
+
+    def remove(self, *label_values):
+        key = tuple(str(value) for value in label_values)
+
+        with self._lock:
+            del self._children[key]
+
+    def collect(self):
+        metric = Metric(self.name, self.documentation, 'summary')
+
+        if self._labelnames:
+            with self._lock:
+                children = list(self._children.items())
+        else:
+            children = [((), self)]
+
+        for label_values, child in children:
+            labels = dict(zip(self._labelnames, label_values))
+
+            for suffix, sample_labels, value in child._samples():
+                metric.add_sample(
+                    self.name + suffix,
+                    dict(labels, **sample_labels),
+                    value,
+                )
+
+        return [metric]
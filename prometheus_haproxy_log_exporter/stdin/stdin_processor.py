@@ -17,6 +17,8 @@ from ..log_processing import AbstractLogProcessor
 
 
 class StdinProcessor(AbstractLogProcessor):
+    source = 'stdin'
+
     def run(self):
         for line in sys.stdin:
             self.update_metrics(line)
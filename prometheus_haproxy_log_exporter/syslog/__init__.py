@@ -0,0 +1 @@
+from .syslog_processor import SyslogProcessor
@@ -0,0 +1,334 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import socket
+import struct
+import asyncio
+import logging
+import threading
+
+from prometheus_client import Counter
+
+from ..metrics import NAMESPACE
+from ..log_processing import AbstractLogProcessor
+
+# Not exposed by the socket module. Once set, the number of datagrams dropped
+# by the kernel for the socket is included with each datagram received.
+SO_RXQ_OVFL = 40
+
+# The maximum size of a syslog datagram which is read, larger ones are
+# truncated, and counted as dropped
+MAX_DATAGRAM_SIZE = 65535
+
+BOM = b'\xef\xbb\xbf'
+
+
+def parse_listen_address(address):
+    """Parse an address to listen on, e.g. udp://0.0.0.0:514,
+    tcp://[::]:514 or unix:///run/haproxy-log.sock, returning the
+    scheme, and the host and port or path.
+    """
+
+    scheme, separator, rest = address.partition('://')
+    if not separator or scheme not in ('udp', 'tcp', 'unix'):
+        raise ValueError(
+            "Invalid address %s, expected udp://, tcp:// or unix://" % address,
+        )
+
+    if scheme == 'unix':
+        return scheme, rest
+
+    host, _, port = rest.rpartition(':')
+    if host.startswith('['):
+        host = host[1:-1]
+
+    return scheme, (host or '0.0.0.0', int(port))
+
+
+def remove_stale_socket(path):
+    """Remove the unix socket at path, left by an earlier run, so it can be
+    bound again. Anything else at path is left, for binding to fail.
+    """
+
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def skip_structured_data(message):
+    """Return what follows the structured data elements, [id param="value"]...,
+    at the start of message, or b'' if they aren't terminated.
+    """
+
+    while message.startswith(b'['):
+        end_of_element = message.find(b']')
+        while end_of_element != -1 and message[end_of_element - 1:end_of_element] == b'\\':
+            end_of_element = message.find(b']', end_of_element + 1)
+        if end_of_element == -1:
+            return b''
+        message = message[end_of_element + 1:]
+
+    return message
+
+
+def strip_rfc5424_header(message):
+    """Return the message of the part of an RFC 5424 syslog message following
+    the version: TIMESTAMP HOSTNAME APP-NAME PROCID MSGID SD MSG
+    """
+
+    parts = message.split(b' ', 5)
+    if len(parts) < 6:
+        return b''
+
+    message = parts[5]
+
+    if message.startswith(b'-'):
+        message = message[2:]
+    else:
+        message = skip_structured_data(message)[1:]
+
+    if message.startswith(BOM):
+        message = message[len(BOM):]
+
+    return message
+
+
+def strip_rfc3164_header(message, end_of_priority):
+    """Return the message of an RFC 3164 syslog message, following its
+    priority: TIMESTAMP [HOSTNAME] TAG[PID]: MSG
+    """
+
+    end_of_tag = message.find(b': ', end_of_priority)
+    if end_of_tag == -1:
+        return message[end_of_priority + 1:]
+
+    return message[end_of_tag + 2:]
+
+
+def strip_syslog_header(message):
+    """Return the message of an RFC 3164 or RFC 5424 syslog message, e.g.
+    the HAProxy log line in
+
+    <134>Jun  9 12:31:39 haproxy[11058]: 127.0.0.1:42563 [09/Jun/2016...
+
+    <134>1 2016-06-09T12:31:39.908+02:00 lb1 haproxy 11058 - - 127.0.0.1...
+    """
+
+    if not message.startswith(b'<'):
+        return message
+
+    end_of_priority = message.find(b'>', 1, 5)
+    if end_of_priority == -1:
+        return message
+
+    if message[end_of_priority + 1:end_of_priority + 3] == b'1 ':
+        return strip_rfc5424_header(message[end_of_priority + 3:])
+
+    return strip_rfc3164_header(message, end_of_priority)
+
+
+def split_frames(buffer):
+    """Remove and return the complete messages in buffer, a bytearray of data
+    received over a stream, framed either by octet counting (RFC 6587), e.g.
+    "123 <134>...", or by a newline after each message.
+    """
+
+    messages = []
+    start = 0
+
+    while start < len(buffer):
+        if buffer[start:start + 1].isdigit():
+            end_of_length = buffer.find(b' ', start, start + 11)
+            if end_of_length == -1:
+                if len(buffer) - start > 10:
+                    raise ValueError("Invalid message length")
+                break
+
+            message_start = end_of_length + 1
+            message_end = message_start + int(buffer[start:end_of_length])
+            if message_end > len(buffer):
+                break
+
+            messages.append(bytes(buffer[message_start:message_end]))
+            start = message_end
+        else:
+            end_of_line = buffer.find(b'\n', start)
+            if end_of_line == -1:
+                break
+
+            messages.append(bytes(buffer[start:end_of_line]))
+            start = end_of_line + 1
+
+    del buffer[:start]
+
+    return messages
+
+
+class SyslogProcessor(AbstractLogProcessor):
+    """Receives HAProxy logs as syslog messages, over UDP, TCP or unix
+    datagram sockets, on each of the given addresses.
+
+    The datagrams available on a socket are read in one go, up to
+    messages_per_batch at a time, and processed with the lock taken once.
+    """
+
+    binary = True
+    source = 'syslog'
+
+    def __init__(
+        self,
+        addresses,
+        *args,
+        receive_buffer_size=16 * 1024 * 1024,
+        messages_per_batch=1000,
+        **kwargs
+    ):
+        super(SyslogProcessor, self).__init__(*args, **kwargs)
+
+        self.addresses = [parse_listen_address(address) for address in addresses]
+        self.receive_buffer_size = receive_buffer_size
+        self.messages_per_batch = messages_per_batch
+
+        self.dropped_datagrams = Counter(
+            'syslog_dropped_datagrams_total',
+            "Total syslog datagrams dropped, as the socket receive buffer was "
+            "full, or as they were too large",
+            namespace=NAMESPACE,
+        )
+
+        # The number of datagrams the kernel has dropped, for each socket
+        self.kernel_drops = {}
+
+        self.loop = None
+        self.sockets = []
+        self.servers = []
+        self.listening = threading.Event()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+
+        try:
+            self.loop.run_until_complete(self.listen())
+            self.listening.set()
+
+            self.loop.run_forever()
+        finally:
+            for server in self.servers:
+                server.close()
+
+            for sock in self.kernel_drops:
+                self.loop.remove_reader(sock)
+                sock.close()
+
+            self.loop.close()
+
+    def stop(self):
+        super(SyslogProcessor, self).stop()
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def listen(self):
+        for scheme, address in self.addresses:
+            if scheme == 'tcp':
+                server = await asyncio.start_server(
+                    self.handle_connection,
+                    *address,
+                    reuse_address=True,
+                )
+                self.servers.append(server)
+                self.sockets.extend(server.sockets)
+
+                logging.info("Listening for syslog messages on tcp://%s:%d" % address)
+                continue
+
+            if scheme == 'udp':
+                family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+            else:
+                remove_stale_socket(address)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            except OSError:
+                logging.info("The dropped datagrams for %s can't be counted" % (address,))
+
+            sock.bind(address)
+            sock.setblocking(False)
+
+            self.kernel_drops[sock] = 0
+            self.sockets.append(sock)
+            self.loop.add_reader(sock, self.receive_datagrams, sock)
+
+            logging.info("Listening for syslog messages on %s://%s" % (
+                scheme,
+                address if scheme == 'unix' else '%s:%d' % address,
+            ))
+
+    def receive_datagrams(self, sock):
+        messages = []
+        kernel_drops = None
+
+        while len(messages) < self.messages_per_batch:
+            try:
+                data, ancillary_data, flags, _ = sock.recvmsg(
+                    MAX_DATAGRAM_SIZE,
+                    socket.CMSG_SPACE(4),
+                )
+            except (BlockingIOError, InterruptedError):
+                break
+
+            for level, cmsg_type, cmsg_data in ancillary_data:
+                if level == socket.SOL_SOCKET and cmsg_type == SO_RXQ_OVFL:
+                    kernel_drops = struct.unpack('=I', cmsg_data[:4])[0]
+
+            if flags & socket.MSG_TRUNC:
+                self.dropped_datagrams.inc()
+                continue
+
+            messages.append(strip_syslog_header(data))
+
+        if kernel_drops is not None and kernel_drops > self.kernel_drops[sock]:
+            self.dropped_datagrams.inc(kernel_drops - self.kernel_drops[sock])
+            self.kernel_drops[sock] = kernel_drops
+
+        if messages:
+            self.update_metrics_batch(messages)
+
+    async def handle_connection(self, reader, writer):
+        buffer = bytearray()
+
+        try:
+            while True:
+                data = await reader.read(1 << 16)
+                if not data:
+                    break
+
+                buffer += data
+
+                messages = split_frames(buffer)
+                if messages:
+                    self.update_metrics_batch([
+                        strip_syslog_header(message)
+                        for message in messages
+                    ])
+        except (ConnectionError, ValueError) as e:
+            logging.info("Closing syslog connection: %s" % e)
+        finally:
+            writer.close()
@@ -0,0 +1,119 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import multiprocessing
+
+
+class WorkerPool(object):
+    """Parses lines in worker processes.
+
+    Lines are sent to the workers in batches of batch_lines. Each worker
+    parses the lines, collects the updates to the caches of the log processor
+    in its own copy of them, and sends them back as deltas, which are then
+    applied to the caches in this process.
+
+    The workers are forked, so they share the metric definitions of the log
+    processor without them having to be pickled.
+    """
+
+    def __init__(self, log_processor, workers, batch_lines):
+        self.log_processor = log_processor
+        self.workers = workers
+        self.batch_lines = batch_lines
+
+        context = multiprocessing.get_context('fork')
+
+        self.lines_queue = context.Queue(maxsize=workers * 4)
+        self.deltas_queue = context.Queue()
+
+        self.processes = [
+            context.Process(
+                target=self.work,
+                name='%s-worker-%d' % (log_processor.name, i),
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+
+        self.merger = threading.Thread(target=self.merge_deltas)
+        self.merger.daemon = True
+
+        self.batch = []
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+        self.merger.start()
+
+    def submit(self, raw_line, weight=1, source=None):
+        self.batch.append((raw_line, weight, source))
+
+        if len(self.batch) >= self.batch_lines:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.lines_queue.put(self.batch)
+            self.batch = []
+
+    def stop(self):
+        """Process any remaining lines, and wait for the workers to exit"""
+
+        self.flush()
+
+        for _ in self.processes:
+            self.lines_queue.put(None)
+
+        for process in self.processes:
+            process.join()
+
+        self.merger.join()
+
+    def work(self):
+        caches = self.log_processor.caches
+
+        for cache in caches:
+            cache.start_batching()
+
+        while True:
+            lines = self.lines_queue.get()
+
+            if lines is None:
+                self.deltas_queue.put(None)
+                return
+
+            for raw_line, weight, source in lines:
+                self.log_processor.process_line(raw_line, weight, source)
+
+            self.deltas_queue.put([cache.take_deltas() for cache in caches])
+
+    def merge_deltas(self):
+        caches = self.log_processor.caches
+        running_workers = self.workers
+
+        while running_workers:
+            all_deltas = self.deltas_queue.get()
+
+            if all_deltas is None:
+                running_workers -= 1
+                continue
+
+            try:
+                with self.log_processor.lock:
+                    for cache, deltas in zip(caches, all_deltas):
+                        cache.apply_deltas(deltas)
+            except Exception:
+                logging.exception("Failed to apply the deltas from a worker")
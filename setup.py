@@ -14,12 +14,10 @@ else:
              'configargparse',
              'prometheus-client',
              #'systemd', ??? Unknown which module this is
-             'haproxy-log-analysis<2.0',
              #'pkg-resources', ??? Unknown which module this is
-             'tailhead'
         ],
         "setup_requires":['pytest-runner'],
-        "tests_require":['pytest-sugar', 'pytest-html', 'pytest-cov', 'pytest'],
+        "tests_require":['pytest-sugar', 'pytest-html', 'pytest-cov', 'pytest', 'haproxy-log-analysis<2.0'],
     }
 
 setup(
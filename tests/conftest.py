@@ -2,6 +2,14 @@
 # -*- coding: utf-8
 import pytest
 
+from prometheus_client import CollectorRegistry, Histogram
+
+from prometheus_haproxy_log_exporter.log_processing import AbstractLogProcessor
+from prometheus_haproxy_log_exporter.metrics import (
+    DEFAULT_QUEUE_LENGTH_BUCKETS, DEFAULT_TIMER_BUCKETS, compile_plan,
+    requests_total, server_queue_length, timer,
+)
+
 LOG_CONTENT = """\
 Jun  9 12:31:39 softwarelb1-prod1.z01.finn.no haproxy[11058]: 127.0.0.1:42563 [09/Jun/2016:12:31:39.908] cache.api.finn.no-tls cache.api.finn.no-backend/apicache3.finn.no 0/0/1/1/2 200 1771 - - ---- 1/1/0/0/0 0/0 "GET / HTTP/1.1"
 Jun  9 12:31:39 softwarelb1-prod1.z01.finn.no haproxy[11066]: 127.0.0.1:42563 [09/Jun/2016:12:31:39.900] cache.api.finn.no-tls-termination~ cache.api.finn.no-tls-termination/cache.api.finn.no-tls-frontend 8/1/11 1752 -- 0/0/0/0/0 0/0
@@ -44,3 +52,43 @@ def tmpfile(tmpdir):
 def logfile(tmpfile):
     tmpfile.write(LOG_CONTENT)
     return tmpfile
+
+
+def create_log_processor(
+    log_processor_class=AbstractLogProcessor,
+    histogram_class=Histogram,
+    **kwargs
+):
+    registry = CollectorRegistry()
+    update_metrics = compile_plan([
+        requests_total(['status_code', 'backend_name'], registry=registry),
+        timer(
+            'session_duration_milliseconds', ['backend_name'], DEFAULT_TIMER_BUCKETS,
+            registry=registry, histogram_class=histogram_class,
+        ),
+        timer(
+            'request_queued_milliseconds', [], DEFAULT_TIMER_BUCKETS,
+            registry=registry, histogram_class=histogram_class,
+        ),
+        server_queue_length(
+            [], DEFAULT_QUEUE_LENGTH_BUCKETS,
+            registry=registry, histogram_class=histogram_class,
+        ),
+    ])
+
+    log_processor = log_processor_class(
+        metric_updaters=[update_metrics],
+        fields=update_metrics.fields,
+        caches=update_metrics.caches,
+        **kwargs
+    )
+
+    return registry, log_processor
+
+
+def samples(registry):
+    return sorted(
+        (name, sorted(labels.items()), value)
+        for metric in registry.collect()
+        for name, labels, value in metric.samples
+    )
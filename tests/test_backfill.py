@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import gzip
+
+from prometheus_haproxy_log_exporter.backfill import get_argument_parser, backfill
+
+
+def test_backfill(tmpdir, log_content):
+    log_file = tmpdir.join('haproxy.log.1.gz')
+    with gzip.open(str(log_file), 'wt') as f:
+        f.write(log_content)
+
+    options = get_argument_parser().parse_args([
+        str(log_file),
+        '--output-directory', str(tmpdir),
+        '--step', '5',
+        '--enabled-metrics', 'requests_total', 'session_duration_milliseconds',
+        '--requests-total-labels', 'status_code',
+    ])
+
+    output_path, processing_errors = backfill(options, str(log_file))
+
+    assert processing_errors == 0
+    assert output_path == str(tmpdir.join('haproxy.log.1.gz.om'))
+
+    output = open(output_path).read().splitlines()
+
+    assert output[-1] == '# EOF'
+
+    # Families are not interleaved
+    families = [line.split()[2] for line in output if line.startswith('# TYPE')]
+    assert families == sorted(set(families), key=families.index)
+
+    assert '# TYPE haproxy_log_requests counter' in output
+
+    # 12:31:39 to 12:31:49, in steps of 5 seconds ending at 12:31:40, 45 and 50
+    requests = [
+        line for line in output
+        if line.startswith('haproxy_log_requests_total{status_code="200"}')
+    ]
+    assert requests == [
+        'haproxy_log_requests_total{status_code="200"} 1.0 1465475500',
+        'haproxy_log_requests_total{status_code="200"} 6.0 1465475505',
+        'haproxy_log_requests_total{status_code="200"} 13.0 1465475510',
+    ]
+
+
+def test_rotated_files(tmpdir, log_content):
+    lines = log_content.splitlines(keepends=True)
+    log_files = [str(tmpdir.join('haproxy.log.1')), str(tmpdir.join('haproxy.log'))]
+    with open(log_files[0], 'w') as f:
+        f.write(''.join(lines[:10]))
+    with open(log_files[1], 'w') as f:
+        f.write(''.join(lines[10:]))
+
+    options = get_argument_parser().parse_args(log_files + [
+        '--output-directory', str(tmpdir),
+        '--step', '5',
+        '--enabled-metrics', 'requests_total',
+        '--requests-total-labels', 'status_code',
+    ])
+
+    requests = []
+    for i, log_file in enumerate(log_files):
+        output_path, _ = backfill(options, log_file, final=i == len(log_files) - 1)
+
+        requests.append([
+            line.split()[1:]
+            for line in open(output_path).read().splitlines()
+            if line.startswith('haproxy_log_requests_total{status_code="200"}')
+        ])
+
+    # The step ending at 12:31:45 is split between the files, and only the
+    # second has a sample at the end of it
+    assert requests == [
+        [['1.0', '1465475500']],
+        [['1.0', '1465475505'], ['8.0', '1465475510']],
+    ]
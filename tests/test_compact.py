@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from prometheus_client import CollectorRegistry, Histogram
+
+from prometheus_haproxy_log_exporter.compact import CompactHistogram
+from prometheus_haproxy_log_exporter.series import SeriesCache
+
+from conftest import samples
+
+
+def test_compact_histogram():
+    registry = CollectorRegistry()
+    compact_registry = CollectorRegistry()
+
+    histogram = Histogram('test', 'Test', ['code'], buckets=(1, 10), registry=registry)
+    compact = CompactHistogram('test', 'Test', ['code'], buckets=(1, 10), registry=compact_registry)
+
+    for code, value in (('200', 0.5), ('200', 5), ('404', 1), ('500', 100)):
+        histogram.labels(code).observe(value)
+        compact.labels(code).observe(value)
+
+    assert samples(compact_registry) == samples(registry)
+
+    # The slot of a removed series is reused, and starts empty
+    child = compact.labels('404')
+    slot = child.slot
+    compact.remove('404')
+    assert child.slot is None
+    assert compact.labels('302').slot == slot
+    assert compact.labels('302')._samples()[-2] == ('_count', {}, 0.0)
+
+    histogram.remove('404')
+    histogram.labels('302')
+
+    assert samples(compact_registry) == samples(registry)
+
+
+def test_unlabelled():
+    registry = CollectorRegistry()
+    compact_registry = CollectorRegistry()
+
+    histogram = Histogram('test', 'Test', namespace='ns', registry=registry)
+    compact = CompactHistogram('test', 'Test', namespace='ns', registry=compact_registry)
+
+    histogram.observe(0.3)
+    compact.observe(0.3)
+
+    assert samples(compact_registry) == samples(registry)
+
+
+def test_series_cache():
+    registry = CollectorRegistry()
+    compact = CompactHistogram('test', 'Test', ['code'], buckets=(1, 10), registry=registry)
+
+    cache = SeriesCache('test', compact, max_series=2, buckets=(1, 10))
+    cache.start_batching()
+
+    cache.get(('200',)).observe(5, 2)
+    cache.get(('404',)).observe(20)
+    cache.get(('200',)).observe(0.5)
+    cache.flush()
+
+    assert registry.get_sample_value('test_bucket', {'code': '200', 'le': '1.0'}) == 1
+    assert registry.get_sample_value('test_bucket', {'code': '200', 'le': '10.0'}) == 3
+    assert registry.get_sample_value('test_sum', {'code': '200'}) == 10.5
+    assert registry.get_sample_value('test_count', {'code': '404'}) == 1
+
+    # Evicts 200
+    cache.get(('500',)).observe(1)
+    cache.flush()
+
+    assert registry.get_sample_value('test_count', {'code': '200'}) is None
+    assert registry.get_sample_value('test_count', {'code': '500'}) == 1
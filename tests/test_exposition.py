@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import gzip
+import threading
+import tracemalloc
+import urllib.error
+import urllib.request
+
+from http.server import ThreadingHTTPServer
+
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client.exposition import generate_latest
+
+from prometheus_haproxy_log_exporter.exposition import (
+    CachedExposition, IncrementalExposition, accepts_gzip,
+    create_request_handler,
+)
+from prometheus_haproxy_log_exporter.series import SeriesCache
+
+
+def test_accepts_gzip():
+    assert accepts_gzip('gzip')
+    assert accepts_gzip('deflate, gzip;q=1.0, *;q=0.5')
+    assert accepts_gzip('*')
+    assert not accepts_gzip('')
+    assert not accepts_gzip('identity')
+    assert not accepts_gzip('gzip;q=0')
+
+
+def test_cached_exposition():
+    registry = CollectorRegistry()
+    counter = Counter('test_total', 'Test', registry=registry)
+
+    exposition = CachedExposition(registry, max_age=60)
+
+    output = exposition.get()
+    assert b'test_total 0.0' in output
+
+    counter.inc()
+
+    # Still cached
+    assert exposition.get() is output
+    assert gzip.decompress(exposition.get(gzipped=True)) == output
+
+    exposition.max_age = 0
+
+    assert b'test_total 1.0' in exposition.get()
+    assert exposition.renders == 2
+
+
+def test_request_handler(tmpdir):
+    registry = CollectorRegistry()
+    Counter('test_total', 'Test', registry=registry).inc()
+
+    licence = tmpdir.join('LICENSE')
+    licence.write('Licence')
+
+    httpd = ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        create_request_handler(str(licence), CachedExposition(registry)),
+    )
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+    try:
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert response.headers.get('Content-Encoding') is None
+            assert b'test_total 1.0' in response.read()
+
+        request = urllib.request.Request(
+            url + '/metrics',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+        with urllib.request.urlopen(request) as response:
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert b'test_total 1.0' in gzip.decompress(response.read())
+
+        with urllib.request.urlopen(url + '/licence') as response:
+            assert response.read() == b'Licence'
+
+        # Not enabled
+        with urllib.request.urlopen(url + '/debug/tracemalloc') as response:
+            assert b'<html' in response.read()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_debug_endpoints(tmpdir):
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            sum(range(1000))
+
+    spinner = threading.Thread(target=spin, name='spinner')
+    spinner.start()
+
+    httpd = ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        create_request_handler(
+            str(tmpdir.join('LICENSE')),
+            CachedExposition(CollectorRegistry()),
+            debug_threads=[spinner],
+        ),
+    )
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+    try:
+        with urllib.request.urlopen(url + '/debug/profile?seconds=0.2') as response:
+            stacks = response.read().decode('utf-8').splitlines()
+
+        assert stacks
+        for stack in stacks:
+            frames, count = stack.rsplit(' ', 1)
+            assert frames.startswith('spinner;')
+            assert int(count) > 0
+        assert any('spin (' in stack for stack in stacks)
+
+        try:
+            urllib.request.urlopen(url + '/debug/profile?seconds=-1')
+        except urllib.error.HTTPError as e:
+            assert e.code == 400
+        else:
+            assert False
+
+        with urllib.request.urlopen(url + '/debug/tracemalloc') as response:
+            assert response.read().startswith(b'Started tracing')
+
+        with urllib.request.urlopen(url + '/debug/tracemalloc?limit=5') as response:
+            output = response.read().decode('utf-8').splitlines()
+            assert output[0].startswith('Traced')
+            assert len(output) <= 6
+
+        with urllib.request.urlopen(url + '/debug/tracemalloc?stop=1') as response:
+            output = response.read().decode('utf-8').splitlines()
+            assert output[0].startswith('Traced')
+            assert output[-1].startswith('Stopped tracing')
+
+        assert not tracemalloc.is_tracing()
+    finally:
+        stop.set()
+        spinner.join()
+        tracemalloc.stop()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def parse_exposition(output):
+    return sorted(
+        line for line in output.decode('utf-8').splitlines()
+        if not line.startswith('#')
+    )
+
+
+def test_incremental_exposition():
+    registry = CollectorRegistry()
+    counter_cache = SeriesCache(
+        'requests_total',
+        Counter('requests_total', 'Requests', ['code'], registry=registry),
+        max_series=2,
+    )
+    histogram_cache = SeriesCache(
+        'duration',
+        Histogram('duration', 'Duration', ['code'], buckets=[1, 10], registry=registry),
+        buckets=[1, 10],
+    )
+    unlabelled_cache = SeriesCache(
+        'errors_total',
+        Counter('errors_total', 'Errors', registry=registry),
+    )
+    Counter('other_total', 'Other', registry=registry).inc()
+
+    exposition = IncrementalExposition(
+        (counter_cache, histogram_cache, unlabelled_cache),
+        threading.Lock(),
+        registry,
+        max_age=0,
+    )
+
+    def update(code, duration):
+        counter_cache.get((code,)).inc()
+        histogram_cache.get((code,)).observe(duration)
+
+    update('200', 5)
+    update('500', 20)
+
+    assert parse_exposition(exposition.get()) == parse_exposition(generate_latest(registry))
+    fragment_200 = exposition.fragments[counter_cache.metric][('200',)]
+
+    update('500', 0.5)
+    unlabelled_cache.get(()).inc()
+
+    assert parse_exposition(exposition.get()) == parse_exposition(generate_latest(registry))
+
+    # Only the changed series are rendered again
+    assert exposition.fragments[counter_cache.metric][('200',)] is fragment_200
+
+    # Evicting 200
+    update('404', 5)
+
+    output = exposition.get()
+    assert parse_exposition(output) == parse_exposition(generate_latest(registry))
+    assert b'code="200"' not in output.split(b'# HELP duration')[0]
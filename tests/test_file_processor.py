@@ -1,13 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 
+import os
+import signal
+import socket
+import subprocess
+import sys
 import threading
 import time
+import urllib.request
 from unittest.mock import MagicMock
 
 import pytest
 
-from prometheus_haproxy_log_exporter.file.log_file_processor import LogFileProcessor
+from prometheus_haproxy_log_exporter.file.log_file_processor import (
+    LogFileProcessor, expand_paths, load_positions,
+)
+from prometheus_haproxy_log_exporter.file.tail import FileTail
 
 @pytest.fixture()
 def updater_mock():
@@ -18,7 +27,7 @@ def test_follow(tmpfile, updater_mock, log_content):
     tmp = tmpfile.open('w')
     log_processor = LogFileProcessor(
         metric_updaters=[updater_mock],
-        path=str(tmpfile),
+        paths=[str(tmpfile)],
     )
     lp = threading.Thread(target=log_processor.run)
     lp.start()
@@ -30,4 +39,236 @@ def test_follow(tmpfile, updater_mock, log_content):
     time.sleep(1)
     log_processor.should_exit = True
     lp.join()
-    assert updater_mock.call_count == 13
+    assert updater_mock.call_count == 23
+
+
+def test_follow_multiple(tmpdir, updater_mock, log_content):
+    paths = [str(tmpdir.join('haproxy-%d.log' % i)) for i in range(2)]
+    for path in paths:
+        open(path, 'w').close()
+
+    log_processor = LogFileProcessor(
+        metric_updaters=[updater_mock],
+        paths=[str(tmpdir.join('haproxy-*.log'))],
+    )
+    lp = threading.Thread(target=log_processor.run)
+    lp.start()
+    time.sleep(0.5)
+    lines = log_content.splitlines(keepends=True)
+    for path, content in ((paths[0], lines[:5]), (paths[1], lines[5:])):
+        with open(path, 'a') as f:
+            f.write(''.join(content))
+    time.sleep(0.5)
+    log_processor.should_exit = True
+    lp.join()
+
+    sources = [call[0][0].source for call in updater_mock.call_args_list]
+    assert sources.count(paths[0]) == 5
+    assert sources.count(paths[1]) == len(lines) - 5
+
+
+def test_expand_paths(tmpdir):
+    for name in ('b.log', 'a.log', 'c.txt'):
+        tmpdir.join(name).write('')
+
+    assert expand_paths([
+        str(tmpdir.join('*.log')),
+        str(tmpdir.join('a.log')),
+        str(tmpdir.join('missing.log')),
+        str(tmpdir.join('*.gz')),
+    ]) == [
+        str(tmpdir.join('a.log')),
+        str(tmpdir.join('b.log')),
+        str(tmpdir.join('missing.log')),
+    ]
+
+
+def test_tail_rotation(tmpfile):
+    path = str(tmpfile)
+    tmpfile.write_binary(b'old line\n')
+
+    tail = FileTail(path)
+    assert tail.read_lines() == []
+
+    with open(path, 'ab') as f:
+        f.write(b'line 1\nline 2\npartial')
+    assert tail.read_lines() == [b'line 1', b'line 2']
+    assert tail.read_lines() == []
+
+    # rename and create
+    os.rename(path, path + '.1')
+    with open(path + '.1', 'ab') as f:
+        f.write(b' line 3\n')
+    with open(path, 'wb') as f:
+        f.write(b'line 4\n')
+    assert tail.read_lines() == [b'partial line 3']
+    assert tail.read_lines() == [b'line 4']
+
+    # copytruncate
+    with open(path, 'wb') as f:
+        f.write(b'l5\n')
+    assert tail.read_lines() == [b'l5']
+
+    tail.close()
+
+
+def test_tail_wait(tmpfile):
+    tmpfile.write_binary(b'')
+    tail = FileTail(str(tmpfile))
+
+    def write():
+        time.sleep(0.1)
+        with open(str(tmpfile), 'ab') as f:
+            f.write(b'line 1\n')
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    start = time.time()
+    tail.wait(timeout=5)
+    assert time.time() - start < 2
+    assert tail.read_lines() == [b'line 1']
+
+    writer.join()
+    tail.close()
+
+
+def test_tail_resume_after_rotation(tmpfile):
+    path = str(tmpfile)
+    tmpfile.write_binary(b'')
+
+    tail = FileTail(path)
+    with open(path, 'ab') as f:
+        f.write(b'line 1\npart')
+    assert tail.read_lines() == [b'line 1']
+    position = tail.get_position()
+    tail.close()
+
+    # Written and rotated while stopped
+    with open(path, 'ab') as f:
+        f.write(b'ial line 2\n')
+    os.rename(path, path + '.1')
+    with open(path, 'wb') as f:
+        f.write(b'line 3\n')
+
+    tail = FileTail(path, position=position)
+    assert tail.read_lines() == [b'partial line 2']
+    assert tail.read_lines() == [b'line 3']
+    tail.close()
+
+
+def test_checkpoint(tmpfile, tmpdir, updater_mock, log_content):
+    state_path = str(tmpdir.join('state.json'))
+    tmpfile.write('')
+
+    def run(content):
+        log_processor = LogFileProcessor(
+            metric_updaters=[updater_mock],
+            paths=[str(tmpfile)],
+            state_path=state_path,
+        )
+        lp = threading.Thread(target=log_processor.run)
+        lp.start()
+        time.sleep(0.5)
+        with tmpfile.open('a') as f:
+            f.write(content)
+        time.sleep(0.5)
+        log_processor.should_exit = True
+        lp.join()
+
+    lines = log_content.splitlines(keepends=True)
+    run(''.join(lines[:10]))
+    assert updater_mock.call_count == 10
+
+    # Lines written while the exporter isn't running
+    with tmpfile.open('a') as f:
+        f.write(''.join(lines[10:15]))
+
+    run(''.join(lines[15:]))
+    assert updater_mock.call_count == len(lines)
+
+
+def test_checkpoint_when_terminated(tmpfile, tmpdir, log_content):
+    state_path = str(tmpdir.join('state.json'))
+    tmpfile.write('')
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    def lines_read():
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port) as response:
+                metrics = response.read().decode('utf-8')
+        except OSError:
+            return None
+
+        for line in metrics.splitlines():
+            if line.startswith('haproxy_log_source_lines_total{'):
+                return float(line.rsplit(' ', 1)[1])
+
+        return 0
+
+    def wait_until(predicate):
+        deadline = time.monotonic() + 10
+        while not predicate():
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+
+    exporter = subprocess.Popen(
+        [
+            sys.executable, '-c',
+            'from prometheus_haproxy_log_exporter.cli import main; main()',
+            '--file', str(tmpfile),
+            '--file-state-path', state_path,
+            '--host', '127.0.0.1',
+            '--port', str(port),
+        ],
+        env=dict(os.environ, PYTHONPATH=os.getcwd()),
+    )
+
+    try:
+        wait_until(lambda: lines_read() is not None)
+
+        with tmpfile.open('a') as f:
+            f.write(log_content)
+
+        wait_until(lambda: lines_read() == len(log_content.splitlines()))
+
+        # Well before the periodic checkpoint
+        assert not os.path.exists(state_path)
+
+        exporter.send_signal(signal.SIGTERM)
+        assert exporter.wait(20) == 0
+    finally:
+        if exporter.poll() is None:
+            exporter.kill()
+
+    _, _, offset = load_positions(state_path)[str(tmpfile)]
+    assert offset == len(log_content)
+
+
+def test_checkpoint_queued_lines(tmpfile, tmpdir, updater_mock, log_content):
+    state_path = str(tmpdir.join('state.json'))
+    tmpfile.write('')
+
+    # The lines are queued, but never processed, as the consumer isn't started
+    log_processor = LogFileProcessor(
+        metric_updaters=[updater_mock],
+        paths=[str(tmpfile)],
+        state_path=state_path,
+        checkpoint_interval=0.1,
+        queue_lines=100,
+    )
+    lp = threading.Thread(target=log_processor.run)
+    lp.start()
+    time.sleep(0.2)
+    with tmpfile.open('a') as f:
+        f.write(log_content)
+    time.sleep(0.5)
+    log_processor.should_exit = True
+    lp.join()
+
+    assert len(log_processor.ingest_queue) == len(log_content.splitlines())
+    # Any position saved is from before the lines
+    assert load_positions(state_path).get(str(tmpfile), (0, 0, 0))[2] == 0
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import time
+import threading
+
+from prometheus_haproxy_log_exporter.ingest import IngestQueue
+
+
+def test_drop_oldest():
+    ingest_queue = IngestQueue(3, 'drop-oldest')
+    ingest_queue.put_many([1, 2, 3, 4, 5], 'file')
+
+    assert ingest_queue.get_many(10) == [(3, 1, 'file'), (4, 1, 'file'), (5, 1, 'file')]
+    assert ingest_queue.dropped == 2
+
+
+def test_block():
+    ingest_queue = IngestQueue(2, 'block')
+    ingest_queue.put_many([1, 2])
+
+    producer = threading.Thread(target=ingest_queue.put_many, args=([3, 4],))
+    producer.start()
+
+    time.sleep(0.05)
+    assert producer.is_alive()
+
+    assert ingest_queue.get_many(10) == [(1, 1, None), (2, 1, None)]
+    lines = []
+    while len(lines) < 2:
+        lines += ingest_queue.get_many(10, timeout=1)
+
+    producer.join()
+    assert lines == [(3, 1, None), (4, 1, None)]
+    assert ingest_queue.dropped == 0
+
+
+def test_sample():
+    ingest_queue = IngestQueue(4, 'sample', sample_every=3)
+    ingest_queue.put_many(range(4))
+
+    # The queue is full, so sampling starts with the next line
+    producer = threading.Thread(target=ingest_queue.put_many, args=(range(4, 10),))
+    producer.start()
+
+    time.sleep(0.05)
+    assert ingest_queue.sampling
+
+    assert ingest_queue.get_many(1) == [(0, 1, None)]
+    time.sleep(0.05)
+    assert ingest_queue.get_many(1) == [(1, 1, None)]
+
+    producer.join()
+
+    assert ingest_queue.get_many(10) == [(2, 1, None), (3, 1, None), (4, 3, None), (7, 3, None)]
+    assert ingest_queue.sampled_out == 4
+    assert ingest_queue.dropped == 0
+
+    # Sampling stops once the queue is half empty
+    assert not ingest_queue.sampling
+
+
+def test_join():
+    ingest_queue = IngestQueue(10, 'drop-oldest')
+    ingest_queue.put_many(range(12))
+    assert ingest_queue.unfinished == 10
+
+    lines = ingest_queue.get_many(5)
+    assert not ingest_queue.join(timeout=0.01)
+
+    # Lines are only done once processed, not when taken
+    ingest_queue.task_done(len(lines))
+    lines = ingest_queue.get_many(10)
+    assert not ingest_queue.join(timeout=0.01)
+
+    ingest_queue.task_done(len(lines))
+    assert ingest_queue.join(timeout=0.01)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import os
+import time
+import shutil
+import subprocess
+
+import pytest
+
+from prometheus_haproxy_log_exporter.cli import stop
+from prometheus_haproxy_log_exporter.log_processing import (
+    MultiSourceProcessor, load_state, save_state,
+)
+
+from conftest import create_log_processor
+
+journal = pytest.importorskip('systemd.journal')
+
+from prometheus_haproxy_log_exporter.journal import JournalProcessor  # noqa: E402
+
+SYSTEMD_JOURNAL_REMOTE = [
+    path
+    for path in (
+        '/lib/systemd/systemd-journal-remote',
+        '/usr/lib/systemd/systemd-journal-remote',
+        shutil.which('systemd-journal-remote'),
+    )
+    if path is not None and os.path.exists(path)
+]
+
+
+@pytest.fixture()
+def journal_file(tmpdir, log_content):
+    """A journal file, with an entry for haproxy.service for each line"""
+
+    if not SYSTEMD_JOURNAL_REMOTE:
+        pytest.skip("systemd-journal-remote is required to create journal files")
+
+    export = b''.join(
+        (
+            '__REALTIME_TIMESTAMP=%d\n'
+            '__MONOTONIC_TIMESTAMP=%d\n'
+            '_BOOT_ID=0123456789abcdef0123456789abcdef\n'
+            '_SYSTEMD_UNIT=haproxy.service\n'
+            'MESSAGE=%s\n'
+            '\n' % (1465475499000000 + i, i + 1, line.split(': ', 1)[1])
+        ).encode('utf-8')
+        for i, line in enumerate(log_content.splitlines())
+    )
+
+    path = str(tmpdir.join('haproxy.journal'))
+    subprocess.run(
+        [SYSTEMD_JOURNAL_REMOTE[0], '--output=%s' % path, '-'],
+        input=export,
+        check=True,
+    )
+
+    return path
+
+
+def test_resume_from_cursor(tmpdir, journal_file, log_content):
+    with journal.Reader(files=[journal_file]) as j:
+        j._next()
+        j._next()
+        cursor = j._get_cursor()
+
+    state_path = str(tmpdir.join('state'))
+    save_state(state_path, {'unit': 'haproxy.service', 'cursor': cursor})
+
+    messages = []
+
+    journal_processor = JournalProcessor(
+        metric_updaters=[],
+        units=['haproxy.service'],
+        files=[journal_file],
+        state_path=state_path,
+        entries_per_batch=5,
+    )
+
+    def update_metrics_batch(raw_lines, source=None):
+        messages.extend(raw_lines)
+        if len(messages) >= len(log_content.splitlines()) - 2:
+            journal_processor.should_exit = True
+
+    journal_processor.update_metrics_batch = update_metrics_batch
+    journal_processor.run()
+
+    # Everything after the first two entries
+    assert messages == [
+        line.split(': ', 1)[1].encode('utf-8')
+        for line in log_content.splitlines()[2:]
+    ]
+
+    # The cursor of the last entry is saved on exit
+    with journal.Reader(files=[journal_file]) as j:
+        j.seek_tail()
+        j._previous()
+        assert load_state(state_path)['cursor'] == j._get_cursor()
+
+
+def test_save_cursor_when_stopped(tmpdir, journal_file, log_content):
+    with journal.Reader(files=[journal_file]) as j:
+        j._next()
+        cursor = j._get_cursor()
+
+    state_path = str(tmpdir.join('state'))
+    save_state(state_path, {'unit': 'haproxy.service', 'cursor': cursor})
+
+    # Stopped as when the exporter is, with the journal as one of its sources
+    _, log_processor = create_log_processor(MultiSourceProcessor)
+    log_processor.add_source(JournalProcessor(
+        metric_updaters=None,
+        sink=log_processor,
+        units=['haproxy.service'],
+        files=[journal_file],
+        state_path=state_path,
+    ))
+    log_processor.start()
+
+    deadline = time.monotonic() + 10
+    while log_processor.lines_read.get('haproxy.service') != len(log_content.splitlines()) - 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    # Well before the periodic checkpoint
+    assert load_state(state_path)['cursor'] == cursor
+
+    stop(log_processor, None)
+    assert not log_processor.is_alive()
+
+    with journal.Reader(files=[journal_file]) as j:
+        j.seek_tail()
+        j._previous()
+        assert load_state(state_path)['cursor'] == j._get_cursor()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import pytest
+
+from prometheus_haproxy_log_exporter.line_filter import LineFilter, filter_rule
+
+
+def test_filter_rule():
+    assert filter_rule('status=5xx') == ('status', '5xx')
+
+    with pytest.raises(ValueError):
+        filter_rule('path=/')
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_exclude(log_content, binary):
+    line_filter = LineFilter(
+        exclude_rules=[
+            ('backend', 'statistics'),
+            ('frontend', '*-tls-termination'),
+        ],
+        binary=binary,
+    )
+
+    lines = log_content.splitlines()
+    if binary:
+        lines = [line.encode('utf-8') for line in lines]
+
+    kept = [line for line in lines if line_filter(line)]
+
+    assert len(kept) == 11
+    assert all(b'cache.api.finn.no-backend/' in line for line in (
+        line if binary else line.encode('utf-8') for line in kept
+    ))
+    assert line_filter.skipped == [2, 10]
+
+
+def test_include(log_content):
+    line_filter = LineFilter(
+        include_rules=[('server', 'apicache3*'), ('status', '2xx')],
+        exclude_rules=[('server', '<STATS>')],
+    )
+
+    kept = [line for line in log_content.splitlines() if line_filter(line)]
+
+    # Only HTTP lines have a status
+    assert len(kept) == 11
+    assert line_filter.skipped == [2, 0, 0]
+    assert line_filter.not_included == 10
+
+    assert line_filter('not a log line')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from haproxy.haproxy_logline import HaproxyLogLine
+
+from prometheus_haproxy_log_exporter.log_processing import JOURNAL_REGEX
+from prometheus_haproxy_log_exporter.log_parser import FIELDS, create_parser
+
+
+def test_http_lines_match_haproxy_logline(log_content):
+    parse = create_parser()
+    http_lines = 0
+
+    for raw_line in log_content.splitlines():
+        expected = HaproxyLogLine(JOURNAL_REGEX.sub('', raw_line.strip()))
+        if not expected.valid:
+            continue
+
+        line = parse(raw_line)
+        assert line.is_http
+        http_lines += 1
+
+        for field in FIELDS:
+            if field == 'accept_date':
+                assert line.accept_date == expected.raw_accept_date
+            elif field == 'termination_state':
+                # Not parsed by HaproxyLogLine
+                assert line.termination_state in ('----', 'LR--')
+            elif field == 'source':
+                # Set by the log processor, not parsed
+                assert line.source is None
+            else:
+                assert getattr(line, field) == getattr(expected, field), field
+
+    assert http_lines == 13
+
+
+def test_tcp_line():
+    parse = create_parser()
+    line = parse(
+        "Jun  9 12:31:39 softwarelb1-prod1.z01.finn.no haproxy[11066]: 127.0.0.1:42563 [09/Jun/2016:12:31:39.900] "
+        "cache.api.finn.no-tls-termination~ cache.api.finn.no-tls-termination/cache.api.finn.no-tls-frontend "
+        "8/1/11 1752 -- 0/0/0/0/0 0/0"
+    )
+
+    assert not line.is_http
+    assert line.frontend_name == 'cache.api.finn.no-tls-termination~'
+    assert line.backend_name == 'cache.api.finn.no-tls-termination'
+    assert line.server_name == 'cache.api.finn.no-tls-frontend'
+    assert line.time_wait_queues == 8
+    assert line.time_connect_server == 1
+    assert line.total_time == '11'
+    assert line.bytes_read == '1752'
+    assert line.time_wait_request is None
+    # A deliberate label value for the fields TCP lines lack
+    assert line.status_code == ''
+    assert line.http_request_path == ''
+
+
+def test_only_requested_fields():
+    parse = create_parser(('backend_name', 'total_time'))
+    line = parse(
+        '127.0.0.1:42563 [09/Jun/2016:12:31:39.908] cache.api.finn.no-tls '
+        'cache.api.finn.no-backend/apicache3.finn.no 0/0/1/1/+2 200 1771 - - ---- 1/1/0/0/0 0/0 '
+        '{Mozilla/5.0} "GET /some/path?q=1 HTTP/1.1"'
+    )
+
+    assert line.backend_name == 'cache.api.finn.no-backend'
+    assert line.total_time == '+2'
+    assert line.frontend_name is None
+    assert line.http_request_path is None
+
+
+def test_invalid_line():
+    parse = create_parser()
+
+    assert parse("Jun  9 12:31:39 lb1 haproxy[11066]: Proxy fe started.") is None
+
+
+def test_binary(log_content):
+    parse = create_parser()
+    parse_binary = create_parser(binary=True)
+
+    for raw_line in log_content.splitlines():
+        line = parse(raw_line)
+        binary_line = parse_binary(raw_line.encode('utf-8'))
+
+        for field in FIELDS:
+            assert getattr(binary_line, field) == getattr(line, field)
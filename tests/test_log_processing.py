@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import time
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_haproxy_log_exporter.cli import (
+    create_metric_updater, get_argument_parser, reload_metrics,
+)
+from prometheus_haproxy_log_exporter.compact import CompactHistogram
+from prometheus_haproxy_log_exporter.exposition import IncrementalExposition
+from prometheus_haproxy_log_exporter.log_processing import (
+    AbstractLogProcessor, MultiSourceProcessor,
+)
+from prometheus_haproxy_log_exporter.metrics import compile_plan, requests_total
+
+from conftest import create_log_processor, samples
+
+
+def test_batching(log_content):
+    registry, log_processor = create_log_processor()
+    batched_registry, batched_log_processor = create_log_processor(batch_lines=10)
+
+    lines = log_content.splitlines()
+    for line in lines:
+        log_processor.update_metrics(line)
+        batched_log_processor.update_metrics(line)
+
+    # The last 3 lines are still pending
+    assert batched_registry.get_sample_value(
+        'haproxy_log_request_queued_milliseconds_count',
+    ) == 20
+
+    batched_log_processor.flush()
+
+    assert samples(batched_registry) == samples(registry)
+    assert batched_registry.get_sample_value(
+        'haproxy_log_request_queued_milliseconds_count',
+    ) == len(lines)
+
+
+def test_workers(log_content):
+    registry, log_processor = create_log_processor()
+    workers_registry, workers_log_processor = create_log_processor(workers=2, batch_lines=4)
+
+    workers_log_processor.worker_pool.start()
+
+    for line in log_content.splitlines() + ['not a log line']:
+        log_processor.update_metrics(line)
+        workers_log_processor.update_metrics(line)
+
+    workers_log_processor.worker_pool.stop()
+
+    assert samples(workers_registry) == samples(registry)
+    assert workers_log_processor.processing_errors.get(())._value.get() == 1
+
+
+def test_weights(log_content):
+    registry, log_processor = create_log_processor()
+    weighted_registry, weighted_log_processor = create_log_processor()
+    batched_registry, batched_log_processor = create_log_processor(batch_lines=10)
+
+    for line in log_content.splitlines():
+        log_processor.update_metrics(line)
+        log_processor.update_metrics(line)
+
+        weighted_log_processor.process_line(line, weight=2)
+        batched_log_processor.process_line(line, weight=2)
+
+    batched_log_processor.flush()
+
+    assert samples(weighted_registry) == samples(registry)
+    assert samples(batched_registry) == samples(registry)
+
+
+def test_compact_histograms(log_content):
+    registry, log_processor = create_log_processor()
+    compact_registry, compact_log_processor = create_log_processor(
+        histogram_class=CompactHistogram,
+    )
+    batched_registry, batched_log_processor = create_log_processor(
+        histogram_class=CompactHistogram,
+        batch_lines=10,
+    )
+
+    for line in log_content.splitlines():
+        log_processor.process_line(line)
+        log_processor.process_line(line, weight=3)
+
+        compact_log_processor.process_line(line)
+        compact_log_processor.process_line(line, weight=3)
+
+        batched_log_processor.process_line(line)
+        batched_log_processor.process_line(line, weight=3)
+
+    batched_log_processor.flush()
+
+    assert samples(compact_registry) == samples(registry)
+    assert samples(batched_registry) == samples(registry)
+
+
+def test_ingest_queue(log_content):
+    registry, log_processor = create_log_processor()
+    queue_registry, queue_log_processor = create_log_processor(queue_lines=100)
+
+    queue_log_processor.start()
+
+    lines = log_content.splitlines()
+    for line in lines:
+        log_processor.update_metrics(line)
+        queue_log_processor.update_metrics(line)
+
+    deadline = time.monotonic() + 5
+    while (
+        queue_registry.get_sample_value('haproxy_log_request_queued_milliseconds_count') != len(lines) and
+        time.monotonic() < deadline
+    ):
+        time.sleep(0.01)
+
+    assert samples(queue_registry) == samples(registry)
+    assert queue_log_processor.lag['unknown'] > 0
+
+
+def test_instrumentation(log_content):
+    registry, log_processor = create_log_processor(batch_lines=10)
+
+    lines = log_content.splitlines()
+    for line in lines:
+        log_processor.update_metrics(line)
+    log_processor.flush()
+
+    assert log_processor.lines_read == {'unknown': len(lines)}
+    assert log_processor.bytes_read == {'unknown': sum(len(line) for line in lines)}
+    assert log_processor.lag['unknown'] > 0
+
+    # Only the first line is timed, and the filter stage is skipped without
+    # filters
+    stage_durations = log_processor.stage_durations.metric
+    for stage, count in (('filter', 0), ('parse', 1), ('update', 1)):
+        assert stage_durations.labels(stage)._samples()[-2][2] == count
+
+
+def test_reload(log_content):
+    p = get_argument_parser()
+    options = p.parse_args([
+        '--stdin',
+        '--enabled-metrics', 'requests_total', 'bytes_read_total', 'server_queue_length',
+    ])
+
+    registry = CollectorRegistry()
+    update_metrics = create_metric_updater(options, registry=registry)
+    log_processor = AbstractLogProcessor(
+        metric_updaters=[update_metrics],
+        fields=update_metrics.fields,
+        caches=update_metrics.caches,
+        batch_lines=10,
+    )
+
+    lines = log_content.splitlines()
+    for line in lines:
+        log_processor.update_metrics(line)
+
+    reload_metrics(log_processor, p.parse_args([
+        '--stdin',
+        '--enabled-metrics', 'requests_total', 'bytes_read_total', 'backend_queue_length',
+        '--requests-total-labels', 'backend_name',
+    ]), registry=registry)
+
+    names = set(sample[0] for sample in samples(registry))
+    assert 'haproxy_log_server_queue_length_count' not in names
+    assert 'haproxy_log_backend_queue_length_count' in names
+
+    # The unchanged metric keeps its series, and the pending updates
+    bytes_read = [
+        sample for sample in samples(registry)
+        if sample[0] == 'haproxy_log_bytes_read_total'
+    ]
+    assert sum(value for _, _, value in bytes_read) == len(lines)
+
+    for line in lines:
+        log_processor.update_metrics(line)
+    log_processor.flush()
+
+    assert registry.get_sample_value(
+        'haproxy_log_backend_queue_length_count',
+    ) == len(lines)
+    assert sum(
+        value for name, labels, value in samples(registry)
+        if name == 'haproxy_log_requests_total'
+    ) == len(lines)
+    assert [
+        value for name, labels, value in samples(registry)
+        if name == 'haproxy_log_bytes_read_total'
+    ] == [value * 2 for _, _, value in bytes_read]
+
+
+class ListProcessor(AbstractLogProcessor):
+    binary = True
+
+    def __init__(self, raw_lines, *args, **kwargs):
+        super(ListProcessor, self).__init__(*args, **kwargs)
+
+        self.raw_lines = raw_lines
+
+    def run(self):
+        for raw_line in self.raw_lines:
+            self.update_metrics(raw_line)
+
+
+def test_multiple_sources(log_content):
+    registry = CollectorRegistry()
+    update_metrics = compile_plan([requests_total(['source'], registry=registry)])
+
+    log_processor = MultiSourceProcessor(
+        metric_updaters=[update_metrics],
+        fields=update_metrics.fields,
+        caches=update_metrics.caches,
+    )
+
+    lines = [line.encode('utf-8') for line in log_content.splitlines()]
+    for source, raw_lines in (('first', lines[:5]), ('second', lines[5:])):
+        log_processor.add_source(ListProcessor(
+            raw_lines,
+            metric_updaters=None,
+            source=source,
+            sink=log_processor,
+        ))
+
+    log_processor.start()
+    log_processor.join()
+
+    assert log_processor.lines_read == {'first': 5, 'second': len(lines) - 5}
+    assert registry.get_sample_value(
+        'haproxy_log_requests_total', {'source': 'first'},
+    ) == 5
+    assert registry.get_sample_value(
+        'haproxy_log_requests_total', {'source': 'second'},
+    ) == len(lines) - 5
+
+
+def test_series_expiry(log_content):
+    registry, log_processor = create_log_processor(series_ttl=0.01)
+    exposition = IncrementalExposition(
+        log_processor.caches,
+        log_processor.lock,
+        registry,
+        max_age=0,
+    )
+
+    lines = log_content.splitlines()
+    for line in lines:
+        log_processor.update_metrics(line)
+    log_processor.expire_series()
+    assert b'haproxy_log_requests_total{' in exposition.get()
+
+    time.sleep(0.02)
+    log_processor.expire_series()
+
+    names = set(sample[0] for sample in samples(registry))
+    assert 'haproxy_log_requests_total' not in names
+    assert 'haproxy_log_session_duration_milliseconds_count' not in names
+    # Metrics without labels are kept
+    assert 'haproxy_log_request_queued_milliseconds_count' in names
+    assert b'haproxy_log_requests_total{' not in exposition.get()
+
+    log_processor.update_metrics(lines[0])
+    assert b'haproxy_log_requests_total{' in exposition.get()
+
+
+def test_tcp_lines(log_content):
+    registry, log_processor = create_log_processor()
+
+    tcp_lines = [line for line in log_content.splitlines() if '"' not in line]
+    for line in tcp_lines:
+        log_processor.update_metrics(line)
+
+    assert log_processor.processing_errors.peek(()) is None
+    assert registry.get_sample_value('haproxy_log_requests_total', {
+        'status_code': '',
+        'backend_name': 'cache.api.finn.no-tls-termination',
+    }) == len(tcp_lines)
+    assert 'None' not in set(
+        value
+        for _, labels, _ in samples(registry)
+        for _, value in labels
+    )
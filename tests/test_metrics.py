@@ -2,10 +2,17 @@
 # -*- coding: utf-8
 
 from haproxy.haproxy_logline import HaproxyLogLine
-from prometheus_client import REGISTRY
+from prometheus_client import REGISTRY, CollectorRegistry
 
+from prometheus_haproxy_log_exporter.log_parser import create_parser
 from prometheus_haproxy_log_exporter.log_processing import JOURNAL_REGEX
-from prometheus_haproxy_log_exporter.metrics import timer, DEFAULT_TIMER_BUCKETS
+from prometheus_haproxy_log_exporter.metrics import (
+    DEFAULT_TIMER_BUCKETS, NAMESPACE, bytes_read_total, compile_plan,
+    requests_total, timer,
+)
+from prometheus_haproxy_log_exporter.series import SeriesCacheCollector
+
+from conftest import samples
 
 
 def test_timer(log_content):
@@ -29,3 +36,104 @@ def test_timer(log_content):
         for name, labels, value in metric.samples:
             if name in expected:
                 assert value == expected[name][labels["backend_name"]]
+
+
+def test_compile_plan(log_content):
+    def create_updaters(registry):
+        return [
+            requests_total(['status_code', 'backend_name'], registry=registry),
+            bytes_read_total(['status_code', 'backend_name'], registry=registry),
+            timer('request_queued_milliseconds', ['server_name'], DEFAULT_TIMER_BUCKETS, registry=registry),
+            timer('session_duration_milliseconds', [], DEFAULT_TIMER_BUCKETS, registry=registry),
+        ]
+
+    separate_registry = CollectorRegistry()
+    separate_updaters = create_updaters(separate_registry)
+
+    plan_registry = CollectorRegistry()
+    plan = compile_plan(create_updaters(plan_registry))
+
+    assert plan.fields == ('status_code', 'backend_name', 'server_name', 'time_wait_queues', 'total_time')
+
+    parse = create_parser(plan.fields)
+    for raw_line in log_content.splitlines():
+        line = parse(raw_line)
+        for updater in separate_updaters:
+            updater(line)
+        plan(line)
+
+    assert samples(plan_registry) == samples(separate_registry)
+    assert plan_registry.get_sample_value(
+        'haproxy_log_requests_total',
+        {'status_code': '200', 'backend_name': 'statistics'},
+    ) == 2
+
+
+def test_series_cache_eviction():
+    class Line(object):
+        def __init__(self, http_request_path):
+            self.http_request_path = http_request_path
+
+    registry = CollectorRegistry()
+    updater = requests_total(['http_request_path'], registry=registry, max_series=2)
+    SeriesCacheCollector(updater.caches, NAMESPACE, registry=registry)
+
+    for path in ('/a', '/b', '/a', '/c', '/a'):
+        updater(Line(path))
+
+    def requests(path):
+        return registry.get_sample_value(
+            'haproxy_log_requests_total',
+            {'http_request_path': path},
+        )
+
+    # /b was the least recently used series when /c was added
+    assert requests('/a') == 3
+    assert requests('/b') is None
+    assert requests('/c') == 1
+
+    cache_labels = {'metric': 'haproxy_log_requests_total'}
+    assert registry.get_sample_value('haproxy_log_series_cache_hits_total', cache_labels) == 2
+    assert registry.get_sample_value('haproxy_log_series_cache_misses_total', cache_labels) == 3
+    assert registry.get_sample_value('haproxy_log_series_cache_evictions_total', cache_labels) == 1
+    assert registry.get_sample_value('haproxy_log_series', cache_labels) == 2
+
+
+def test_series_cache_expiry():
+    class Line(object):
+        def __init__(self, http_request_path):
+            self.http_request_path = http_request_path
+
+    registry = CollectorRegistry()
+    updater = requests_total(['http_request_path'], registry=registry)
+    cache, = updater.caches
+
+    updater(Line('/a'))
+    cache.start_expiry(0)
+
+    cache.tick = 10
+    updater(Line('/b'))
+    cache.tick = 20
+    updater(Line('/c'))
+    cache.take_dirty()
+
+    def requests(path):
+        return registry.get_sample_value(
+            'haproxy_log_requests_total',
+            {'http_request_path': path},
+        )
+
+    cache.expire(10)
+    assert requests('/a') is None
+    assert requests('/b') == 1
+    assert cache.take_dirty() == {('/a',)}
+
+    # Updating a series records the current tick
+    cache.tick = 30
+    updater(Line('/b'))
+    cache.expire(25)
+    assert requests('/b') == 2
+    assert requests('/c') is None
+
+    assert len(cache) == 1
+    assert cache.expirations == 2
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from prometheus_haproxy_log_exporter.log_parser import create_parser
+from prometheus_haproxy_log_exporter.paths import PathNormalizer
+
+
+def test_replace_ids():
+    normalize = PathNormalizer()
+
+    assert normalize('/') == '/'
+    assert normalize('/search?q=1') == '/search'
+    assert normalize('/users/123/orders/') == '/users/{number}/orders/'
+    assert normalize(
+        '/items/3f2504e0-4f89-11d3-9a0c-0305e82c3301',
+    ) == '/items/{uuid}'
+    assert normalize('/blobs/deadbeef42') == '/blobs/{hex}'
+    assert normalize('/words/acceded/facade') == '/words/acceded/facade'
+    assert normalize(b'/users/1?x') == '/users/{number}'
+
+
+def test_templates():
+    normalize = PathNormalizer([
+        '/users/{user}',
+        '/users/{user}/orders/{order}',
+        '/users/me/orders',
+        '/static/*',
+    ])
+
+    assert normalize('/users/bob') == '/users/{user}'
+    assert normalize('/users/bob/orders/1?page=2') == '/users/{user}/orders/{order}'
+    assert normalize('/users/me/orders') == '/users/me/orders'
+
+    # The literal me doesn't match, so {user} is used
+    assert normalize('/users/me/orders/7') == '/users/{user}/orders/{order}'
+
+    assert normalize('/static/css/site.css') == '/static/*'
+
+    # No template matches
+    assert normalize('/users/bob/invoices/5') == '/users/bob/invoices/{number}'
+
+
+def test_cache():
+    normalize = PathNormalizer(max_cache_size=2)
+
+    normalize('/a/1')
+    normalize('/a/1')
+    normalize('/a/2')
+    normalize('/a/3')
+
+    cache_info = normalize.normalize.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.currsize == 2
+
+
+def test_parser(log_content):
+    parse = create_parser(
+        ('http_request_path',),
+        binary=True,
+        path_normalizer=PathNormalizer(),
+    )
+
+    paths = set(
+        parse(line.encode('utf-8')).http_request_path
+        for line in log_content.splitlines()
+    )
+
+    # TCP lines have no path
+    assert paths == {'', '/', '/statistics;csv'}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import socket
+import threading
+import urllib.error
+import urllib.request
+import zlib
+
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_haproxy_log_exporter.exposition import create_request_handler
+from prometheus_haproxy_log_exporter.log_processing import AbstractLogProcessor
+from prometheus_haproxy_log_exporter.metrics import compile_plan, requests_total, timer
+from prometheus_haproxy_log_exporter.push import (
+    SKETCH, AggregateProcessor, DeltaPusher, decode_deltas, encode_deltas,
+)
+
+from conftest import create_log_processor, samples
+
+
+def test_encoding():
+    caches_deltas = [
+        ('requests_total', (0, 0.0), {('200', 'be'): 3.0, ('404', 'be'): 1.0}),
+        ('timer', (3, 0.0), {(): (12.5, (1.0, 0.0, 2.0))}),
+        ('summary', (SKETCH, 0.01), {('be',): (12.5, 4.0, 1.0, {-3: 1.0, 115: 2.0})}),
+    ]
+
+    data = encode_deltas('lb1', b'0123456789abcdef', 7, caches_deltas)
+
+    assert decode_deltas(data) == ('lb1', b'0123456789abcdef', 7, caches_deltas)
+
+    with pytest.raises(ValueError):
+        decode_deltas(data[:-3])
+
+
+@pytest.fixture
+def aggregator():
+    registry, aggregator = create_log_processor(AggregateProcessor)
+
+    httpd = ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        create_request_handler('LICENSE', aggregator=aggregator),
+    )
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    aggregator.url = 'http://127.0.0.1:%d/push' % httpd.server_address[1]
+    aggregator.registry = registry
+
+    yield aggregator
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_push(log_content, aggregator):
+    lines = log_content.splitlines()
+
+    registry, log_processor = create_log_processor()
+    for line in lines:
+        log_processor.update_metrics(line)
+        log_processor.update_metrics(line)
+
+    pushers = []
+    for instance in ('lb1', 'lb2'):
+        _, pushing_log_processor = create_log_processor(batch_lines=5)
+        pusher = DeltaPusher(pushing_log_processor, aggregator.url, instance)
+        pushers.append(pusher)
+
+        for line in lines[:10]:
+            pushing_log_processor.update_metrics(line)
+
+        pushing_log_processor.flush()
+        pusher.push()
+
+        for line in lines[10:]:
+            pushing_log_processor.update_metrics(line)
+
+        pushing_log_processor.flush()
+        pusher.push()
+
+    assert [pusher.pushes for pusher in pushers] == [2, 2]
+    assert samples(aggregator.registry) == samples(registry)
+
+
+def test_retry(log_content, aggregator):
+    registry, log_processor = create_log_processor()
+    _, pushing_log_processor = create_log_processor(batch_lines=5)
+
+    # A port nothing is listening on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    unused_port = sock.getsockname()[1]
+    sock.close()
+
+    url = aggregator.url
+    pusher = DeltaPusher(pushing_log_processor, 'http://127.0.0.1:%d/push' % unused_port, 'lb1')
+
+    lines = log_content.splitlines()
+    for line in lines[:10]:
+        log_processor.update_metrics(line)
+        pushing_log_processor.update_metrics(line)
+
+    pushing_log_processor.flush()
+    pusher.push()
+    assert pusher.failures == 1
+    push_data = pusher.push_data
+
+    # The failed push is sent again, and the lines since in the next one
+    pusher.url = url
+    for line in lines[10:]:
+        log_processor.update_metrics(line)
+        pushing_log_processor.update_metrics(line)
+
+    pushing_log_processor.flush()
+    pusher.push()
+    assert pusher.pushes == 2
+
+    # Receiving a push again, e.g. when the response was lost, changes nothing
+    assert not aggregator.receive(push_data)
+    assert aggregator.duplicate_pushes == {'lb1': 1}
+    assert aggregator.last_seqs == {'lb1': (pusher.boot_id, 2)}
+
+    assert samples(aggregator.registry) == samples(registry)
+
+
+def test_rejected(log_content, aggregator):
+    lines = log_content.splitlines()
+
+    registry = CollectorRegistry()
+    update_metrics = compile_plan([
+        requests_total(['status_code', 'backend_name'], registry=registry),
+        # With a different label, and different buckets
+        timer('session_duration_milliseconds', ['frontend_name'], [1, 10], registry=registry),
+    ])
+    pushing_log_processor = AbstractLogProcessor(
+        metric_updaters=[update_metrics],
+        fields=update_metrics.fields,
+        caches=update_metrics.caches,
+        batch_lines=5,
+    )
+    pusher = DeltaPusher(pushing_log_processor, aggregator.url, 'lb1')
+
+    for line in lines:
+        pushing_log_processor.update_metrics(line)
+    pushing_log_processor.flush()
+
+    # The push is rejected, and dropped rather than sent again forever
+    pusher.push()
+    assert pusher.rejected == 1
+    assert pusher.push_data is None
+
+    # None of it is applied, not even the counter which does match
+    assert aggregator.received_pushes == {}
+    assert 'haproxy_log_requests_total' not in set(
+        name for name, _, _ in samples(aggregator.registry)
+    )
+
+    for counts in ((1.0, 2.0), (1.0, 2.0, 3.0, 4.0)):
+        push_data = encode_deltas('lb1', pusher.boot_id, 1, [
+            ('haproxy_log_requests_total', (0, 0.0), {('200', 'be'): 1.0}),
+            ('haproxy_log_request_queued_milliseconds', (len(counts), 0.0), {(): (1.0, counts)}),
+        ])
+        with pytest.raises(ValueError):
+            aggregator.receive(push_data)
+
+    assert 'haproxy_log_requests_total' not in set(
+        name for name, _, _ in samples(aggregator.registry)
+    )
+
+
+def test_size_limits(log_content, aggregator):
+    data = zlib.compress(bytes(1024 * 1024))
+
+    aggregator.max_push_size = len(data) - 1
+    request = urllib.request.Request(aggregator.url, data=data)
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(request)
+    assert e.value.code == 413
+
+    # Not decompressed beyond the limit
+    aggregator.max_push_size = len(data)
+    aggregator.max_deltas_size = 1024
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(request)
+    assert e.value.code == 400
+    assert 'larger than 1024 bytes' in e.value.reason
+
+    with pytest.raises(ValueError):
+        decode_deltas(data, 1024)
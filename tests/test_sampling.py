@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import pytest
+
+from prometheus_haproxy_log_exporter.sampling import Sampler, sampling_rule
+
+LINE = (
+    'Jun  9 12:31:39 lb1 haproxy[11066]: %s [09/Jun/2016:12:31:39.900] '
+    'fe~ be/srv 8/1/11 1752 -- 0/0/0/0/0 0/0'
+)
+
+
+def test_sampling_rule():
+    assert sampling_rule('www=0.25') == ('www', 0.25)
+
+    with pytest.raises(ValueError):
+        sampling_rule('www')
+    with pytest.raises(ValueError):
+        sampling_rule('www=0')
+
+
+def test_sampler():
+    sampler = Sampler([('fe', 0.25)], [])
+    binary_sampler = Sampler([('fe', 0.25)], [], binary=True)
+
+    weights = []
+    for port in range(10000):
+        line = LINE % ('10.0.0.1:%d' % port)
+
+        weight = sampler(line)
+        assert binary_sampler(line.encode('utf-8')) == weight
+
+        # Deterministic for each client address
+        assert sampler(line) == weight
+
+        weights.append(weight)
+
+    assert set(weights) == {0, 4}
+    assert 0.23 < weights.count(4) / len(weights) < 0.27
+
+    # About as many lines as were seen are accounted for
+    assert 9000 < sum(weights) < 11000
+
+
+def test_sampler_rules():
+    sampler = Sampler([('other', 0.5)], [('be', 0.0001)])
+
+    # The backend rule applies, as there is no rule for fe
+    assert sampler(LINE % '10.0.0.1:1') == 0
+
+    assert Sampler([('fe', 1)], [('be', 0.0001)])(LINE % '10.0.0.1:1') == 1
+
+    # No rule, or not a log line
+    assert Sampler([('other', 0.0001)], [])(LINE % '10.0.0.1:1') == 1
+    assert Sampler([('other', 0.0001)], [])('not a log line') == 1
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import math
+import random
+
+from prometheus_client import CollectorRegistry
+
+from prometheus_haproxy_log_exporter import sketch
+from prometheus_haproxy_log_exporter.series import SeriesCache, weighted_observe
+from prometheus_haproxy_log_exporter.sketch import DDSketch, SketchSummary
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_ddsketch():
+    values = [random.Random(0).lognormvariate(3, 2) for _ in range(10000)]
+
+    dd_sketch = DDSketch(relative_accuracy=0.01)
+    for value in values:
+        dd_sketch.observe(value)
+
+    values.sort()
+    for quantile in (0.5, 0.9, 0.99, 0.999):
+        expected = values[int(quantile * (len(values) - 1))]
+        assert abs(dd_sketch.quantile(quantile) - expected) <= expected * 0.01
+
+    assert math.isnan(DDSketch().quantile(0.5))
+
+
+def test_ddsketch_merge():
+    first = DDSketch()
+    second = DDSketch()
+    both = DDSketch()
+
+    for value in range(100):
+        first.observe(value)
+        both.observe(value)
+    for value in range(50, 500):
+        second.observe(value, 2)
+        both.observe(value, 2)
+
+    first.merge(second.delta())
+
+    assert first.delta() == both.delta()
+
+
+def test_ddsketch_max_bins():
+    dd_sketch = DDSketch(max_bins=10)
+    for value in range(1, 1000):
+        dd_sketch.observe(value)
+
+    assert len(dd_sketch.bins) == 10
+    assert dd_sketch.count == 999
+    assert abs(dd_sketch.quantile(0.99) - 989) <= 989 * 0.01
+
+
+def test_window(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sketch, 'time', clock)
+
+    registry = CollectorRegistry()
+    summary = SketchSummary(
+        'test', 'Test', ['code'],
+        quantiles=(0.5,), window=100, age_buckets=4, registry=registry,
+    )
+
+    child = summary.labels('200')
+    for _ in range(10):
+        child.observe(1000)
+
+    clock.now += 60
+    for _ in range(10):
+        child.observe(10)
+
+    # Both halves are within the window
+    assert registry.get_sample_value('test', {'code': '200', 'quantile': '0.5'}) > 10
+
+    clock.now += 60
+
+    # The first observations are no longer in the window, even without
+    # observing anything since
+    assert abs(registry.get_sample_value('test', {'code': '200', 'quantile': '0.5'}) - 10) < 0.1
+    assert registry.get_sample_value('test_count', {'code': '200'}) == 20
+    assert registry.get_sample_value('test_sum', {'code': '200'}) == 10100
+
+    clock.now += 1000
+    child.observe(5)
+
+    assert abs(registry.get_sample_value('test', {'code': '200', 'quantile': '0.5'}) - 5) < 0.05
+
+
+def test_series_cache():
+    registry = CollectorRegistry()
+    batched_registry = CollectorRegistry()
+
+    summary = SketchSummary('test', 'Test', ['code'], registry=registry)
+    batched_summary = SketchSummary('test', 'Test', ['code'], registry=batched_registry)
+
+    cache = SeriesCache('test', summary)
+    batched_cache = SeriesCache('test', batched_summary)
+    batched_cache.start_batching()
+
+    for value in range(100):
+        for series_cache in (cache, batched_cache):
+            series_cache.get(('200',)).observe(value)
+            weighted_observe(series_cache.get(('500',)), value, 3)
+
+    batched_cache.flush()
+
+    assert list(batched_registry.collect()) == list(registry.collect())
+    assert registry.get_sample_value('test_count', {'code': '500'}) == 300
+
+    # The quantiles of every series can change over time
+    cache.take_dirty()
+    assert cache.take_dirty() == {('200',), ('500',)}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+import socket
+import time
+
+from prometheus_haproxy_log_exporter.syslog import SyslogProcessor
+from prometheus_haproxy_log_exporter.syslog.syslog_processor import (
+    parse_listen_address, remove_stale_socket, split_frames,
+    strip_syslog_header,
+)
+
+MESSAGE = (
+    b'127.0.0.1:42563 [09/Jun/2016:12:31:39.908] fe be/srv 0/0/1/1/2 200 '
+    b'1771 - - ---- 1/1/0/0/0 0/0 "GET / HTTP/1.1"'
+)
+
+
+def test_parse_listen_address():
+    assert parse_listen_address('udp://127.0.0.1:514') == ('udp', ('127.0.0.1', 514))
+    assert parse_listen_address('tcp://[::1]:514') == ('tcp', ('::1', 514))
+    assert parse_listen_address('unix:///run/log.sock') == ('unix', '/run/log.sock')
+
+
+def test_strip_syslog_header():
+    assert strip_syslog_header(
+        b'<134>Jun  9 12:31:39 haproxy[11058]: ' + MESSAGE,
+    ) == MESSAGE
+    assert strip_syslog_header(
+        b'<134>Jun  9 12:31:39 lb1 haproxy[11058]: ' + MESSAGE,
+    ) == MESSAGE
+    assert strip_syslog_header(
+        b'<134>1 2016-06-09T12:31:39.908+02:00 lb1 haproxy 11058 - - ' + MESSAGE,
+    ) == MESSAGE
+    assert strip_syslog_header(
+        b'<134>1 2016-06-09T12:31:39.908+02:00 lb1 haproxy 11058 - '
+        b'[meta a="\\]"][other] ' + MESSAGE,
+    ) == MESSAGE
+    assert strip_syslog_header(MESSAGE) == MESSAGE
+
+
+def test_remove_stale_socket(tmpdir):
+    socket_path = str(tmpdir.join('haproxy-log.sock'))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(socket_path)
+
+    remove_stale_socket(socket_path)
+    assert not tmpdir.join('haproxy-log.sock').exists()
+
+    # Nothing to remove
+    remove_stale_socket(socket_path)
+
+    # Not a socket, e.g. a mistyped path
+    tmpdir.join('haproxy.log').write('')
+    remove_stale_socket(str(tmpdir.join('haproxy.log')))
+    assert tmpdir.join('haproxy.log').exists()
+
+
+def test_split_frames():
+    buffer = bytearray(b'5 <1>ab<2>c\n3 <3')
+
+    assert split_frames(buffer) == [b'<1>ab', b'<2>c']
+    assert buffer == bytearray(b'3 <3')
+
+    buffer += b'>'
+    assert split_frames(buffer) == [b'<3>']
+    assert buffer == bytearray()
+
+
+def test_syslog_processor(tmpdir):
+    messages = []
+
+    syslog_processor = SyslogProcessor(
+        metric_updaters=[],
+        addresses=[
+            'udp://127.0.0.1:0',
+            'tcp://127.0.0.1:0',
+            'unix://%s' % tmpdir.join('log.sock'),
+        ],
+    )
+    syslog_processor.update_metrics_batch = messages.extend
+    syslog_processor.daemon = True
+    syslog_processor.start()
+    syslog_processor.listening.wait(5)
+
+    udp_address, tcp_address = [
+        sock.getsockname() for sock in syslog_processor.sockets[:2]
+    ]
+
+    message = b'<134>Jun  9 12:31:39 haproxy[11058]: ' + MESSAGE
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(message, udp_address)
+
+    with socket.create_connection(tcp_address) as sock:
+        sock.sendall(b'%d %s%s\n' % (len(message), message, message))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(message, str(tmpdir.join('log.sock')))
+
+    deadline = time.monotonic() + 5
+    while len(messages) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    syslog_processor.stop()
+    syslog_processor.join()
+
+    assert messages == [MESSAGE] * 4